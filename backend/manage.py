@@ -0,0 +1,786 @@
+"""Maintenance commands for the EatFlex backend, kept out of the API process.
+
+Usage: cd backend && python manage.py <command> [args]
+
+  migrate-images | migrate-engagement | migrate-follows   one-off data migrations
+  migrate-phashes                                          key stored photo hashes by meal name
+  rebuild-rollups | backfill-streaks | build-foods         rebuild derived data
+  check-indexes                                            run tests/test_indexes.py against MONGO_URL
+  bench-insights [meals] | bench-recipes [count] | bench-nutrition [runs]
+  bench-serialization [runs] | bench-phash [hashes]
+  soak-push <api-url> <token> [connections] | bench-load <api-url> <token> [requests] [concurrency]
+  bench-driver [concurrency] | bench-feed [users] | bench-likes [likes] | bench-login-storm [logins]
+  bench-ingest [megapixels]
+"""
+from fastapi.responses import JSONResponse, ORJSONResponse
+from fastapi import Request, UploadFile
+from fastapi.encoders import jsonable_encoder
+from starlette.datastructures import Headers
+from motor.motor_asyncio import AsyncIOMotorCollection
+from pymongo import MongoClient
+from pymongo.errors import BulkWriteError
+from datetime import datetime, timedelta, UTC
+import asyncio
+import base64
+import contextlib
+import multiprocessing
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+import httpx
+import bson
+import numpy as np
+import orjson
+import pandas as pd
+from PIL import Image
+
+import server
+from server import (
+    client, MONGO_URL, users_collection, meals_collection, posts_collection, recipes_collection, comments_collection,
+    likes_collection, follows_collection, daily_totals_collection, meal_phash_collection,
+    RecipeCreate, PostPage, NUTRIENT_FIELDS, NUTRITION_DB, POST_IMAGE_MAX_DIM, DEFAULT_RECIPE_PAGE_SIZE,
+    RECIPE_LIST_PROJECTION, REQUIRED_INDEXES, PHASH_MAX_DISTANCE, MultiIndexHash,
+    downscale_image, store_post_image, encode_cursor, paginate, daily_goals, compute_insights,
+    recipe_document, recipe_search_query, build_nutrition_db, nutrition_index, estimate_nutrition,
+    backfill_streaks, ensure_indexes, following_ids, get_feed, FANOUT_FOLLOWER_LIMIT,
+    POST_LIST_PROJECTION, set_like, hash_password, create_jwt_token, ANALYSIS_IMAGE_MAX_DIM, MAX_UPLOAD_BYTES,
+    ingest_image, process_rss, etag_response,
+)
+
+# Data migrations and rebuilds
+async def migrate_inline_post_images():
+    """Move base64 data URLs embedded in posts into the blob store"""
+    migrated = failed = 0
+    cursor = posts_collection.find(
+        {"image_url": {"$regex": "^data:"}},
+        {"_id": 0, "post_id": 1, "image_url": 1}
+    )
+    async for post in cursor:
+        try:
+            encoded = post['image_url'].split(',', 1)[1]
+            image_data = await asyncio.to_thread(
+                downscale_image, base64.b64decode(encoded), POST_IMAGE_MAX_DIM
+            )
+            urls = await store_post_image(image_data)
+            await posts_collection.update_one(
+                {"post_id": post['post_id']},
+                {"$set": {"image_url": urls['lg'], "image_thumbnails": {k: v for k, v in urls.items() if k != 'lg'}}}
+            )
+            migrated += 1
+        except Exception as e:
+            print(f"Could not migrate image for post {post['post_id']}: {e}")
+            failed += 1
+    print(f"Migrated {migrated} post images ({failed} failed)")
+    return migrated, failed
+
+async def migrate_follow_edges():
+    """Move users' followers/following arrays into follow edges and counters"""
+    migrated = 0
+    now = datetime.now(UTC)
+    cursor = users_collection.find(
+        {"following": {"$exists": True}},
+        {"_id": 0, "user_id": 1, "following": 1}
+    )
+    async for user in cursor:
+        edges = [
+            {"follower_id": user['user_id'], "followee_id": followee_id, "created_at": now, "fanout_on_read": False}
+            for followee_id in dict.fromkeys(user.get('following', []))
+        ]
+        if edges:
+            try:
+                await follows_collection.insert_many(edges, ordered=False)
+            except BulkWriteError as e:
+                # Duplicates were already copied by an earlier, interrupted run
+                if any(error['code'] != 11000 for error in e.details['writeErrors']):
+                    raise
+        migrated += 1
+
+    async for row in follows_collection.aggregate([{"$group": {"_id": "$follower_id", "count": {"$sum": 1}}}]):
+        await users_collection.update_one({"user_id": row['_id']}, {"$set": {"following_count": row['count']}})
+    async for row in follows_collection.aggregate([{"$group": {"_id": "$followee_id", "count": {"$sum": 1}}}]):
+        await users_collection.update_one({"user_id": row['_id']}, {"$set": {"followers_count": row['count']}})
+    async for user in users_collection.find({"fanout_on_read": True}, {"_id": 0, "user_id": 1}):
+        await follows_collection.update_many({"followee_id": user['user_id']}, {"$set": {"fanout_on_read": True}})
+
+    await users_collection.update_many(
+        {"$or": [{"followers": {"$exists": True}}, {"following": {"$exists": True}}]},
+        {"$unset": {"followers": "", "following": ""}}
+    )
+    print(f"Migrated follow edges for {migrated} users")
+    return migrated
+
+async def migrate_post_engagement():
+    """Move embedded likes/comments arrays out of posts into their own collections"""
+    migrated = 0
+    cursor = posts_collection.find(
+        {"$or": [{"likes": {"$exists": True}}, {"comments": {"$exists": True}}]},
+        {"_id": 0, "post_id": 1, "likes": 1, "comments": 1, "created_at": 1}
+    )
+    async for post in cursor:
+        likes = [
+            {"post_id": post['post_id'], "user_id": user_id, "created_at": post['created_at']}
+            for user_id in dict.fromkeys(post.get('likes', []))
+        ]
+        comments = [{**comment, "post_id": post['post_id']} for comment in post.get('comments', [])]
+        for collection, docs in ((likes_collection, likes), (comments_collection, comments)):
+            if docs:
+                try:
+                    await collection.insert_many(docs, ordered=False)
+                except BulkWriteError as e:
+                    # Duplicates were already copied by an earlier, interrupted run
+                    if any(error['code'] != 11000 for error in e.details['writeErrors']):
+                        raise
+        await posts_collection.update_one(
+            {"post_id": post['post_id']},
+            {"$set": {"like_count": len(likes), "comment_count": len(comments)},
+             "$unset": {"likes": "", "comments": ""}}
+        )
+        migrated += 1
+    
+    async for row in posts_collection.aggregate([{"$group": {"_id": "$user_id", "likes": {"$sum": "$like_count"}}}]):
+        await users_collection.update_one({"user_id": row['_id']}, {"$set": {"likes_received": row['likes']}})
+    print(f"Migrated engagement for {migrated} posts")
+    return migrated
+
+async def rebuild_daily_totals():
+    """Recompute every rollup from meals (for existing data or after manual edits)"""
+    rows = 0
+    pipeline = [{"$group": {
+        "_id": {"user_id": "$user_id", "date": "$date"},
+        "meals": {"$sum": 1},
+        **{field: {"$sum": {"$ifNull": [f"${field}", 0]}} for field in NUTRIENT_FIELDS}
+    }}]
+    async for row in meals_collection.aggregate(pipeline, allowDiskUse=True):
+        await daily_totals_collection.update_one(
+            row['_id'],
+            {"$set": {"meals": row['meals'], **{field: row[field] for field in NUTRIENT_FIELDS}}},
+            upsert=True
+        )
+        rows += 1
+    print(f"Rebuilt {rows} daily totals")
+    return rows
+
+async def migrate_meal_phashes():
+    """Drop the phash-only unique index and hashes stored before they were keyed by meal name"""
+    indexes = await meal_phash_collection.index_information()
+    if "phash_1" in indexes:
+        await meal_phash_collection.drop_index("phash_1")
+    result = await meal_phash_collection.delete_many({"name_key": {"$exists": False}})
+    await meal_phash_collection.create_indexes(REQUIRED_INDEXES[meal_phash_collection])
+    print(f"Removed {result.deleted_count} unkeyed photo hashes")
+    return result.deleted_count
+
+# Benchmarks. Database benchmarks use a scratch `eatflex_bench` database and drop it afterwards.
+async def use_bench_database():
+    """Create the declared indexes in a fresh `eatflex_bench` database and point the server
+    module's collections at it, so benchmarks run the real route code against scratch data"""
+    bench = client['eatflex_bench']
+    await client.drop_database(bench.name)
+    await ensure_indexes(bench)
+    for name, value in list(vars(server).items()):
+        if isinstance(value, AsyncIOMotorCollection):
+            setattr(server, name, bench[value.name])
+    return bench
+
+def latency_summary(timings_ms: list) -> str:
+    timings_ms = sorted(timings_ms)
+    return (f"p50 {timings_ms[len(timings_ms) // 2]:.1f} ms, "
+            f"p99 {timings_ms[min(int(len(timings_ms) * 0.99), len(timings_ms) - 1)]:.1f} ms")
+
+def benchmark_insights(meal_count: int = 50000, years: int = 5, runs: int = 20):
+    """Time compute_insights over the daily rollups of a generated multi-year history"""
+    rng = np.random.default_rng(0)
+    start = np.datetime64("2020-01-01")
+    offsets = np.sort(rng.integers(0, years * 365, meal_count))
+    docs = [
+        {"date": str(day), "calories": int(cal), "protein": float(p), "carbs": float(c), "fat": None if i % 50 == 0 else float(f)}
+        for i, (day, cal, p, c, f) in enumerate(zip(
+            start + offsets,
+            rng.normal(600, 150, meal_count),
+            rng.normal(35, 10, meal_count),
+            rng.normal(70, 20, meal_count),
+            rng.normal(20, 6, meal_count)
+        ))
+    ]
+    # The route reads daily rollups, i.e. these meals summed per day
+    rollups = {}
+    for doc in docs:
+        day = rollups.setdefault(doc['date'], {"date": doc['date'], "meals": 0, **dict.fromkeys(NUTRIENT_FIELDS, 0)})
+        day['meals'] += 1
+        for field in NUTRIENT_FIELDS:
+            day[field] += doc[field] or 0
+    rollups = list(rollups.values())
+    goals = daily_goals({})
+    # Warm-up: pandas imports parts of itself on first use
+    compute_insights(pd.DataFrame.from_records(rollups[:10]), goals)
+    
+    timings = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        frame = pd.DataFrame.from_records(rollups, columns=["date", "meals", *NUTRIENT_FIELDS])
+        compute_insights(frame, goals)
+        timings.append((time.perf_counter() - started) * 1000)
+    timings.sort()
+    print(f"{meal_count} meals over {years} years ({len(rollups)} daily rollups): median {timings[len(timings) // 2]:.1f} ms, "
+          f"max {timings[-1]:.1f} ms ({runs} runs, frame build + insights)")
+
+RECIPE_WORDS = {
+    "proteins": ["chicken", "beef", "salmon", "tofu", "egg", "turkey", "shrimp", "lentil", "pork", "tuna"],
+    "bases": ["rice", "quinoa", "pasta", "oats", "potato", "noodle", "bread", "couscous", "salad", "wrap"],
+    "styles": ["spicy", "grilled", "roasted", "creamy", "lemon", "garlic", "teriyaki", "curry", "pesto", "smoky"],
+}
+
+async def benchmark_recipe_search(count: int = 500000, samples: int = 200):
+    """Time mixed text + macro-range searches over generated recipes in a scratch database"""
+    collection = client['eatflex_bench']['recipes']
+    await collection.drop()
+    await collection.create_indexes(REQUIRED_INDEXES[recipes_collection])
+    rng = random.Random(0)
+    now = datetime.now(UTC)
+    
+    started = time.perf_counter()
+    for offset in range(0, count, 10000):
+        batch = []
+        for i in range(offset, min(offset + 10000, count)):
+            words = [rng.choice(RECIPE_WORDS[kind]) for kind in ("styles", "proteins", "bases")]
+            recipe = RecipeCreate(
+                name=" ".join(words),
+                ingredients=", ".join(words[1:] + rng.sample(RECIPE_WORDS["bases"], 2)),
+                instructions="Cook and serve.",
+                calories=rng.randint(200, 1600),
+                protein=round(rng.uniform(5, 90), 1),
+                carbs=round(rng.uniform(5, 160), 1),
+                fat=round(rng.uniform(2, 70), 1),
+                servings=rng.randint(1, 4)
+            )
+            batch.append({
+                "recipe_id": f"bench-{i}",
+                "user_id": f"bench-user-{i % 1000}",
+                **recipe_document(recipe),
+                "created_at": now - timedelta(seconds=i)
+            })
+        await collection.insert_many(batch, ordered=False)
+    print(f"Inserted {count} recipes in {time.perf_counter() - started:.1f}s")
+    
+    shapes = {
+        "text": lambda: recipe_search_query(rng.choice(RECIPE_WORDS["proteins"]), {}),
+        "text+text": lambda: recipe_search_query(
+            f"{rng.choice(RECIPE_WORDS['styles'])} {rng.choice(RECIPE_WORDS['proteins'])}", {}
+        ),
+        "range": lambda: recipe_search_query(None, {"calories": (100, rng.randint(150, 400)), "protein": (20, None)}),
+        "text+range": lambda: recipe_search_query(
+            rng.choice(RECIPE_WORDS["proteins"]), {"calories": (None, rng.randint(200, 600)), "protein": (25, None)}
+        ),
+    }
+    for name, make_query in shapes.items():
+        timings = []
+        for _ in range(samples):
+            query = make_query()
+            query_started = time.perf_counter()
+            await paginate(collection, query, "recipe_id", None, DEFAULT_RECIPE_PAGE_SIZE, RECIPE_LIST_PROJECTION)
+            timings.append((time.perf_counter() - query_started) * 1000)
+        timings.sort()
+        print(f"{name:>10}: p50 {timings[len(timings) // 2]:.1f} ms, p95 {timings[int(len(timings) * 0.95)]:.1f} ms")
+    await collection.drop()
+
+def benchmark_nutrition(runs: int = 10000):
+    """Time estimate_nutrition over typical free-text meal logs"""
+    build_nutrition_db()
+    nutrition_index.load(NUTRITION_DB)
+    samples = [
+        ("200g grilled chicken breast, 1 cup rice, broccoli", None),
+        ("2 large eggs and 2 slices whole wheat toast with butter", None),
+        ("greek yoghurt, blueberies, 1/2 cup granola, honey", None),
+        ("spagheti bolognese", "1 bowl"),
+        ("salmon fillet, sweet potatos, spinach salad with olive oil", "2 servings"),
+    ]
+    timings = []
+    for i in range(runs):
+        ingredients, quantity = samples[i % len(samples)]
+        started = time.perf_counter()
+        estimate_nutrition(ingredients, quantity)
+        timings.append((time.perf_counter() - started) * 1000)
+    timings.sort()
+    print(f"{len(nutrition_index.names)} food names: p50 {timings[len(timings) // 2]:.3f} ms, "
+          f"p99 {timings[int(len(timings) * 0.99)]:.3f} ms ({runs} estimates)")
+
+def benchmark_serialization(runs: int = 2000):
+    """Compare renderings of a 50-post /api/posts/discover payload"""
+    now = datetime.now(UTC).replace(tzinfo=None)
+    payload = {"posts": [{
+        "post_id": str(uuid.uuid4()),
+        "user_id": str(uuid.uuid4()),
+        "author_name": f"User {i}",
+        "content": "Just had grilled chicken with rice! " * 4,
+        "image_url": f"/api/images/posts/{i}/lg.jpg",
+        "image_thumbnails": {"md": f"/api/images/posts/{i}/md.jpg", "sm": f"/api/images/posts/{i}/sm.jpg"},
+        "meal_id": None,
+        "like_count": i * 3,
+        "comment_count": i,
+        "liked_by_me": i % 2 == 0,
+        "created_at": now - timedelta(minutes=i)
+    } for i in range(50)], "next_cursor": encode_cursor(now, "p")}
+    request = Request({"type": "http", "headers": []})
+    
+    renderers = {
+        "jsonable_encoder + json": lambda: JSONResponse(jsonable_encoder(payload)).body,
+        "response model + orjson": lambda: ORJSONResponse(PostPage.model_validate(payload).model_dump(mode="json")).body,
+        "orjson": lambda: orjson.dumps(payload),
+        # What /api/posts/discover does: validate into PostPage, render with pydantic-core, hash for the ETag
+        "discover (PostPage + ETag)": lambda: etag_response(request, PostPage.model_validate(payload)).body,
+    }
+    for name, render in renderers.items():
+        timings = []
+        for _ in range(runs):
+            started = time.perf_counter()
+            body = render()
+            timings.append((time.perf_counter() - started) * 1e6)
+        timings.sort()
+        print(f"{name:>26}: median {timings[len(timings) // 2]:.0f} us, p95 {timings[int(len(timings) * 0.95)]:.0f} us, {len(body)} bytes")
+
+def benchmark_phash(count: int = 100000, samples: int = 2000):
+    """Time near-duplicate lookups in MultiIndexHash against a linear Hamming scan"""
+    rng = random.Random(0)
+    hashes = [rng.getrandbits(64) for _ in range(count)]
+    started = time.perf_counter()
+    index = MultiIndexHash(PHASH_MAX_DISTANCE)
+    for value in hashes:
+        index.add(value, None)
+    print(f"Indexed {count} hashes in {time.perf_counter() - started:.2f}s")
+
+    def near_duplicate():
+        value = rng.choice(hashes)
+        for bit in rng.sample(range(64), rng.randint(1, PHASH_MAX_DISTANCE)):
+            value ^= 1 << bit
+        return value
+
+    def linear_scan(value):
+        return min(((candidate ^ value).bit_count(), candidate) for candidate in hashes)
+
+    shapes = {
+        "near-duplicate": (near_duplicate, True),
+        "miss": (lambda: rng.getrandbits(64), False),
+    }
+    for name, (make_query, expect_match) in shapes.items():
+        for method, lookup, runs in (("index", index.find, samples), ("linear", linear_scan, samples // 20)):
+            timings = []
+            for _ in range(runs):
+                value = make_query()
+                lookup_started = time.perf_counter()
+                lookup(value)
+                timings.append((time.perf_counter() - lookup_started) * 1000)
+            timings.sort()
+            print(f"{name:>14} {method:>6}: p50 {timings[len(timings) // 2]:.3f} ms, "
+                  f"p99 {timings[int(len(timings) * 0.99)]:.3f} ms ({runs} lookups)")
+        matched = sum(index.find(make_query()) is not None for _ in range(samples))
+        print(f"{name:>14} matched {matched}/{samples} (expected {samples if expect_match else 'about 0'})")
+
+async def benchmark_load(base_url: str, token: str, requests: int = 2000, concurrency: int = 100):
+    """Drive /api/posts/feed and /api/meals/today on a running server and report req/s and p99 for each.
+
+    Run it against a build from before the Motor data layer and against this one to compare.
+    """
+    async with httpx.AsyncClient(
+        base_url=base_url, timeout=60, limits=httpx.Limits(max_connections=concurrency)
+    ) as http:
+        headers = {"Authorization": f"Bearer {token}"}
+        for path in ("/api/posts/feed", "/api/meals/today"):
+            remaining = requests
+            timings, errors = [], 0
+
+            async def worker():
+                nonlocal remaining, errors
+                while remaining > 0:
+                    remaining -= 1
+                    request_started = time.perf_counter()
+                    response = await http.get(path, headers=headers)
+                    timings.append((time.perf_counter() - request_started) * 1000)
+                    errors += response.status_code != 200
+
+            started = time.perf_counter()
+            await asyncio.gather(*(worker() for _ in range(concurrency)))
+            elapsed = time.perf_counter() - started
+            print(f"{path:>18}: {requests / elapsed:.0f} req/s, {latency_summary(timings)} "
+                  f"({requests} requests, {concurrency} concurrent, {errors} errors)")
+
+async def benchmark_driver(concurrency: int = 200, posts: int = 2000):
+    """Run the feed and today queries concurrently through Motor and through blocking PyMongo
+    called from the event loop (how routes queried before Motor), reporting throughput, p99
+    and the longest event-loop stall"""
+    bench = client['eatflex_bench']
+    await bench.posts.drop()
+    await bench.meals.drop()
+    await bench.posts.create_indexes(REQUIRED_INDEXES[posts_collection])
+    await bench.meals.create_indexes(REQUIRED_INDEXES[meals_collection])
+    now = datetime.now(UTC)
+    today = now.strftime("%Y-%m-%d")
+    await bench.posts.insert_many([
+        {"post_id": f"bench-{i}", "user_id": f"bench-user-{i % 50}", "content": "Lunch! " * 20,
+         "like_count": i % 100, "comment_count": i % 10, "created_at": now - timedelta(seconds=i)}
+        for i in range(posts)
+    ])
+    await bench.meals.insert_many([
+        {"meal_id": f"bench-meal-{i}", "user_id": "bench-user-0", "name": "Oatmeal", "calories": 300,
+         "date": today, "created_at": now - timedelta(minutes=i)}
+        for i in range(20)
+    ])
+    feed_query = {"user_id": {"$in": [f"bench-user-{i}" for i in range(50)]}}
+    today_query = {"user_id": "bench-user-0", "date": today}
+
+    async def motor_request():
+        await bench.posts.find(feed_query, {"_id": 0}).sort("created_at", -1).limit(20).to_list(length=20)
+        await bench.meals.find(today_query, {"_id": 0}).to_list(length=100)
+
+    blocking = MongoClient(MONGO_URL)['eatflex_bench']
+
+    async def blocking_request():
+        list(blocking.posts.find(feed_query, {"_id": 0}).sort("created_at", -1).limit(20))
+        list(blocking.meals.find(today_query, {"_id": 0}))
+
+    for name, request in (("blocking pymongo", blocking_request), ("motor", motor_request)):
+        stall = 0.0
+        running = True
+
+        async def ticker():
+            # Sleeps 1 ms at a time; anything longer is time the loop couldn't serve other requests
+            nonlocal stall
+            while running:
+                tick = time.perf_counter()
+                await asyncio.sleep(0.001)
+                stall = max(stall, time.perf_counter() - tick - 0.001)
+
+        async def timed():
+            # Measured from when the burst arrived, as the clients waiting on it see it
+            await request()
+            return (time.perf_counter() - started) * 1000
+
+        monitor = asyncio.create_task(ticker())
+        await asyncio.sleep(0.01)
+        started = time.perf_counter()
+        timings = await asyncio.gather(*(timed() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+        running = False
+        await monitor
+        print(f"{name:>16}: {concurrency / elapsed:.0f} req/s, {latency_summary(timings)}, "
+              f"longest event-loop stall {stall * 1000:.1f} ms ({concurrency} concurrent feed + today requests)")
+    blocking.client.close()
+    await client.drop_database('eatflex_bench')
+
+async def benchmark_feed(user_count: int = 10000, samples: int = 1000, posts_per_user: int = 10):
+    """Compare home-feed latency on the materialized timeline against the fan-out-on-read
+    query it replaced, over a synthetic power-law follow graph"""
+    bench = await use_bench_database()
+    rng = np.random.default_rng(0)
+    now = datetime.now(UTC)
+    user_ids = [f"bench-user-{i}" for i in range(user_count)]
+    # Zipf-like author popularity, and a heavy-tailed number of follows per user
+    popularity = 1 / np.arange(1, user_count + 1) ** 0.9
+    popularity /= popularity.sum()
+    follow_counts = np.minimum(rng.pareto(1.2, user_count) * 10 + 1, 2000).astype(int)
+    edges = []
+    for follower, count in enumerate(follow_counts):
+        for followee in set(rng.choice(user_count, size=count, p=popularity)) - {follower}:
+            edges.append({"follower_id": user_ids[follower], "followee_id": user_ids[followee],
+                          "created_at": now, "fanout_on_read": False})
+    followers = np.bincount([int(edge['followee_id'].rsplit("-", 1)[1]) for edge in edges], minlength=user_count)
+    following = np.bincount([int(edge['follower_id'].rsplit("-", 1)[1]) for edge in edges], minlength=user_count)
+    celebrities = {user_ids[i] for i in np.flatnonzero(followers > FANOUT_FOLLOWER_LIMIT)}
+    for edge in edges:
+        edge['fanout_on_read'] = edge['followee_id'] in celebrities
+    for offset in range(0, len(edges), 50000):
+        await bench.follows.insert_many(edges[offset:offset + 50000], ordered=False)
+    await bench.users.insert_many([
+        {"user_id": user_id, "email": f"{user_id}@example.com", "name": user_id, "followers_count": int(followers[i]),
+         "following_count": int(following[i]), "fanout_on_read": user_id in celebrities}
+        for i, user_id in enumerate(user_ids)
+    ], ordered=False)
+    posts = [
+        {"post_id": f"bench-post-{i}-{n}", "user_id": user_id, "author_name": user_id, "content": "Lunch!",
+         "like_count": 0, "comment_count": 0,
+         "created_at": now - timedelta(minutes=int(rng.integers(0, 30 * 24 * 60)))}
+        for i, user_id in enumerate(user_ids) for n in range(posts_per_user)
+    ]
+    for offset in range(0, len(posts), 50000):
+        await bench.posts.insert_many(posts[offset:offset + 50000], ordered=False)
+    print(f"{user_count} users, {len(edges)} follows (max {followers.max()} followers, "
+          f"{len(celebrities)} fan-out-on-read accounts), {len(posts)} posts")
+
+    sampled = [user_ids[i] for i in rng.choice(user_count, size=min(samples, user_count), replace=False)]
+    # First reads build each sampled timeline; the timed reads below are the steady state
+    for user_id in sampled:
+        await get_feed(current_user={"user_id": user_id})
+
+    async def fan_out_on_read(user_id):
+        ids = await following_ids(user_id) + [user_id]
+        posts, _ = await paginate(server.posts_collection, {"user_id": {"$in": ids}}, "post_id", None, 20, POST_LIST_PROJECTION)
+        await server.annotate_liked_by_me(posts, user_id)
+
+    async def timeline(user_id):
+        await get_feed(current_user={"user_id": user_id})
+
+    for name, read in (("fan-out-on-read", fan_out_on_read), ("timeline", timeline)):
+        by_follows = {}
+        for user_id in sampled:
+            started = time.perf_counter()
+            await read(user_id)
+            elapsed = (time.perf_counter() - started) * 1000
+            count = int(following[int(user_id.rsplit("-", 1)[1])])
+            bucket = "<10" if count < 10 else "10-99" if count < 100 else "100+"
+            by_follows.setdefault("all", []).append(elapsed)
+            by_follows.setdefault(bucket, []).append(elapsed)
+        for bucket in ("all", "<10", "10-99", "100+"):
+            if bucket in by_follows:
+                print(f"{name:>15} {bucket:>5} follows: {latency_summary(by_follows[bucket])} "
+                      f"({len(by_follows[bucket])} users)")
+    await client.drop_database(bench.name)
+
+async def benchmark_hot_post(like_count: int = 50000, samples: int = 500):
+    """Time feed reads and like toggles on a post with like_count likes, against the same
+    post with likes embedded as an array the way posts stored them before"""
+    bench = await use_bench_database()
+    now = datetime.now(UTC)
+    likers = [f"bench-user-{i}" for i in range(like_count)]
+    posts = [{"post_id": f"bench-post-{i}", "user_id": "bench-author", "author_name": "Author", "content": "Lunch!",
+              "like_count": 0, "comment_count": 0, "created_at": now - timedelta(minutes=i)} for i in range(20)]
+    posts[0]['like_count'] = like_count
+    await bench.posts.insert_many(posts)
+    for offset in range(0, like_count, 50000):
+        await bench.likes.insert_many([
+            {"post_id": "bench-post-0", "user_id": user_id, "created_at": now, "active": True}
+            for user_id in likers[offset:offset + 50000]
+        ], ordered=False)
+    legacy = [dict(post, likes=likers if i == 0 else [], comments=[]) for i, post in enumerate(posts)]
+    await bench.legacy_posts.insert_many(legacy)
+    await bench.legacy_posts.create_index([("created_at", -1)])
+    new_size, legacy_size = len(bson.encode(posts[0])), len(bson.encode(legacy[0]))
+    print(f"Hot post document: {new_size} bytes with a like_count, {legacy_size / 1024:.0f} KiB with embedded likes")
+
+    rng = random.Random(0)
+    viewers = [rng.choice(likers) if i % 2 else f"viewer-{i}" for i in range(samples)]
+
+    async def page_read(viewer):
+        page, _ = await paginate(server.posts_collection, {}, "post_id", None, 20, POST_LIST_PROJECTION)
+        await server.annotate_liked_by_me(page, viewer)
+
+    async def legacy_page_read(viewer):
+        page = await bench.legacy_posts.find({}, {"_id": 0}).sort("created_at", -1).limit(20).to_list(length=20)
+        for post in page:
+            post['liked_by_me'] = viewer in post['likes']
+
+    async def toggle(viewer):
+        await set_like("bench-post-0", viewer, None)
+
+    async def legacy_toggle(viewer):
+        # What like_post did: read the post to decide, then push or pull on the embedded array
+        post = await bench.legacy_posts.find_one({"post_id": "bench-post-0"})
+        operator = "$pull" if viewer in post['likes'] else "$addToSet"
+        await bench.legacy_posts.update_one({"post_id": "bench-post-0"}, {operator: {"likes": viewer}})
+
+    for name, operation in (
+        ("feed page, embedded likes", legacy_page_read), ("feed page, like edges", page_read),
+        ("like toggle, embedded likes", legacy_toggle), ("like toggle, like edges", toggle),
+    ):
+        timings = []
+        for viewer in viewers:
+            started = time.perf_counter()
+            await operation(viewer)
+            timings.append((time.perf_counter() - started) * 1000)
+        print(f"{name:>27}: {latency_summary(timings)} ({samples} operations)")
+    await client.drop_database(bench.name)
+
+class InlineExecutor:
+    """Runs password checks on the event loop, as login did before the bcrypt pool"""
+
+    async def run(self, fn, *args):
+        return fn(*args)
+
+async def benchmark_login_storm(logins: int = 100, interval: float = 0.01):
+    """Probe non-auth endpoints while a burst of logins runs, with bcrypt on the event loop
+    and on the bounded pool, and report probe latency against an idle baseline"""
+    bench = await use_bench_database()
+    password = "storm-password"
+    hashed = hash_password(password)
+    await bench.users.insert_many([
+        {"user_id": f"storm-user-{i}", "email": f"storm-{i}@example.com", "password": hashed,
+         "name": f"Storm {i}", "goal": "maintenance"}
+        for i in range(logins)
+    ])
+    headers = {"Authorization": f"Bearer {create_jwt_token('storm-user-0')}"}
+    pool = server.password_executor
+
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=server.app), base_url="http://bench") as http:
+        async def probe(until):
+            timings = {"/api/health": [], "/api/meals/today": []}
+            while True:
+                due = time.perf_counter() + interval
+                await asyncio.sleep(interval)
+                for path, path_timings in timings.items():
+                    await http.get(path, headers=headers)
+                    # Measured from when the probe was due, so time the loop was blocked before sending counts
+                    now = time.perf_counter()
+                    path_timings.append((now - due) * 1000)
+                    due = now
+                if until(len(timings["/api/health"])):
+                    return timings
+
+        async def login(i):
+            response = await http.post("/api/auth/login", json={"email": f"storm-{i}@example.com", "password": password})
+            return response.status_code
+
+        idle = await probe(lambda rounds: rounds >= 50)
+        for path, timings in idle.items():
+            print(f"{'idle':>24} {path:>17}: {latency_summary(timings)}")
+
+        for name, executor in (("storm, bcrypt on loop", InlineExecutor()), ("storm, bcrypt pool", pool)):
+            server.password_executor = executor
+            started = time.perf_counter()
+            storm = asyncio.gather(*(login(i) for i in range(logins)))
+            timings = await probe(lambda rounds: storm.done())
+            statuses = await storm
+            elapsed = time.perf_counter() - started
+            for path, path_timings in timings.items():
+                print(f"{name:>24} {path:>17}: {latency_summary(path_timings)} ({len(path_timings)} probes)")
+            print(f"{name:>24} {'logins':>17}: {statuses.count(200)} ok, {statuses.count(503)} shed with 503 "
+                  f"in {elapsed:.1f}s ({logins} concurrent)")
+    server.password_executor = pool
+    await client.drop_database(bench.name)
+
+async def ingest_whole_upload(file: UploadFile) -> str:
+    """How uploads were handled before streaming ingest: whole read, base64, then a data URL"""
+    data = await file.read()
+    encoded = base64.b64encode(data).decode('utf-8')
+    return f"data:{file.content_type};base64,{encoded}"
+
+async def ingest_for_analysis(file: UploadFile) -> str:
+    return base64.b64encode(await ingest_image(file, ANALYSIS_IMAGE_MAX_DIM)).decode('utf-8')
+
+async def ingest_for_post(file: UploadFile) -> bytes:
+    return await ingest_image(file, POST_IMAGE_MAX_DIM)
+
+INGEST_VARIANTS = {
+    "whole read + data URL (before)": ingest_whole_upload,
+    "streamed, analysis size": ingest_for_analysis,
+    "streamed, post size": ingest_for_post,
+}
+
+def measure_ingest_peak(variant: str, path: str, results):
+    """Runs in a fresh process: RSS growth at the peak of one upload through an ingest variant"""
+    with open(path, 'rb') as f:
+        upload = UploadFile(f, size=os.path.getsize(path), headers=Headers({"content-type": "image/jpeg"}))
+        # Linux: reset the high-water mark so only this request's peak is measured
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+        baseline = process_rss()
+        asyncio.run(INGEST_VARIANTS[variant](upload))
+    with open('/proc/self/status') as status:
+        peak = next(int(line.split()[1]) * 1024 for line in status if line.startswith('VmHWM:'))
+    results.put(peak - baseline)
+
+def benchmark_ingest(megapixels: int = 12, runs: int = 3):
+    """Report peak RSS per upload for each ingest variant on a generated phone-size photo"""
+    width = int((megapixels * 1e6 * 4 / 3) ** 0.5)
+    height = width * 3 // 4
+    rng = np.random.default_rng(0)
+    # A gradient with heavy sensor-like noise: about as large as a full-quality 12 MP phone photo
+    gradient = np.linspace(0, 200, width, dtype=np.float32)[None, :, None] + np.linspace(0, 55, height, dtype=np.float32)[:, None, None]
+    pixels = np.clip(gradient + rng.normal(0, 24, (height, width, 3)), 0, 255).astype(np.uint8)
+    with tempfile.NamedTemporaryFile(suffix=".jpg", delete=False) as f:
+        Image.fromarray(pixels).save(f, 'JPEG', quality=98)
+        path = f.name
+    size = os.path.getsize(path)
+    print(f"{width}x{height} JPEG, {size / 1024 / 1024:.1f} MB (limit {MAX_UPLOAD_BYTES / 1024 / 1024:.0f} MB)")
+
+    context = multiprocessing.get_context("spawn")
+    try:
+        for variant in INGEST_VARIANTS:
+            peaks = []
+            for _ in range(runs):
+                results = context.Queue()
+                process = context.Process(target=measure_ingest_peak, args=(variant, path, results))
+                process.start()
+                peaks.append(results.get())
+                process.join()
+            print(f"{variant:>30}: peak RSS +{statistics.median(peaks) / 1024 / 1024:.1f} MB per request "
+                  f"({statistics.median(peaks) / size:.1f}x the upload, median of {runs})")
+    finally:
+        os.remove(path)
+
+async def soak_push(base_url: str, token: str, connections: int = 2000, hold: float = 10):
+    """Open many idle SSE connections against a running single-worker server and report memory per connection"""
+    async with httpx.AsyncClient(
+        base_url=base_url, timeout=None, limits=httpx.Limits(max_connections=connections + 1)
+    ) as http:
+        headers = {"Authorization": f"Bearer {token}"}
+        before = (await http.get("/api/metrics/push", headers=headers)).json()
+        async with contextlib.AsyncExitStack() as stack:
+            started = time.perf_counter()
+            for _ in range(connections):
+                # Push tokens are short-lived, so each connection gets a fresh one
+                push_token = (await http.post("/api/events/token", headers=headers)).json()['token']
+                await stack.enter_async_context(http.stream("GET", "/api/events", params={"token": push_token}))
+            print(f"Opened {connections} connections in {time.perf_counter() - started:.1f}s")
+            await asyncio.sleep(hold)
+            after = (await http.get("/api/metrics/push", headers=headers)).json()
+    
+    opened = after['connections'] - before['connections']
+    if opened and before['rss_bytes'] and after['rss_bytes']:
+        per_connection = (after['rss_bytes'] - before['rss_bytes']) / opened
+        print(f"{opened} idle connections: {per_connection / 1024:.1f} KiB RSS per connection "
+              f"({(after['rss_bytes'] - before['rss_bytes']) / 1024 / 1024:.1f} MiB total)")
+    else:
+        print(f"{opened} idle connections; server RSS unavailable")
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["migrate-images"]:
+        asyncio.run(migrate_inline_post_images())
+    elif sys.argv[1:] == ["migrate-engagement"]:
+        asyncio.run(migrate_post_engagement())
+    elif sys.argv[1:] == ["migrate-follows"]:
+        asyncio.run(migrate_follow_edges())
+    elif sys.argv[1:] == ["migrate-phashes"]:
+        asyncio.run(migrate_meal_phashes())
+    elif sys.argv[1:] == ["rebuild-rollups"]:
+        asyncio.run(rebuild_daily_totals())
+    elif sys.argv[1:] == ["backfill-streaks"]:
+        asyncio.run(backfill_streaks())
+    elif sys.argv[1:] == ["build-foods"]:
+        print(f"Built {build_nutrition_db()} foods into {NUTRITION_DB}")
+    elif sys.argv[1:] == ["check-indexes"]:
+        # The route query samples live with the test, next to the routes' other tests
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        sys.exit(subprocess.run(
+            [sys.executable, "-m", "pytest", "-q", os.path.join("tests", "test_indexes.py")],
+            cwd=root, env={**os.environ, "MONGO_URL": MONGO_URL}
+        ).returncode)
+    elif sys.argv[1:2] == ["bench-insights"]:
+        benchmark_insights(*map(int, sys.argv[2:3]))
+    elif sys.argv[1:2] == ["bench-recipes"]:
+        asyncio.run(benchmark_recipe_search(*map(int, sys.argv[2:3])))
+    elif sys.argv[1:2] == ["bench-nutrition"]:
+        benchmark_nutrition(*map(int, sys.argv[2:3]))
+    elif sys.argv[1:2] == ["bench-serialization"]:
+        benchmark_serialization(*map(int, sys.argv[2:3]))
+    elif sys.argv[1:2] == ["bench-phash"]:
+        benchmark_phash(*map(int, sys.argv[2:3]))
+    elif sys.argv[1:2] == ["bench-load"] and len(sys.argv) >= 4:
+        asyncio.run(benchmark_load(sys.argv[2], sys.argv[3], *map(int, sys.argv[4:6])))
+    elif sys.argv[1:2] == ["bench-driver"]:
+        asyncio.run(benchmark_driver(*map(int, sys.argv[2:3])))
+    elif sys.argv[1:2] == ["bench-feed"]:
+        asyncio.run(benchmark_feed(*map(int, sys.argv[2:3])))
+    elif sys.argv[1:2] == ["bench-likes"]:
+        asyncio.run(benchmark_hot_post(*map(int, sys.argv[2:3])))
+    elif sys.argv[1:2] == ["bench-login-storm"]:
+        asyncio.run(benchmark_login_storm(*map(int, sys.argv[2:3])))
+    elif sys.argv[1:2] == ["bench-ingest"]:
+        benchmark_ingest(*map(int, sys.argv[2:3]))
+    elif sys.argv[1:2] == ["soak-push"] and len(sys.argv) >= 4:
+        asyncio.run(soak_push(sys.argv[2], sys.argv[3], *map(int, sys.argv[4:5])))
+    else:
+        print(__doc__, file=sys.stderr)
+        sys.exit(2)
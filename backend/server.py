@@ -1,20 +1,42 @@
-from fastapi import FastAPI, HTTPException, UploadFile, File, Depends, status
+from fastapi import FastAPI, HTTPException, UploadFile, File, Depends, Query, Request, WebSocket, WebSocketDisconnect, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
-from pymongo import MongoClient
+from fastapi.responses import ORJSONResponse, StreamingResponse, Response
+from fastapi.encoders import jsonable_encoder
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import IndexModel, UpdateOne, CursorType, ReturnDocument, ASCENDING, DESCENDING, TEXT
+from pymongo.errors import DuplicateKeyError, BulkWriteError, CollectionInvalid
 from pydantic import BaseModel
-from datetime import datetime, timedelta, UTC
+from datetime import date, datetime, timedelta, UTC
 import os
 import uuid
 import jwt
 import bcrypt
 import base64
-import requests
-from typing import Optional, List
+import httpx
+import asyncio
+import random
+import hashlib
+import time
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO, StringIO
+from PIL import Image, ImageOps
+import numpy as np
+import orjson
+import pandas as pd
+from typing import Optional, List, Dict
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 import json
+import re
+import csv
+import codecs
+import sqlite3
+import math
 
-app = FastAPI()
+# orjson renders every response; list routes declare response models so FastAPI
+# serializes them with pydantic-core instead of walking them with jsonable_encoder
+app = FastAPI(default_response_class=ORJSONResponse)
 
 # CORS configuration
 allowed_origins = [
@@ -32,9 +54,18 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# MongoDB connection
+# MongoDB connection (Motor keeps every query off the event loop)
 MONGO_URL = os.environ.get('MONGO_URL', 'mongodb://localhost:27017/')
-client = MongoClient(MONGO_URL)
+MONGO_MAX_POOL_SIZE = int(os.environ.get('MONGO_MAX_POOL_SIZE', 100))
+MONGO_MIN_POOL_SIZE = int(os.environ.get('MONGO_MIN_POOL_SIZE', 0))
+MONGO_TIMEOUT_MS = int(os.environ.get('MONGO_TIMEOUT_MS', 5000))
+client = AsyncIOMotorClient(
+    MONGO_URL,
+    maxPoolSize=MONGO_MAX_POOL_SIZE,
+    minPoolSize=MONGO_MIN_POOL_SIZE,
+    timeoutMS=MONGO_TIMEOUT_MS,
+    serverSelectionTimeoutMS=MONGO_TIMEOUT_MS,
+)
 db = client['eatflex']
 
 # Collections
@@ -43,13 +74,50 @@ meals_collection = db['meals']
 posts_collection = db['posts']
 recipes_collection = db['recipes']
 streaks_collection = db['streaks']
+analysis_cache_collection = db['analysis_cache']
+analysis_cache_stats_collection = db['analysis_cache_stats']
+meal_phash_collection = db['meal_phashes']
+analysis_jobs_collection = db['analysis_jobs']
+timelines_collection = db['timelines']
+comments_collection = db['comments']
+likes_collection = db['likes']
+follows_collection = db['follows']
+daily_totals_collection = db['daily_totals']
+daily_stats_collection = db['daily_stats']
+push_events_collection = db['push_events']
+
+@app.on_event("startup")
+async def connect_to_mongo():
+    """Warm up the Motor connection pool before the first request"""
+    try:
+        await client.admin.command('ping')
+    except Exception as e:
+        print(f"MongoDB startup ping failed: {e}")
+
+async def close_mongo_connection():
+    client.close()
 
 # JWT Secret
 JWT_SECRET = os.environ.get('JWT_SECRET', 'eatflex-secret-key')
 
 # OpenRouter API configuration
 OPENROUTER_API_KEY = os.environ.get('OPENROUTER_API_KEY')
-OPENROUTER_BASE_URL = "https://openrouter.ai/api/v1"
+OPENROUTER_BASE_URL = os.environ.get('OPENROUTER_BASE_URL', "https://openrouter.ai/api/v1")
+OPENROUTER_CONNECT_TIMEOUT = float(os.environ.get('OPENROUTER_CONNECT_TIMEOUT', 5))
+OPENROUTER_READ_TIMEOUT = float(os.environ.get('OPENROUTER_READ_TIMEOUT', 30))
+OPENROUTER_MAX_RETRIES = int(os.environ.get('OPENROUTER_MAX_RETRIES', 2))
+AI_MAX_CONCURRENCY = int(os.environ.get('AI_MAX_CONCURRENCY', 8))
+
+# Shared HTTP client so OpenRouter calls reuse pooled keep-alive connections
+openrouter_client = httpx.AsyncClient(
+    base_url=OPENROUTER_BASE_URL,
+    timeout=httpx.Timeout(OPENROUTER_READ_TIMEOUT, connect=OPENROUTER_CONNECT_TIMEOUT),
+    limits=httpx.Limits(max_connections=AI_MAX_CONCURRENCY, max_keepalive_connections=AI_MAX_CONCURRENCY),
+)
+ai_semaphore = asyncio.Semaphore(AI_MAX_CONCURRENCY)
+
+async def close_openrouter_client():
+    await openrouter_client.aclose()
 
 security = HTTPBearer()
 
@@ -59,6 +127,7 @@ class UserSignup(BaseModel):
     password: str
     name: str
     goal: str = "maintenance"  # bulking, cutting, maintenance
+    timezone: Optional[str] = None  # IANA name, e.g. "Europe/Berlin"; day boundaries for meals and streaks
 
 class UserLogin(BaseModel):
     email: str
@@ -73,9 +142,19 @@ class MealLog(BaseModel):
     carbs: Optional[float] = None
     fat: Optional[float] = None
 
+class MealImport(MealLog):
+    meal_id: Optional[str] = None  # kept from an export, so re-importing it is a no-op
+    date: str  # YYYY-MM-DD
+    created_at: Optional[datetime] = None
+    calories: Optional[float] = None
+
+class NutritionEstimate(BaseModel):
+    ingredients: str
+    quantity: Optional[str] = None
+
 class PostCreate(BaseModel):
     content: str
-    image_url: Optional[str] = None
+    image_url: Optional[str] = None  # from /api/posts/temp/upload-image; data: URLs are rejected
     meal_id: Optional[str] = None
 
 class RecipeCreate(BaseModel):
@@ -95,6 +174,7 @@ class ProfileUpdate(BaseModel):
     daily_protein_goal: Optional[int] = None
     daily_carbs_goal: Optional[int] = None
     daily_fat_goal: Optional[int] = None
+    timezone: Optional[str] = None
     bio: Optional[str] = None
 
 class CommentCreate(BaseModel):
@@ -106,254 +186,2359 @@ class PostUpdate(BaseModel):
 class CommentUpdate(BaseModel):
     content: str
 
+# Response models: the fields clients render. List queries project exactly these.
+class PostOut(BaseModel):
+    post_id: str
+    user_id: str
+    author_name: str
+    content: str
+    image_url: Optional[str] = None
+    image_thumbnails: Optional[Dict[str, str]] = None
+    meal_id: Optional[str] = None
+    like_count: int = 0
+    comment_count: int = 0
+    liked_by_me: bool = False
+    created_at: datetime
+    updated_at: Optional[datetime] = None
+
+class PostPage(BaseModel):
+    posts: List[PostOut]
+    next_cursor: Optional[str] = None
+
+class MealOut(BaseModel):
+    meal_id: str
+    name: str
+    ingredients: Optional[str] = None
+    quantity: Optional[str] = None
+    calories: Optional[float] = None
+    protein: Optional[float] = None
+    carbs: Optional[float] = None
+    fat: Optional[float] = None
+    analyzed_by_ai: bool = False
+    estimated: bool = False
+    fallback: bool = False
+    date: str
+    created_at: datetime
+
+class MealPage(BaseModel):
+    meals: List[MealOut]
+    next_cursor: Optional[str] = None
+
+class CommentOut(BaseModel):
+    comment_id: str
+    post_id: str
+    user_id: str
+    author_name: str
+    content: str
+    created_at: datetime
+    updated_at: Optional[datetime] = None
+
+class CommentPage(BaseModel):
+    comments: List[CommentOut]
+    next_cursor: Optional[str] = None
+
+def list_projection(model) -> dict:
+    return {"_id": 0, **{field: 1 for field in model.model_fields}}
+
 # Helper functions
 def hash_password(password: str) -> str:
     return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
 
-def verify_password(password: str, hashed: str) -> bool:
-    return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
+def verify_password(password: str, hashed: str) -> bool:
+    return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
+
+# bcrypt releases the GIL, so a small thread pool keeps hashing off the event loop
+PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS', os.cpu_count() or 2))
+PASSWORD_HASH_QUEUE_MAX = int(os.environ.get('PASSWORD_HASH_QUEUE_MAX', 32))
+
+class BoundedExecutor:
+    """Thread pool that sheds load with 503 once workers and queue are full"""
+
+    def __init__(self, workers: int, queue_max: int):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="bcrypt")
+        self.capacity = workers + queue_max
+        self.pending = 0
+
+    async def run(self, fn, *args):
+        if self.pending >= self.capacity:
+            raise HTTPException(
+                status_code=503,
+                detail="Authentication is busy, please retry shortly",
+                headers={"Retry-After": "1"}
+            )
+        self.pending += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+        finally:
+            self.pending -= 1
+
+password_executor = BoundedExecutor(PASSWORD_HASH_WORKERS, PASSWORD_HASH_QUEUE_MAX)
+
+async def stop_password_executor():
+    password_executor.executor.shutdown(wait=False)
+
+def create_jwt_token(user_id: str) -> str:
+    payload = {
+        'user_id': user_id,
+        'exp': datetime.now(UTC) + timedelta(days=7)
+    }
+    return jwt.encode(payload, JWT_SECRET, algorithm='HS256')
+
+def verify_jwt_token(token: str, scope: str = None) -> str:
+    """Return the token's user_id; session tokens carry no scope and push tokens have scope push"""
+    try:
+        payload = jwt.decode(token, JWT_SECRET, algorithms=['HS256'])
+    except jwt.PyJWTError:
+        raise HTTPException(status_code=401, detail="Invalid token")
+    if payload.get('scope') != scope or 'user_id' not in payload:
+        raise HTTPException(status_code=401, detail="Invalid token")
+    return payload['user_id']
+
+# WebSocket/EventSource connections carry their token in the URL, where proxies and
+# access logs record it, so they take a short-lived push-only token instead of the session JWT
+PUSH_TOKEN_TTL = int(os.environ.get('PUSH_TOKEN_TTL', 60))
+
+def create_push_token(user_id: str) -> str:
+    payload = {
+        'user_id': user_id,
+        'scope': 'push',
+        'exp': datetime.now(UTC) + timedelta(seconds=PUSH_TOKEN_TTL)
+    }
+    return jwt.encode(payload, JWT_SECRET, algorithm='HS256')
+
+class TTLCache:
+    """In-process LRU cache with per-entry expiry and hit/miss counters"""
+
+    def __init__(self, ttl: float, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry and entry[0] > time.monotonic():
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+        self.entries.pop(key, None)
+        self.misses += 1
+        return None
+
+    def set(self, key, value):
+        self.entries[key] = (time.monotonic() + self.ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, *keys):
+        for key in keys:
+            self.entries.pop(key, None)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0
+        }
+
+class ResponseCache(TTLCache):
+    """TTLCache whose misses are coalesced, so concurrent requests for a key share one load"""
+
+    def __init__(self, ttl: float, max_entries: int):
+        super().__init__(ttl, max_entries)
+        self.loading = {}
+        self.generation = 0
+
+    async def get_or_load(self, key, load):
+        value = self.get(key)
+        if value is not None:
+            return value
+        future = self.loading.get(key)
+        if future is None:
+            # The generation is taken now, not when the task first runs, so an
+            # invalidation between scheduling and start still discards the result
+            future = self.loading[key] = asyncio.ensure_future(self._load(key, load, self.generation))
+        # A disconnecting client must not cancel the load other requests are waiting on
+        return await asyncio.shield(future)
+
+    async def _load(self, key, load, generation):
+        try:
+            value = await load()
+            # Don't store a result that an invalidation raced past
+            if generation == self.generation:
+                self.set(key, value)
+            return value
+        finally:
+            if self.loading.get(key) is asyncio.current_task():
+                del self.loading[key]
+
+    def invalidate(self, *keys):
+        self.generation += 1
+        super().invalidate(*keys)
+        for key in keys:
+            self.loading.pop(key, None)
+
+    def clear(self):
+        self.generation += 1
+        self.entries.clear()
+        self.loading.clear()
+
+# Authenticated principals are cached briefly so most requests skip the users lookup.
+# The cache is per worker, with no shared tier: writes to a user's document invalidate
+# it on the worker that made them, and other workers may serve the old principal for
+# up to USER_CACHE_TTL seconds.
+USER_CACHE_TTL = float(os.environ.get('USER_CACHE_TTL', 30))
+USER_CACHE_MAX_ENTRIES = int(os.environ.get('USER_CACHE_MAX_ENTRIES', 10000))
+USER_PRINCIPAL_PROJECTION = {"_id": 0, "password": 0, "followers": 0, "following": 0}
+# A ResponseCache, so a principal read before a counter flush or profile write is not
+# stored after that write has invalidated it
+user_cache = ResponseCache(USER_CACHE_TTL, USER_CACHE_MAX_ENTRIES)
+
+async def load_principal(token: str, scope: str = None) -> dict:
+    user_id = verify_jwt_token(token, scope)
+
+    async def load():
+        user = await users_collection.find_one({"user_id": user_id}, USER_PRINCIPAL_PROJECTION)
+        if not user:
+            raise HTTPException(status_code=401, detail="User not found")
+        return user
+
+    user = await user_cache.get_or_load(user_id, load)
+    # Routes get their own copy so nothing can mutate the cached principal
+    return dict(user)
+
+async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    return await load_principal(credentials.credentials)
+
+def validate_timezone(name: str) -> str:
+    try:
+        ZoneInfo(name)
+    except (ZoneInfoNotFoundError, ValueError):
+        raise HTTPException(status_code=400, detail=f"Unknown timezone: {name}")
+    return name
+
+def local_today(user: dict) -> str:
+    """Today's date in the user's own timezone; meals and streaks roll over at their midnight"""
+    try:
+        tz = ZoneInfo(user.get('timezone') or "UTC")
+    except (ZoneInfoNotFoundError, ValueError):
+        tz = UTC
+    return datetime.now(tz).date().isoformat()
+
+async def post_to_openrouter(payload: dict, headers: dict) -> httpx.Response:
+    """POST a chat completion, retrying transient failures with jittered backoff"""
+    for attempt in range(OPENROUTER_MAX_RETRIES + 1):
+        try:
+            async with ai_semaphore:
+                response = await openrouter_client.post("/chat/completions", headers=headers, json=payload)
+            if response.status_code != 429 and response.status_code < 500:
+                return response
+        except httpx.TransportError:
+            if attempt == OPENROUTER_MAX_RETRIES:
+                raise
+        else:
+            if attempt == OPENROUTER_MAX_RETRIES:
+                return response
+        await asyncio.sleep(random.uniform(0, 0.5 * 2 ** attempt))
+
+# Placeholder macros returned when the model can't be reached or its reply can't be
+# parsed. They are flagged "fallback" so callers never cache or reuse them as an analysis.
+FALLBACK_INGREDIENTS = "Could not analyze ingredients"
+JSON_CODE_FENCE = re.compile(r"^\s*```(?:json)?\s*(.*?)\s*```\s*$", re.DOTALL | re.IGNORECASE)
+
+def fallback_analysis(meal_name: str = None, confidence: int = 1) -> dict:
+    return {
+        "name": meal_name or "Unknown meal",
+        "calories": 400,
+        "protein": 20.0,
+        "carbs": 30.0,
+        "fat": 15.0,
+        "ingredients": FALLBACK_INGREDIENTS,
+        "confidence": confidence,
+        "fallback": True
+    }
+
+def parse_analysis_content(content: str) -> dict:
+    """Parse the model's JSON reply, which often arrives wrapped in a ```json fence"""
+    fenced = JSON_CODE_FENCE.match(content)
+    meal_data = json.loads(fenced.group(1) if fenced else content)
+    if not isinstance(meal_data, dict):
+        raise ValueError("Analysis is not a JSON object")
+    meal_data.pop("fallback", None)
+    return meal_data
+
+async def analyze_meal_with_ai(image_data: str, meal_name: str = None) -> dict:
+    """Analyze meal using OpenRouter GPT-4o vision"""
+    try:
+        headers = {
+            "Authorization": f"Bearer {OPENROUTER_API_KEY}",
+            "Content-Type": "application/json"
+        }
+        
+        prompt = f"""Analyze this meal image and provide detailed nutritional information. 
+        {'The user says this is: ' + meal_name if meal_name else ''}
+        
+        Please provide:
+        1. Meal name/description
+        2. Estimated calories
+        3. Protein (grams)
+        4. Carbohydrates (grams)
+        5. Fat (grams)
+        6. Brief ingredient list
+        7. Confidence level (1-10)
+        
+        Return as JSON format:
+        {{
+            "name": "meal name",
+            "calories": 500,
+            "protein": 25.5,
+            "carbs": 45.2,
+            "fat": 18.3,
+            "ingredients": "chicken breast, rice, vegetables",
+            "confidence": 8
+        }}"""
+        
+        payload = {
+            "model": "openai/gpt-4o",
+            "messages": [
+                {
+                    "role": "user",
+                    "content": [
+                        {"type": "text", "text": prompt},
+                        {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{image_data}"}}
+                    ]
+                }
+            ],
+            "max_tokens": 500,
+            "temperature": 0.3
+        }
+        
+        response = await post_to_openrouter(payload, headers)
+        
+        if response.status_code == 200:
+            result = response.json()
+            content = result['choices'][0]['message']['content']
+            
+            try:
+                return parse_analysis_content(content)
+            except ValueError as e:
+                print(f"AI Analysis unparseable reply: {e}")
+                return fallback_analysis(meal_name, confidence=5)
+        else:
+            raise Exception(f"API call failed: {response.status_code}")
+            
+    except Exception as e:
+        print(f"AI Analysis error: {e}")
+        return fallback_analysis(meal_name)
+
+# Image ingest: bounded chunked reads and downscaling before analysis or storage
+MAX_UPLOAD_BYTES = int(os.environ.get('MAX_UPLOAD_BYTES', 15 * 1024 * 1024))
+UPLOAD_CHUNK_SIZE = 256 * 1024
+ANALYSIS_IMAGE_MAX_DIM = int(os.environ.get('ANALYSIS_IMAGE_MAX_DIM', 1024))
+POST_IMAGE_MAX_DIM = int(os.environ.get('POST_IMAGE_MAX_DIM', 1600))
+IMAGE_JPEG_QUALITY = int(os.environ.get('IMAGE_JPEG_QUALITY', 85))
+
+async def read_upload(file: UploadFile, max_bytes: int) -> bytearray:
+    """Read an upload in chunks, rejecting it as soon as it exceeds max_bytes"""
+    if file.size is not None and file.size > max_bytes:
+        raise HTTPException(status_code=413, detail=f"Image must be at most {max_bytes // (1024 * 1024)} MB")
+
+    buffer = bytearray()
+    while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+        buffer += chunk
+        if len(buffer) > max_bytes:
+            raise HTTPException(status_code=413, detail=f"Image must be at most {max_bytes // (1024 * 1024)} MB")
+    return buffer
+
+def downscale_image(image_data, max_dim: int, quality: int = IMAGE_JPEG_QUALITY) -> bytes:
+    """Re-encode an image (bytes or a binary file) as a JPEG no larger than max_dim on either side"""
+    try:
+        image = Image.open(image_data if hasattr(image_data, 'read') else BytesIO(image_data))
+        # JPEGs can be decoded directly at 1/2, 1/4 or 1/8 scale, skipping most of the pixel work.
+        # The draft size keeps the aspect ratio: a square box would force full-scale decodes
+        # whenever the short side is below max_dim.
+        scale = min(max_dim / max(image.size), 1)
+        image.draft('RGB', (math.ceil(image.width * scale), math.ceil(image.height * scale)))
+        # Shrink before rotating and converting, so those copies are of the small image
+        image.thumbnail((max_dim, max_dim), Image.LANCZOS)
+        image = ImageOps.exif_transpose(image)
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+    except Exception:
+        raise HTTPException(status_code=400, detail="Could not decode image")
+
+    output = BytesIO()
+    image.save(output, 'JPEG', quality=quality, optimize=True)
+    return output.getvalue()
+
+async def ingest_image(file: UploadFile, max_dim: int) -> bytes:
+    if not file.content_type.startswith('image/'):
+        raise HTTPException(status_code=400, detail="File must be an image")
+    if file.size is None:
+        return await asyncio.to_thread(downscale_image, await read_upload(file, MAX_UPLOAD_BYTES), max_dim)
+    if file.size > MAX_UPLOAD_BYTES:
+        raise HTTPException(status_code=413, detail=f"Image must be at most {MAX_UPLOAD_BYTES // (1024 * 1024)} MB")
+    # The multipart parser has already spooled the upload (to disk past 1 MB), so decode from
+    # there instead of holding a second copy of the compressed bytes in memory
+    await file.seek(0)
+    return await asyncio.to_thread(downscale_image, file.file, max_dim)
+
+# Blob storage for post images (local filesystem or any S3-compatible store)
+BLOB_STORE = os.environ.get('BLOB_STORE', 'local')
+BLOB_LOCAL_DIR = os.environ.get('BLOB_LOCAL_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'uploads'))
+S3_BUCKET = os.environ.get('S3_BUCKET', 'eatflex-images')
+S3_ENDPOINT_URL = os.environ.get('S3_ENDPOINT_URL')  # e.g. a MinIO server
+S3_PUBLIC_URL = os.environ.get('S3_PUBLIC_URL')  # serve directly from the bucket/CDN when set
+POST_THUMBNAIL_SIZES = {"md": 640, "sm": 320}
+BLOB_KEY_PATTERN = re.compile(r'^[A-Za-z0-9_-]+(/[A-Za-z0-9_-]+)*\.jpg$')
+
+class LocalBlobStore:
+    def __init__(self, root: str):
+        self.root = root
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.root, *key.split('/'))
+
+    def _write(self, key: str, data: bytes):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
+
+    def _read(self, key: str) -> Optional[bytes]:
+        try:
+            with open(self._path(key), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    async def put(self, key: str, data: bytes, content_type: str):
+        await asyncio.to_thread(self._write, key, data)
+
+    async def get(self, key: str) -> Optional[bytes]:
+        return await asyncio.to_thread(self._read, key)
+
+    def url(self, key: str) -> str:
+        return f"/api/images/{key}"
+
+class S3BlobStore:
+    def __init__(self, bucket: str, endpoint_url: str = None, public_url: str = None):
+        import boto3
+        self.bucket = bucket
+        self.public_url = public_url.rstrip('/') if public_url else None
+        self.s3 = boto3.client('s3', endpoint_url=endpoint_url)
+
+    def _read(self, key: str) -> Optional[bytes]:
+        try:
+            return self.s3.get_object(Bucket=self.bucket, Key=key)['Body'].read()
+        except self.s3.exceptions.NoSuchKey:
+            return None
+
+    async def put(self, key: str, data: bytes, content_type: str):
+        await asyncio.to_thread(
+            self.s3.put_object, Bucket=self.bucket, Key=key, Body=data,
+            ContentType=content_type, CacheControl="public, max-age=31536000, immutable"
+        )
+
+    async def get(self, key: str) -> Optional[bytes]:
+        return await asyncio.to_thread(self._read, key)
+
+    def url(self, key: str) -> str:
+        if self.public_url:
+            return f"{self.public_url}/{key}"
+        return f"/api/images/{key}"
+
+if BLOB_STORE == 's3':
+    blob_store = S3BlobStore(S3_BUCKET, S3_ENDPOINT_URL, S3_PUBLIC_URL)
+else:
+    blob_store = LocalBlobStore(BLOB_LOCAL_DIR)
+
+def make_image_variants(image_data: bytes) -> dict:
+    """Full-size JPEG plus progressively smaller thumbnails, decoding the image once"""
+    variants = {"lg": image_data}
+    image = Image.open(BytesIO(image_data))
+    image.load()
+    for name, dim in sorted(POST_THUMBNAIL_SIZES.items(), key=lambda item: -item[1]):
+        image = image.copy()
+        image.thumbnail((dim, dim), Image.LANCZOS)
+        output = BytesIO()
+        image.save(output, 'JPEG', quality=IMAGE_JPEG_QUALITY, optimize=True)
+        variants[name] = output.getvalue()
+    return variants
+
+POST_IMAGE_KEY_PATTERN = re.compile(r'posts/([A-Za-z0-9_-]+)/lg\.jpg$')
+
+def post_image_thumbnails(image_url: str) -> Optional[Dict[str, str]]:
+    """Thumbnail URLs for a full-size image URL issued by store_post_image, else None"""
+    match = POST_IMAGE_KEY_PATTERN.search(image_url)
+    if not match or blob_store.url(match.group(0)) != image_url:
+        return None
+    return {name: blob_store.url(f"posts/{match.group(1)}/{name}.jpg") for name in POST_THUMBNAIL_SIZES}
+
+async def store_post_image(image_data: bytes) -> dict:
+    """Store a post image and its thumbnails, returning their URLs by size"""
+    image_id = str(uuid.uuid4())
+    variants = await asyncio.to_thread(make_image_variants, image_data)
+    urls = {}
+    for name, data in variants.items():
+        key = f"posts/{image_id}/{name}.jpg"
+        await blob_store.put(key, data, "image/jpeg")
+        urls[name] = blob_store.url(key)
+    return urls
+
+# Meal analysis cache (content-addressed by image bytes + normalized meal name)
+ANALYSIS_CACHE_TTL = int(os.environ.get('ANALYSIS_CACHE_TTL', 7 * 24 * 3600))
+ANALYSIS_CACHE_MAX_ENTRIES = int(os.environ.get('ANALYSIS_CACHE_MAX_ENTRIES', 5000))
+ANALYSIS_CACHE_PERSISTENT = os.environ.get('ANALYSIS_CACHE_PERSISTENT', 'true').lower() == 'true'
+
+class AnalysisCache:
+    """Two-tier cache for AI meal analyses: in-memory LRU plus optional Mongo tier"""
+
+    def __init__(self, ttl: int, max_entries: int, collection=None, stats_collection=None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.collection = collection
+        self.stats_collection = stats_collection
+        self.entries = OrderedDict()
+        self.daily_stats = {}
+        # Running average of AI call latency, used to estimate time saved per hit
+        self.avg_miss_ms = 0.0
+
+    @staticmethod
+    def make_key(image_data: bytes, meal_name: str = None) -> str:
+        digest = hashlib.sha256(image_data).hexdigest()
+        return f"{digest}:{(meal_name or '').strip().lower()}"
+
+    async def get(self, key: str) -> Optional[dict]:
+        entry = self.entries.get(key)
+        if entry and entry[0] > time.monotonic():
+            self.entries.move_to_end(key)
+            return dict(entry[1])
+        self.entries.pop(key, None)
+
+        if self.collection is not None:
+            doc = await self.collection.find_one(
+                {"key": key, "expires_at": {"$gt": datetime.now(UTC)}},
+                {"_id": 0, "analysis": 1}
+            )
+            if doc:
+                self._remember(key, doc['analysis'])
+                return dict(doc['analysis'])
+        return None
+
+    async def set(self, key: str, analysis: dict):
+        self._remember(key, analysis)
+        if self.collection is not None:
+            await self.collection.update_one(
+                {"key": key},
+                {"$set": {
+                    "analysis": analysis,
+                    "expires_at": datetime.now(UTC) + timedelta(seconds=self.ttl)
+                }},
+                upsert=True
+            )
+
+    def _remember(self, key: str, analysis: dict):
+        self.entries[key] = (time.monotonic() + self.ttl, dict(analysis))
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    async def record(self, hit: bool, elapsed_ms: float):
+        """Count a lookup outcome in today's hit/miss and latency-saved stats"""
+        if hit:
+            inc = {"hits": 1, "saved_ms": max(self.avg_miss_ms - elapsed_ms, 0.0)}
+        else:
+            self.avg_miss_ms = elapsed_ms if not self.avg_miss_ms else 0.9 * self.avg_miss_ms + 0.1 * elapsed_ms
+            inc = {"misses": 1}
+
+        today = datetime.now(UTC).strftime("%Y-%m-%d")
+        day = self.daily_stats.setdefault(today, {"hits": 0, "misses": 0, "saved_ms": 0.0})
+        for field, value in inc.items():
+            day[field] += value
+
+        if self.stats_collection is not None:
+            counters.incr(self.stats_collection, {"date": today}, inc, upsert=True)
+
+    async def report(self, days: int) -> List[dict]:
+        if self.stats_collection is not None:
+            rows = await self.stats_collection.find(
+                {}, {"_id": 0}
+            ).sort("date", -1).limit(days).to_list(length=days)
+            rows = [counters.overlay(self.stats_collection, {"date": row['date']}, row) for row in rows]
+        else:
+            rows = [{"date": d, **s} for d, s in sorted(self.daily_stats.items(), reverse=True)[:days]]
+
+        for row in rows:
+            hits, misses = row.get('hits', 0), row.get('misses', 0)
+            row['hit_rate'] = round(hits / (hits + misses), 4) if hits + misses else 0.0
+            row['saved_ms'] = round(row.get('saved_ms', 0.0), 1)
+        return rows
+
+analysis_cache = AnalysisCache(
+    ANALYSIS_CACHE_TTL,
+    ANALYSIS_CACHE_MAX_ENTRIES,
+    collection=analysis_cache_collection if ANALYSIS_CACHE_PERSISTENT else None,
+    stats_collection=analysis_cache_stats_collection if ANALYSIS_CACHE_PERSISTENT else None
+)
+
+# Perceptual-hash index for re-encoded or resized copies of already analyzed photos
+PHASH_MAX_DISTANCE = int(os.environ.get('PHASH_MAX_DISTANCE', 6))
+
+def compute_dhash(image_data: bytes) -> Optional[int]:
+    """64-bit difference hash of an image, or None if it can't be decoded"""
+    try:
+        image = Image.open(BytesIO(image_data))
+        # Let the JPEG decoder downscale while decoding instead of inflating every pixel
+        image.draft('L', (64, 64))
+        pixels = list(image.convert('L').resize((9, 8), Image.LANCZOS).getdata())
+    except Exception:
+        return None
+
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            left = pixels[row * 9 + col]
+            value = (value << 1) | (left > pixels[row * 9 + col + 1])
+    return value
+
+class MultiIndexHash:
+    """Hamming-radius index over 64-bit hashes using multi-index hashing.
+
+    The hash is split into max_distance + 1 segments; by the pigeonhole
+    principle any hash within max_distance matches at least one segment
+    exactly, so only those buckets need a full popcount comparison.
+    """
+
+    def __init__(self, max_distance: int):
+        self.max_distance = max_distance
+        segments = max_distance + 1
+        bounds = [round(i * 64 / segments) for i in range(segments + 1)]
+        self.segments = [(lo, (1 << (hi - lo)) - 1) for lo, hi in zip(bounds, bounds[1:])]
+        self.tables = [{} for _ in self.segments]
+        self.payloads = {}
+
+    def add(self, value: int, payload):
+        if value not in self.payloads:
+            for table, (shift, mask) in zip(self.tables, self.segments):
+                table.setdefault((value >> shift) & mask, []).append(value)
+        self.payloads[value] = payload
+
+    def find(self, value: int):
+        """Return (distance, payload) of the closest entry within max_distance"""
+        if value in self.payloads:
+            return 0, self.payloads[value]
+
+        best = None
+        for table, (shift, mask) in zip(self.tables, self.segments):
+            for candidate in table.get((value >> shift) & mask, ()):
+                distance = (candidate ^ value).bit_count()
+                if distance <= self.max_distance and (best is None or distance < best[0]):
+                    best = (distance, candidate)
+        return (best[0], self.payloads[best[1]]) if best else None
+
+    def __len__(self):
+        return len(self.payloads)
+
+class MealHashIndex:
+    """Near-duplicate photo index scoped by normalized meal name.
+
+    A similar photo labelled as a different meal (the same plate with another
+    dish, or a user correcting the name) must not reuse the other analysis,
+    so each name gets its own MultiIndexHash.
+    """
+
+    def __init__(self, max_distance: int):
+        self.max_distance = max_distance
+        self.by_name = {}
+
+    def add(self, name_key: str, value: int, payload):
+        index = self.by_name.get(name_key)
+        if index is None:
+            index = self.by_name[name_key] = MultiIndexHash(self.max_distance)
+        index.add(value, payload)
+
+    def find(self, name_key: str, value: int):
+        index = self.by_name.get(name_key)
+        return index.find(value) if index is not None else None
+
+    def __len__(self):
+        return sum(len(index) for index in self.by_name.values())
+
+IMAGE_EXTENSION = re.compile(r"\.(jpe?g|png|gif|webp|heic|heif)$", re.IGNORECASE)
+
+def meal_name_key(meal_name: str = None) -> str:
+    """Meal name as compared for hash reuse: case, punctuation, digits and any image
+    extension dropped, so 'IMG_0412.jpg' and 'img_0413.JPG' agree but 'pasta.jpg' and 'salad.jpg' don't"""
+    return " ".join(re.findall(r"[a-z]+", IMAGE_EXTENSION.sub("", (meal_name or "").strip()).lower()))
+
+meal_phash_index = MealHashIndex(PHASH_MAX_DISTANCE)
+
+@app.on_event("startup")
+async def load_meal_phash_index():
+    """Rebuild the in-memory hash index from persisted hashes"""
+    try:
+        # Skip hashes stored before they were keyed by meal name, and placeholders
+        # persisted before fallbacks were flagged and kept out of the cache
+        query = {
+            "name_key": {"$exists": True},
+            "analysis.fallback": {"$ne": True},
+            "analysis.ingredients": {"$ne": FALLBACK_INGREDIENTS}
+        }
+        async for doc in meal_phash_collection.find(query, {"_id": 0, "phash": 1, "name_key": 1, "analysis": 1}):
+            meal_phash_index.add(doc['name_key'], int(doc['phash'], 16), doc['analysis'])
+    except Exception as e:
+        print(f"Perceptual hash index load failed: {e}")
+
+async def analyze_meal_cached(image_data: bytes, meal_name: str = None) -> dict:
+    """Return a cached analysis for identical or near-identical uploads, calling the AI only on a miss"""
+    started = time.perf_counter()
+    key = AnalysisCache.make_key(image_data, meal_name)
+
+    analysis = await analysis_cache.get(key)
+    if analysis is not None:
+        await analysis_cache.record(True, (time.perf_counter() - started) * 1000)
+        return analysis
+
+    phash = await asyncio.to_thread(compute_dhash, image_data)
+    name_key = meal_name_key(meal_name)
+    if phash is not None:
+        match = meal_phash_index.find(name_key, phash)
+        if match is not None:
+            analysis = dict(match[1])
+            await analysis_cache.set(key, analysis)
+            await analysis_cache.record(True, (time.perf_counter() - started) * 1000)
+            return analysis
+
+    image_base64 = base64.b64encode(image_data).decode('utf-8')
+    analysis = await analyze_meal_with_ai(image_base64, meal_name)
+    await analysis_cache.record(False, (time.perf_counter() - started) * 1000)
+
+    # Placeholder macros must never be served again as if they were an analysis
+    if not analysis.get('fallback'):
+        await analysis_cache.set(key, analysis)
+        if phash is not None:
+            meal_phash_index.add(name_key, phash, dict(analysis))
+            try:
+                await meal_phash_collection.update_one(
+                    {"phash": f"{phash:016x}", "name_key": name_key},
+                    {"$set": {"analysis": analysis, "created_at": datetime.now(UTC)}},
+                    upsert=True
+                )
+            except DuplicateKeyError:
+                # The pre-name unique index on phash alone is still in place;
+                # `manage.py migrate-phashes` drops it
+                pass
+    return analysis
+
+async def save_analyzed_meal(user_id: str, analysis: dict, meal_date: str) -> str:
+    meal_id = str(uuid.uuid4())
+    meal_doc = {
+        "meal_id": meal_id,
+        "user_id": user_id,
+        "name": analysis.get('name', 'Unknown meal'),
+        "ingredients": analysis.get('ingredients', ''),
+        "calories": analysis.get('calories', 0),
+        "protein": analysis.get('protein', 0),
+        "carbs": analysis.get('carbs', 0),
+        "fat": analysis.get('fat', 0),
+        "confidence": analysis.get('confidence', 5),
+        "fallback": bool(analysis.get('fallback')),
+        "created_at": datetime.now(UTC),
+        "date": meal_date,
+        "analyzed_by_ai": True
+    }
+    await meals_collection.insert_one(meal_doc)
+    await apply_meal_to_rollup(meal_doc)
+    await record_meal_day(user_id, meal_date)
+    count_daily(meals_logged=1)
+    return meal_id
+
+# Background analysis jobs. Job state lives in Mongo so any worker process can
+# answer polls; the queue itself is per-process and bounded to absorb bursts.
+# Queued jobs keep their (downscaled) image and are owned by the process that
+# queued them, so jobs stranded by a crash can be claimed by another process:
+# stale queued jobs are re-queued and stale running jobs failed, at startup and
+# every ANALYSIS_JOB_STALE_AFTER seconds.
+ANALYSIS_WORKERS = int(os.environ.get('ANALYSIS_WORKERS', AI_MAX_CONCURRENCY))
+ANALYSIS_QUEUE_MAX = int(os.environ.get('ANALYSIS_QUEUE_MAX', 200))
+ANALYSIS_JOB_TTL = int(os.environ.get('ANALYSIS_JOB_TTL', 24 * 3600))
+ANALYSIS_JOB_POLL_INTERVAL = float(os.environ.get('ANALYSIS_JOB_POLL_INTERVAL', 1.0))
+ANALYSIS_JOB_STALE_AFTER = float(os.environ.get('ANALYSIS_JOB_STALE_AFTER', 300))
+ANALYSIS_JOB_PROJECTION = {"_id": 0, "user_id": 0, "image": 0, "owner": 0}
+
+analysis_queue = asyncio.Queue(maxsize=ANALYSIS_QUEUE_MAX)
+analysis_job_events = {}
+analysis_worker_tasks = []
+analysis_process_id = str(uuid.uuid4())
+
+async def enqueue_analysis_job(user_id: str, meal_date: str, image_data: bytes, filename: str = None) -> str:
+    if analysis_queue.full():
+        raise HTTPException(status_code=503, detail="Analysis queue is full, please retry shortly")
+
+    job_id = str(uuid.uuid4())
+    now = datetime.now(UTC)
+    await analysis_jobs_collection.insert_one({
+        "job_id": job_id,
+        "user_id": user_id,
+        "status": "queued",
+        "meal_id": None,
+        "analysis": None,
+        "error": None,
+        "meal_date": meal_date,
+        "image": image_data,
+        "filename": filename,
+        "owner": analysis_process_id,
+        "created_at": now,
+        "updated_at": now
+    })
+    analysis_job_events[job_id] = asyncio.Event()
+    analysis_queue.put_nowait((job_id, user_id, meal_date, image_data, filename))
+    return job_id
+
+async def set_analysis_job_status(job_id: str, status: str, expect: dict = None, **fields) -> bool:
+    """Move a job to status if it still matches expect; False if another process took it"""
+    update = {"$set": {"status": status, "updated_at": datetime.now(UTC), **fields}}
+    if status in ("done", "failed"):
+        update["$unset"] = {"image": ""}
+    result = await analysis_jobs_collection.update_one({"job_id": job_id, **(expect or {})}, update)
+    if not result.matched_count:
+        return False
+    event = analysis_job_events.get(job_id)
+    if event:
+        event.set()
+    if status in ("done", "failed"):
+        analysis_job_events.pop(job_id, None)
+    return True
+
+async def wait_for_analysis_job(job_id: str, timeout: float):
+    """Wake on a local status change, or after timeout when the job runs elsewhere"""
+    event = analysis_job_events.get(job_id)
+    if event is None:
+        await asyncio.sleep(timeout)
+        return
+    try:
+        await asyncio.wait_for(event.wait(), timeout)
+    except asyncio.TimeoutError:
+        pass
+    event.clear()
+
+async def analysis_worker():
+    while True:
+        job_id, user_id, meal_date, image_data, filename = await analysis_queue.get()
+        try:
+            # Skip jobs another process re-queued after this one looked stalled
+            if not await set_analysis_job_status(job_id, "running", {"status": "queued", "owner": analysis_process_id}):
+                continue
+            analysis = await analyze_meal_cached(image_data, filename)
+            meal_id = await save_analyzed_meal(user_id, analysis, meal_date)
+            await set_analysis_job_status(job_id, "done", meal_id=meal_id, analysis=analysis)
+        except asyncio.CancelledError:
+            await set_analysis_job_status(job_id, "failed", error="Server shutting down, please retry")
+            raise
+        except Exception as e:
+            print(f"Analysis job {job_id} failed: {e}")
+            await set_analysis_job_status(job_id, "failed", error=str(e))
+        finally:
+            analysis_queue.task_done()
+
+async def recover_analysis_jobs() -> int:
+    """Fail stale running jobs and claim stale queued ones into this process's queue"""
+    cutoff = datetime.now(UTC) - timedelta(seconds=ANALYSIS_JOB_STALE_AFTER)
+    interrupted = {"$set": {"status": "failed", "error": "Analysis was interrupted, please retry",
+                            "updated_at": datetime.now(UTC)}, "$unset": {"image": ""}}
+    await analysis_jobs_collection.update_many({"status": "running", "updated_at": {"$lt": cutoff}}, interrupted)
+    # Queued before jobs kept their image, so there is nothing to re-run
+    await analysis_jobs_collection.update_many(
+        {"status": "queued", "updated_at": {"$lt": cutoff}, "image": {"$exists": False}}, interrupted
+    )
+    claimed = 0
+    while not analysis_queue.full():
+        job = await analysis_jobs_collection.find_one_and_update(
+            {"status": "queued", "updated_at": {"$lt": cutoff}, "owner": {"$ne": analysis_process_id}},
+            {"$set": {"owner": analysis_process_id, "updated_at": datetime.now(UTC)}},
+            projection={"_id": 0, "job_id": 1, "user_id": 1, "meal_date": 1, "image": 1, "filename": 1}
+        )
+        if job is None:
+            break
+        analysis_job_events.setdefault(job['job_id'], asyncio.Event())
+        analysis_queue.put_nowait((job['job_id'], job['user_id'], job['meal_date'], job['image'], job.get('filename')))
+        claimed += 1
+    return claimed
+
+async def analysis_job_sweeper():
+    while True:
+        try:
+            claimed = await recover_analysis_jobs()
+            if claimed:
+                print(f"Re-queued {claimed} stalled analysis jobs")
+        except Exception as e:
+            print(f"Analysis job recovery failed: {e}")
+        await asyncio.sleep(ANALYSIS_JOB_STALE_AFTER)
+
+@app.on_event("startup")
+async def start_analysis_workers():
+    for _ in range(ANALYSIS_WORKERS):
+        analysis_worker_tasks.append(asyncio.create_task(analysis_worker()))
+    analysis_worker_tasks.append(asyncio.create_task(analysis_job_sweeper()))
+
+async def stop_analysis_workers():
+    for task in analysis_worker_tasks:
+        task.cancel()
+    await asyncio.gather(*analysis_worker_tasks, return_exceptions=True)
+    analysis_worker_tasks.clear()
+
+    # Jobs still waiting in this process's queue would otherwise stay "queued" forever
+    while not analysis_queue.empty():
+        job_id = analysis_queue.get_nowait()[0]
+        await set_analysis_job_status(job_id, "failed", error="Server shutting down, please retry")
+
+# Keyset pagination over (created_at, id), newest first. Cursors are opaque to
+# clients and stay stable under concurrent inserts, unlike skip offsets.
+MAX_PAGE_SIZE = int(os.environ.get('MAX_PAGE_SIZE', 100))
+DEFAULT_RECIPE_PAGE_SIZE = 20
+
+def encode_cursor(created_at: datetime, item_id: str) -> str:
+    raw = json.dumps([created_at.isoformat(), item_id]).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+def decode_cursor(cursor: str):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        created_at, item_id = json.loads(raw)
+        return datetime.fromisoformat(created_at), str(item_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def clamp_page_size(limit: int) -> int:
+    return min(max(limit, 1), MAX_PAGE_SIZE)
+
+def keyset_filter(cursor: Optional[str], id_field: str) -> dict:
+    if not cursor:
+        return {}
+    created_at, item_id = decode_cursor(cursor)
+    # The top-level bound lets the (..., created_at, id) index scan start at the cursor
+    return {
+        "created_at": {"$lte": created_at},
+        "$or": [{"created_at": {"$lt": created_at}}, {id_field: {"$lt": item_id}}]
+    }
+
+async def paginate(collection, query: dict, id_field: str, cursor: Optional[str], limit: int, projection: dict = None):
+    """Return (items, next_cursor) for one newest-first page of a collection"""
+    keyset = keyset_filter(cursor, id_field)
+    items = await collection.find(
+        {"$and": [query, keyset]} if keyset else query,
+        projection or {"_id": 0}
+    ).sort([("created_at", -1), (id_field, -1)]).limit(limit + 1).to_list(length=limit + 1)
+    next_cursor = encode_cursor(items[limit - 1]['created_at'], items[limit - 1][id_field]) if len(items) > limit else None
+    return items[:limit], next_cursor
+
+# Follow graph. One edge document per relationship; users keep only
+# followers_count/following_count instead of unbounded id arrays. Edges to
+# fanout_on_read authors are flagged so feeds can find them without a user lookup.
+async def follower_ids(user_id: str) -> List[str]:
+    edges = await follows_collection.find(
+        {"followee_id": user_id}, {"_id": 0, "follower_id": 1}
+    ).to_list(length=None)
+    return [edge['follower_id'] for edge in edges]
+
+async def following_ids(user_id: str) -> List[str]:
+    edges = await follows_collection.find(
+        {"follower_id": user_id}, {"_id": 0, "followee_id": 1}
+    ).to_list(length=None)
+    return [edge['followee_id'] for edge in edges]
+
+async def list_follow_users(query: dict, id_field: str, cursor: Optional[str], limit: int):
+    """Page through follow edges and resolve the users on the page with one $in query"""
+    edges, next_cursor = await paginate(follows_collection, query, id_field, cursor, limit)
+    ids = [edge[id_field] for edge in edges]
+    users = await users_collection.find(
+        {"user_id": {"$in": ids}},
+        {"_id": 0, "user_id": 1, "name": 1, "goal": 1}
+    ).to_list(length=len(ids))
+    by_id = {user['user_id']: user for user in users}
+    return [by_id[user_id] for user_id in ids if user_id in by_id], next_cursor
+
+async def set_follow(follower_id: str, followee_id: str, following: bool, fanout_on_read: bool = False) -> bool:
+    """Idempotently create or remove a follow edge; True if the state changed.
+
+    The edge upsert/delete on the unique pair is the atomic decision, and only the
+    request whose write changed it moves both counters, in one bulk write.
+    """
+    edge = {"follower_id": follower_id, "followee_id": followee_id}
+    if following:
+        try:
+            result = await follows_collection.update_one(
+                edge,
+                {"$setOnInsert": {"created_at": datetime.now(UTC), "fanout_on_read": fanout_on_read}},
+                upsert=True
+            )
+        except DuplicateKeyError:
+            return False
+        if result.upserted_id is None:
+            return False
+        delta = 1
+    else:
+        if not (await follows_collection.delete_one(edge)).deleted_count:
+            return False
+        delta = -1
+    await users_collection.bulk_write([
+        UpdateOne({"user_id": follower_id}, {"$inc": {"following_count": delta}}),
+        UpdateOne({"user_id": followee_id}, {"$inc": {"followers_count": delta}}),
+    ], ordered=False)
+    return True
+
+# Materialized home timelines (fan-out-on-write). Each user has one document with a
+# capped, newest-first list of post references. Authors with very many followers are
+# flagged fanout_on_read and their posts are merged in when the feed is read instead.
+TIMELINE_MAX_ENTRIES = int(os.environ.get('TIMELINE_MAX_ENTRIES', 500))
+FANOUT_FOLLOWER_LIMIT = int(os.environ.get('FANOUT_FOLLOWER_LIMIT', 5000))
+FEED_PAGE_SIZE = 20
+
+def timeline_entry(post: dict) -> dict:
+    return {"post_id": post['post_id'], "author_id": post['user_id'], "created_at": post['created_at']}
+
+async def push_to_timelines(user_ids: List[str], entries: List[dict]):
+    if not user_ids or not entries:
+        return
+    # No upsert: a user without a timeline gets a complete one rebuilt on first read
+    await timelines_collection.update_many(
+        {"user_id": {"$in": user_ids}},
+        {"$push": {"entries": {"$each": entries, "$sort": {"created_at": -1, "post_id": -1}, "$slice": TIMELINE_MAX_ENTRIES}}}
+    )
+
+async def fan_out_post(author: dict, post: dict):
+    """Push a new post onto the author's and their followers' timelines"""
+    recipients = [author['user_id']]
+    topics = []
+    if author.get('followers_count', 0) > FANOUT_FOLLOWER_LIMIT:
+        if not author.get('fanout_on_read'):
+            await users_collection.update_one({"user_id": author['user_id']}, {"$set": {"fanout_on_read": True}})
+            user_cache.invalidate(author['user_id'])
+            await follows_collection.update_many({"followee_id": author['user_id']}, {"$set": {"fanout_on_read": True}})
+        topics.append(f"author:{author['user_id']}")
+    else:
+        recipients += await follower_ids(author['user_id'])
+    await push_to_timelines(recipients, [timeline_entry(post)])
+    await publish_event(
+        topics + [f"user:{user_id}" for user_id in recipients],
+        {"type": "post", "post": {field: value for field, value in post.items() if field in PostOut.model_fields}}
+    )
+
+async def rebuild_timeline(user: dict) -> List[dict]:
+    """Seed a missing timeline from the followed users' recent posts (fan-out-on-read)"""
+    user_ids = await following_ids(user['user_id']) + [user['user_id']]
+    posts = await posts_collection.find(
+        {"user_id": {"$in": user_ids}},
+        {"_id": 0, "post_id": 1, "user_id": 1, "created_at": 1}
+    ).sort([("created_at", -1), ("post_id", -1)]).limit(TIMELINE_MAX_ENTRIES).to_list(length=TIMELINE_MAX_ENTRIES)
+    entries = [timeline_entry(post) for post in posts]
+    await timelines_collection.update_one(
+        {"user_id": user['user_id']},
+        {"$set": {"entries": entries}},
+        upsert=True
+    )
+    return entries
+
+async def backfill_timeline(user_id: str, author_id: str):
+    """Add a newly followed author's recent posts to the follower's timeline"""
+    posts = await posts_collection.find(
+        {"user_id": author_id},
+        {"_id": 0, "post_id": 1, "user_id": 1, "created_at": 1}
+    ).sort("created_at", -1).limit(FEED_PAGE_SIZE).to_list(length=FEED_PAGE_SIZE)
+    await push_to_timelines([user_id], [timeline_entry(post) for post in posts])
+
+async def read_timeline_page(user_id: str, cursor: Optional[str], limit: int) -> Optional[List[dict]]:
+    """Slice one keyset page out of a stored timeline server-side; None if there is no timeline"""
+    entry_filter = {"$literal": True}
+    if cursor:
+        created_at, post_id = decode_cursor(cursor)
+        entry_filter = {"$or": [
+            {"$lt": ["$$entry.created_at", created_at]},
+            {"$and": [{"$eq": ["$$entry.created_at", created_at]}, {"$lt": ["$$entry.post_id", post_id]}]}
+        ]}
+    result = await timelines_collection.aggregate([
+        {"$match": {"user_id": user_id}},
+        {"$project": {"_id": 0, "entries": {"$slice": [
+            {"$filter": {"input": "$entries", "as": "entry", "cond": entry_filter}}, limit
+        ]}}}
+    ]).to_list(length=1)
+    return result[0]['entries'] if result else None
+
+# Users with nothing in their timeline see every post instead; those cursors are
+# marked so that later pages keep paging the global query
+GLOBAL_FEED_CURSOR_PREFIX = "global."
+
+async def global_feed_page(user_id: str, cursor: Optional[str], limit: int) -> dict:
+    posts, next_cursor = await paginate(posts_collection, {}, "post_id", cursor, limit, POST_LIST_PROJECTION)
+    return {
+        "posts": await annotate_liked_by_me(posts, user_id),
+        "next_cursor": next_cursor and GLOBAL_FEED_CURSOR_PREFIX + next_cursor
+    }
+
+async def load_posts_in_order(post_ids: List[str]) -> List[dict]:
+    posts = await posts_collection.find({"post_id": {"$in": post_ids}}, POST_LIST_PROJECTION).to_list(length=len(post_ids))
+    by_id = {post['post_id']: post for post in posts}
+    # Deleted posts simply drop out here instead of being pulled from every timeline
+    return [by_id[post_id] for post_id in post_ids if post_id in by_id]
+
+# Post engagement. Likes and comments live in their own collections; posts carry
+# denormalized like_count/comment_count and list endpoints never ship the arrays.
+# Unliking keeps the like edge with active: false, so a like, unlike or toggle is a
+# single update on the edge; edges without the flag predate it and are active.
+POST_LIST_PROJECTION = list_projection(PostOut)
+MEAL_LIST_PROJECTION = list_projection(MealOut)
+COMMENT_LIST_PROJECTION = list_projection(CommentOut)
+
+async def annotate_liked_by_me(posts: List[dict], user_id: str) -> List[dict]:
+    """Set liked_by_me on a page of posts with one batched likes lookup"""
+    if not posts:
+        return posts
+    liked = await likes_collection.find(
+        {"post_id": {"$in": [post['post_id'] for post in posts]}, "user_id": user_id, "active": {"$ne": False}},
+        {"_id": 0, "post_id": 1}
+    ).to_list(length=len(posts))
+    liked_ids = {like['post_id'] for like in liked}
+    for post in posts:
+        post.setdefault('like_count', 0)
+        post.setdefault('comment_count', 0)
+        post['liked_by_me'] = post['post_id'] in liked_ids
+    return posts
+
+async def set_like(post_id: str, user_id: str, liked: Optional[bool]):
+    """Like (True), unlike (False) or toggle (None); returns (changed, liked, post author id or None).
+
+    Two round trips: one update on the unique (post_id, user_id) edge decides the new
+    state and returns the old one, and only a real change moves like_count (which
+    also returns the author). Liking a missing post raises 404.
+    """
+    like = {"post_id": post_id, "user_id": user_id}
+    # A freshly upserted edge has no created_at yet and starts out inactive
+    was_active = {"$ifNull": ["$active", {"$cond": [{"$ifNull": ["$created_at", False]}, True, False]}]}
+    update = [{"$set": {
+        "active": {"$not": [was_active]} if liked is None else liked,
+        "created_at": {"$ifNull": ["$created_at", "$$NOW"]}
+    }}]
+    try:
+        before = await likes_collection.find_one_and_update(
+            like, update, projection={"_id": 0, "active": 1}, upsert=liked is not False,
+            return_document=ReturnDocument.BEFORE
+        )
+    except DuplicateKeyError:
+        # A concurrent upsert created the edge first; this update now applies to it
+        before = await likes_collection.find_one_and_update(
+            like, update, projection={"_id": 0, "active": 1}, return_document=ReturnDocument.BEFORE
+        )
+    previous = before is not None and before.get('active', True)
+    now = (not previous) if liked is None else liked
+    if now == previous:
+        return False, now, None
+    
+    post = await posts_collection.find_one_and_update(
+        {"post_id": post_id}, {"$inc": {"like_count": 1 if now else -1}}, projection={"_id": 0, "user_id": 1}
+    )
+    if post is None:
+        await likes_collection.delete_one(like)
+        raise HTTPException(status_code=404, detail="Post not found")
+    return True, now, post['user_id']
+
+# Push channel. Writes publish events to topics: user:<id> (a user's feed and
+# notifications), author:<id> (posts by fanout_on_read authors) and post:<id>
+# (live likes/comments). Each WebSocket or SSE connection holds one subscription
+# with a bounded buffer. The Mongo broker relays events between workers through a
+# capped collection that every worker tails; the local broker is single-process.
+PUSH_BROKER = os.environ.get('PUSH_BROKER', 'local')
+PUSH_BUFFER_SIZE = int(os.environ.get('PUSH_BUFFER_SIZE', 100))
+PUSH_HEARTBEAT_INTERVAL = float(os.environ.get('PUSH_HEARTBEAT_INTERVAL', 25))
+PUSH_EVENTS_CAP_BYTES = int(os.environ.get('PUSH_EVENTS_CAP_BYTES', 64 * 1024 * 1024))
+PUSH_MAX_POST_TOPICS = 50
+PUSH_RESYNC = orjson.dumps({"type": "resync"}).decode()
+PUSH_PING = orjson.dumps({"type": "ping"}).decode()
+
+class Subscription:
+    __slots__ = ("topics", "queue")
+
+    def __init__(self, topics):
+        self.topics = set(topics)
+        self.queue = asyncio.Queue(maxsize=PUSH_BUFFER_SIZE)
+
+    def offer(self, payload) -> int:
+        """Buffer an encoded event; returns how many buffered events had to be dropped"""
+        try:
+            self.queue.put_nowait(payload)
+            return 0
+        except asyncio.QueueFull:
+            # A client this far behind refetches instead of replaying the backlog
+            dropped = self.queue.qsize()
+            self.replace(PUSH_RESYNC)
+            return dropped
+
+    def replace(self, payload):
+        while not self.queue.empty():
+            self.queue.get_nowait()
+        self.queue.put_nowait(payload)
+
+    def close(self):
+        self.replace(None)
+
+class LocalBroker:
+    """In-process pub/sub; also the delivery layer under MongoBroker"""
+
+    def __init__(self):
+        self.topics = {}
+        self.connections = 0
+        self.dropped = 0
+
+    def subscribe(self, topics) -> Subscription:
+        subscription = Subscription(topics)
+        for topic in subscription.topics:
+            self.topics.setdefault(topic, set()).add(subscription)
+        self.connections += 1
+        return subscription
+
+    def add_topic(self, subscription: Subscription, topic: str):
+        subscription.topics.add(topic)
+        self.topics.setdefault(topic, set()).add(subscription)
+
+    def remove_topic(self, subscription: Subscription, topic: str):
+        subscription.topics.discard(topic)
+        subscribers = self.topics.get(topic)
+        if subscribers is not None:
+            subscribers.discard(subscription)
+            if not subscribers:
+                del self.topics[topic]
+
+    def unsubscribe(self, subscription: Subscription):
+        for topic in list(subscription.topics):
+            self.remove_topic(subscription, topic)
+        self.connections -= 1
+
+    def deliver(self, topics: List[str], event: dict):
+        """Encode once and buffer for every local subscriber of any of the topics"""
+        payload = orjson.dumps(event).decode()
+        delivered = set()
+        for topic in topics:
+            for subscription in self.topics.get(topic, ()):
+                if subscription not in delivered:
+                    delivered.add(subscription)
+                    self.dropped += subscription.offer(payload)
+
+    async def publish(self, topics: List[str], event: dict):
+        self.deliver(topics, event)
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+class MongoBroker(LocalBroker):
+    def __init__(self, collection):
+        super().__init__()
+        self.collection = collection
+        self.task = None
+
+    async def publish(self, topics: List[str], event: dict):
+        await self.collection.insert_one({"topics": topics, "event": event, "created_at": datetime.now(UTC)})
+
+    async def start(self):
+        try:
+            await db.create_collection(self.collection.name, capped=True, size=PUSH_EVENTS_CAP_BYTES)
+        except CollectionInvalid:
+            pass
+        self.task = asyncio.create_task(self._tail())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+
+    async def _tail(self):
+        """Deliver events published by any worker, starting from the newest at startup"""
+        latest = await self.collection.find({}, {"_id": 1}).sort("$natural", -1).limit(1).to_list(length=1)
+        last_id = latest[0]['_id'] if latest else None
+        while True:
+            try:
+                cursor = self.collection.find(
+                    {"_id": {"$gt": last_id}} if last_id else {},
+                    cursor_type=CursorType.TAILABLE_AWAIT
+                )
+                while cursor.alive:
+                    async for doc in cursor:
+                        last_id = doc['_id']
+                        self.deliver(doc['topics'], doc['event'])
+                    await asyncio.sleep(0.1)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Push event tail failed: {e}")
+            # An empty capped collection yields a dead cursor; retry shortly
+            await asyncio.sleep(1)
+
+if PUSH_BROKER == 'mongo':
+    push_broker = MongoBroker(push_events_collection)
+else:
+    push_broker = LocalBroker()
+
+@app.on_event("startup")
+async def start_push_broker():
+    await push_broker.start()
+
+async def stop_push_broker():
+    await push_broker.stop()
+
+async def publish_event(topics: List[str], event: dict):
+    """Publish without failing the write that triggered it"""
+    if not topics:
+        return
+    try:
+        await push_broker.publish(topics, event)
+    except Exception as e:
+        print(f"Push publish failed: {e}")
+
+async def push_topics(user_id: str) -> List[str]:
+    celebrities = await follows_collection.find(
+        {"follower_id": user_id, "fanout_on_read": True},
+        {"_id": 0, "followee_id": 1}
+    ).to_list(length=None)
+    return [f"user:{user_id}", *(f"author:{edge['followee_id']}" for edge in celebrities)]
+
+def process_rss() -> Optional[int]:
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return None
+
+# Write-behind counters. Counter $incs on the request path are summed in memory
+# per document and written as one unordered bulk_write per collection every
+# COUNTER_FLUSH_INTERVAL seconds, or sooner once COUNTER_FLUSH_MAX_KEYS documents
+# are pending. Reads overlay this worker's unflushed deltas so authors see their
+# own writes immediately; other workers see them after the next flush.
+COUNTER_FLUSH_INTERVAL = float(os.environ.get('COUNTER_FLUSH_INTERVAL', 1.0))
+COUNTER_FLUSH_MAX_KEYS = int(os.environ.get('COUNTER_FLUSH_MAX_KEYS', 1000))
+COUNTER_SHUTDOWN_ATTEMPTS = 3
+
+class CounterBuffer:
+    """Coalesces $inc updates in memory and flushes them in batched bulk writes"""
+
+    def __init__(self, interval: float, max_keys: int, on_flush=None):
+        self.interval = interval
+        self.max_keys = max_keys
+        self.on_flush = on_flush
+        self.collections = {}
+        # (collection name, filter items) -> {field: delta}; inflight is the batch being written
+        self.pending = {}
+        self.inflight = {}
+        self.upserts = set()
+        self.wakeup = asyncio.Event()
+        self.flush_lock = asyncio.Lock()
+        self.task = None
+        self.increments = 0
+        self.flushes = 0
+        self.writes = 0
+        self.dropped = 0
+
+    def incr(self, collection, key: dict, fields: dict, upsert: bool = False):
+        """Queue an $inc on the document matching key; never waits on the database"""
+        entry = (collection.name, tuple(key.items()))
+        self.collections[collection.name] = collection
+        deltas = self.pending.setdefault(entry, {})
+        for field, delta in fields.items():
+            deltas[field] = deltas.get(field, 0) + delta
+        if upsert:
+            self.upserts.add(entry)
+        self.increments += 1
+        if len(self.pending) >= self.max_keys:
+            self.wakeup.set()
+
+    def overlay(self, collection, key: dict, doc: dict) -> dict:
+        """A copy of doc with this worker's unflushed deltas for it added"""
+        entry = (collection.name, tuple(key.items()))
+        batches = [batch[entry] for batch in (self.inflight, self.pending) if entry in batch]
+        if not batches:
+            return doc
+        doc = dict(doc)
+        for deltas in batches:
+            for field, delta in deltas.items():
+                doc[field] = (doc.get(field) or 0) + delta
+        return doc
+
+    def requeue(self, entries: List[tuple]):
+        for entry, deltas, upsert in entries:
+            queued = self.pending.setdefault(entry, {})
+            for field, delta in deltas.items():
+                queued[field] = queued.get(field, 0) + delta
+            if upsert:
+                self.upserts.add(entry)
+
+    async def flush(self) -> int:
+        """Write everything pending; returns the number of documents updated"""
+        async with self.flush_lock:
+            if not self.pending:
+                return 0
+            self.inflight, self.pending = self.pending, {}
+            upserts, self.upserts = self.upserts, set()
+            batches = {}
+            for entry, deltas in self.inflight.items():
+                deltas = {field: delta for field, delta in deltas.items() if delta}
+                if deltas:
+                    batches.setdefault(entry[0], []).append((entry, deltas, entry in upserts))
+            
+            # Entries that netted out to zero have nothing to write or overlay
+            self.inflight = {entry: self.inflight[entry] for entries in batches.values() for entry, _, _ in entries}
+            
+            written = []
+            for name, entries in batches.items():
+                batch_entries = entries
+                try:
+                    await self.collections[name].bulk_write([
+                        UpdateOne(dict(entry[1]), {"$inc": deltas}, upsert=upsert)
+                        for entry, deltas, upsert in entries
+                    ], ordered=False)
+                except BulkWriteError as e:
+                    # Per-document errors (e.g. a non-numeric field) won't succeed on retry
+                    failed = {error['index'] for error in e.details['writeErrors']}
+                    self.dropped += len(failed)
+                    print(f"Dropped {len(failed)} counter updates on {name}: {e.details['writeErrors'][0]['errmsg']}")
+                    entries = [item for index, item in enumerate(entries) if index not in failed]
+                except Exception as e:
+                    # The server never acknowledged the batch; keep it for the next flush
+                    print(f"Counter flush to {name} failed, retrying later: {e}")
+                    self.requeue(entries)
+                    entries = []
+                # Stop overlaying this collection's batch as soon as its write is settled:
+                # written deltas are in the documents now, requeued ones are pending again
+                for entry, _, _ in batch_entries:
+                    del self.inflight[entry]
+                if entries and self.on_flush:
+                    self.on_flush([entry for entry, _, _ in entries])
+                written.extend(entry for entry, _, _ in entries)
+            
+            self.flushes += 1
+            self.writes += len(written)
+            return len(written)
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            # Shielded so shutdown can't cancel a bulk write halfway and lose its batch
+            await asyncio.shield(self.flush())
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        """Stop the flush loop and write out everything still buffered"""
+        if self.task:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+        # flush() waits out a batch the cancelled loop was still writing
+        for _ in range(COUNTER_SHUTDOWN_ATTEMPTS):
+            await self.flush()
+            if not self.pending:
+                return
+        if self.pending:
+            print(f"Lost {len(self.pending)} counter updates at shutdown")
+
+    def stats(self) -> dict:
+        return {
+            "pending": len(self.pending),
+            "increments": self.increments,
+            "flushes": self.flushes,
+            "documents_written": self.writes,
+            "dropped": self.dropped
+        }
+
+def refresh_flushed_users(entries: List[tuple]):
+    """Cached principals and profiles were read before the flush; reload them from Mongo"""
+    user_ids = [dict(key)['user_id'] for name, key in entries if name == users_collection.name]
+    if user_ids:
+        user_cache.invalidate(*user_ids)
+        profile_cache.invalidate(*user_ids)
+
+counters = CounterBuffer(COUNTER_FLUSH_INTERVAL, COUNTER_FLUSH_MAX_KEYS, on_flush=refresh_flushed_users)
+
+@app.on_event("startup")
+async def start_counter_flusher():
+    counters.start()
+
+def with_pending_counts(user: dict) -> dict:
+    return counters.overlay(users_collection, {"user_id": user['user_id']}, user)
+
+def count_daily(**fields):
+    """Bump today's app-wide activity counters (UTC day)"""
+    counters.incr(daily_stats_collection, {"date": datetime.now(UTC).strftime("%Y-%m-%d")}, fields, upsert=True)
+
+# Daily nutrition rollups, maintained incrementally as meals are written so that
+# dashboards and range summaries never have to re-read individual meals.
+NUTRIENT_FIELDS = ("calories", "protein", "carbs", "fat")
+SUMMARY_MAX_DAYS = 3 * 366
+
+async def apply_meal_to_rollup(meal: dict, sign: int = 1):
+    """Add (sign=1) or remove (sign=-1) a meal's macros from its day's totals"""
+    inc = {field: sign * (meal.get(field) or 0) for field in NUTRIENT_FIELDS}
+    inc["meals"] = sign
+    await daily_totals_collection.update_one(
+        {"user_id": meal['user_id'], "date": meal['date']},
+        {"$inc": inc},
+        upsert=True
+    )
+
+def summary_period(day: str, granularity: str) -> str:
+    if granularity == "month":
+        return day[:7]
+    if granularity == "week":
+        parsed = date.fromisoformat(day)
+        return (parsed - timedelta(days=parsed.weekday())).isoformat()
+    return day
+
+# Streaks. Logging a meal advances the streak with one conditional update, so
+# repeat meals on the same day cost no write; a full recompute streams meals in
+# (user_id, date) order and is only needed for imported or deleted history.
+STREAK_BACKFILL_BATCH = 1000
+
+async def record_meal_day(user_id: str, day: str):
+    """Extend (or restart) the user's streak for a meal logged on `day`"""
+    yesterday = (date.fromisoformat(day) - timedelta(days=1)).isoformat()
+    result = await users_collection.update_one(
+        {"user_id": user_id, "$or": [{"last_meal_date": None}, {"last_meal_date": {"$lt": day}}]},
+        [
+            {"$set": {
+                "current_streak": {"$cond": [
+                    {"$eq": ["$last_meal_date", yesterday]},
+                    {"$add": [{"$ifNull": ["$current_streak", 0]}, 1]},
+                    1
+                ]},
+                "last_meal_date": day
+            }},
+            {"$set": {"longest_streak": {"$max": [{"$ifNull": ["$longest_streak", 0]}, "$current_streak"]}}}
+        ]
+    )
+    if result.modified_count:
+        user_cache.invalidate(user_id)
+
+def current_streak(user: dict) -> int:
+    """The stored streak only moves when meals are logged; a missed day means it has lapsed"""
+    last_day = user.get('last_meal_date')
+    if not last_day:
+        return 0
+    yesterday = (date.fromisoformat(local_today(user)) - timedelta(days=1)).isoformat()
+    return user.get('current_streak', 0) if last_day >= yesterday else 0
+
+def streak_update(user_id: str, last_day: str, current: int, longest: int) -> UpdateOne:
+    return UpdateOne(
+        {"user_id": user_id},
+        {"$set": {"last_meal_date": last_day, "current_streak": current, "longest_streak": longest}}
+    )
+
+async def backfill_streaks(only_user_id: Optional[str] = None):
+    """Recompute streaks (every user's, or one user's) in one pass over meals sorted by (user_id, date)"""
+    started = time.perf_counter()
+    users = meals = 0
+    ops = []
+    user_id = last_day = None
+    current = longest = 0
+    query = {"user_id": only_user_id} if only_user_id else {}
+    cursor = meals_collection.find(query, {"_id": 0, "user_id": 1, "date": 1}, batch_size=10000).sort(
+        [("user_id", ASCENDING), ("date", ASCENDING)]
+    )
+    async for meal in cursor:
+        meals += 1
+        if meal['user_id'] != user_id:
+            if user_id is not None:
+                ops.append(streak_update(user_id, last_day, current, longest))
+                users += 1
+            user_id, last_day, current, longest = meal['user_id'], meal['date'], 1, 1
+        elif meal['date'] != last_day:
+            gap = (date.fromisoformat(meal['date']) - date.fromisoformat(last_day)).days
+            current = current + 1 if gap == 1 else 1
+            longest = max(longest, current)
+            last_day = meal['date']
+        if len(ops) >= STREAK_BACKFILL_BATCH:
+            await users_collection.bulk_write(ops, ordered=False)
+            ops = []
+    if user_id is not None:
+        ops.append(streak_update(user_id, last_day, current, longest))
+        users += 1
+    if ops:
+        await users_collection.bulk_write(ops, ordered=False)
+    
+    elapsed = time.perf_counter() - started
+    print(f"Backfilled streaks for {users} users ({meals} meals) in {elapsed:.1f}s, "
+          f"{users / elapsed if elapsed else 0:.0f} users/sec")
+    return users
+
+# Bulk meal import/export. Both directions stream: imports are parsed line by
+# line and written in unordered batches, exports iterate a server-side cursor,
+# so memory stays flat regardless of how long the history is.
+MEAL_IMPORT_BATCH = int(os.environ.get('MEAL_IMPORT_BATCH', 1000))
+MEAL_IMPORT_MAX_ROWS = int(os.environ.get('MEAL_IMPORT_MAX_ROWS', 500000))
+MEAL_IMPORT_MAX_ERRORS = 100
+MEAL_EXPORT_BATCH = 1000
+MEAL_EXPORT_FIELDS = ("meal_id", "date", "created_at", "name", "ingredients", "quantity", *NUTRIENT_FIELDS)
+MEAL_EXPORT_MEDIA_TYPES = {"csv": "text/csv", "ndjson": "application/x-ndjson"}
+
+async def request_lines(request: Request):
+    """Yield (line number, text) from a streamed request body without buffering it"""
+    decoder = codecs.getincrementaldecoder('utf-8-sig')(errors='replace')
+    pending = ""
+    number = 0
+    async for chunk in request.stream():
+        pending += decoder.decode(chunk)
+        *lines, pending = pending.split("\n")
+        for line in lines:
+            number += 1
+            yield number, line.rstrip("\r")
+    pending += decoder.decode(b"", final=True)
+    if pending:
+        yield number + 1, pending.rstrip("\r")
+
+async def import_rows(request: Request, fmt: str):
+    """Yield (line number, row) from a CSV body with a header row, or an NDJSON body"""
+    lines = request_lines(request)
+    if fmt == "ndjson":
+        async for number, line in lines:
+            if line.strip():
+                try:
+                    yield number, json.loads(line)
+                except ValueError:
+                    yield number, None
+        return
+    
+    header = record = None
+    async for number, line in lines:
+        record = line if record is None else f"{record}\n{line}"
+        # A quoted field can span lines; the record is complete once quotes balance
+        if record.count('"') % 2:
+            continue
+        fields = next(csv.reader([record]), [])
+        record = None
+        if header is None:
+            header = [field.strip().lower() for field in fields]
+        elif any(field.strip() for field in fields):
+            yield number, {key: value.strip() or None for key, value in zip(header, fields)}
+
+def imported_meal_doc(user_id: str, row) -> dict:
+    if not isinstance(row, dict):
+        raise ValueError("Row must be a JSON object")
+    meal = MealImport(**row)
+    day = date.fromisoformat(meal.date)
+    created_at = meal.created_at or datetime.combine(day, datetime.min.time(), UTC)
+    return {
+        "meal_id": meal.meal_id or str(uuid.uuid4()),
+        "user_id": user_id,
+        **meal.dict(exclude={"meal_id", "date", "created_at"}),
+        "created_at": created_at if created_at.tzinfo else created_at.replace(tzinfo=UTC),
+        "date": day.isoformat(),
+        "imported": True
+    }
+
+async def write_meal_batch(meals: List[dict]) -> int:
+    """Insert the meals not already stored and fold them into the daily rollups with one bulk write.
+
+    A meal_id the owner already has is skipped, so re-importing an export adds nothing;
+    one that belongs to another user gets a fresh id. Returns the number inserted.
+    """
+    existing = {
+        doc['meal_id']: doc['user_id'] async for doc in meals_collection.find(
+            {"meal_id": {"$in": [meal['meal_id'] for meal in meals]}}, {"_id": 0, "meal_id": 1, "user_id": 1}
+        )
+    }
+    fresh, seen = [], set()
+    for meal in meals:
+        owner = existing.get(meal['meal_id'])
+        if owner == meal['user_id'] or meal['meal_id'] in seen:
+            continue
+        if owner is not None:
+            meal['meal_id'] = str(uuid.uuid4())
+        seen.add(meal['meal_id'])
+        fresh.append(meal)
+    if not fresh:
+        return 0
+    try:
+        await meals_collection.insert_many(fresh, ordered=False)
+    except BulkWriteError as e:
+        # A concurrent import of the same rows got there first; anything else is a real failure
+        errors = e.details['writeErrors']
+        if any(error['code'] != 11000 for error in errors):
+            raise
+        duplicates = {error['index'] for error in errors}
+        fresh = [meal for index, meal in enumerate(fresh) if index not in duplicates]
+        if not fresh:
+            return 0
+    meals = fresh
+    totals = {}
+    for meal in meals:
+        inc = totals.setdefault((meal['user_id'], meal['date']), dict.fromkeys(("meals", *NUTRIENT_FIELDS), 0))
+        inc["meals"] += 1
+        for field in NUTRIENT_FIELDS:
+            inc[field] += meal.get(field) or 0
+    await daily_totals_collection.bulk_write([
+        UpdateOne({"user_id": user_id, "date": day}, {"$inc": inc}, upsert=True)
+        for (user_id, day), inc in totals.items()
+    ], ordered=False)
+    # Imported rows are history, not meals logged today, so they get their own counter
+    count_daily(meals_imported=len(meals))
+    return len(meals)
+
+async def import_meals(user_id: str, rows) -> dict:
+    imported = skipped = failed = 0
+    errors = []
+    batch = []
+    async for number, row in rows:
+        if imported + skipped + failed + len(batch) >= MEAL_IMPORT_MAX_ROWS:
+            errors.append({"line": number, "error": f"Import stopped after {MEAL_IMPORT_MAX_ROWS} rows"})
+            break
+        try:
+            batch.append(imported_meal_doc(user_id, row))
+        except (ValueError, TypeError) as e:
+            failed += 1
+            if len(errors) < MEAL_IMPORT_MAX_ERRORS:
+                errors.append({"line": number, "error": str(e) if row is not None else "Invalid JSON"})
+            continue
+        if len(batch) >= MEAL_IMPORT_BATCH:
+            inserted = await write_meal_batch(batch)
+            imported += inserted
+            skipped += len(batch) - inserted
+            batch = []
+    if batch:
+        inserted = await write_meal_batch(batch)
+        imported += inserted
+        skipped += len(batch) - inserted
+    return {"imported": imported, "skipped": skipped, "failed": failed, "errors": errors}
+
+async def export_meal_chunks(cursor, fmt: str):
+    """Render meals from a cursor as CSV or NDJSON, one chunk per batch"""
+    buffer = StringIO()
+    writer = csv.writer(buffer)
+    if fmt == "csv":
+        writer.writerow(MEAL_EXPORT_FIELDS)
+    rows = 0
+    async for meal in cursor:
+        if fmt == "csv":
+            meal['created_at'] = meal['created_at'].isoformat()
+            writer.writerow([meal.get(field) for field in MEAL_EXPORT_FIELDS])
+        else:
+            buffer.write(json.dumps(jsonable_encoder(meal)) + "\n")
+        rows += 1
+        if rows % MEAL_EXPORT_BATCH == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+# Nutrition insights. A user's history is read from the daily rollups (one row
+# per logged day instead of one per meal), loaded column-wise into pandas, and
+# every statistic is computed with vectorized operations, so even multi-year
+# histories are analysed in a few milliseconds.
+GOAL_FIELDS = {
+    "calories": ("daily_calorie_goal", 2000),
+    "protein": ("daily_protein_goal", 150),
+    "carbs": ("daily_carbs_goal", 250),
+    "fat": ("daily_fat_goal", 70),
+}
+KCAL_PER_GRAM = np.array([4.0, 4.0, 9.0])  # protein, carbs, fat
+GOAL_TOLERANCE = 0.1
+INSIGHT_SERIES_DAYS = 90
+
+def daily_goals(user: dict) -> dict:
+    return {field: user.get(key, default) for field, (key, default) in GOAL_FIELDS.items()}
+
+def rounded(values) -> dict:
+    return {
+        field: None if np.isnan(value) else round(float(value), 1)
+        for field, value in zip(NUTRIENT_FIELDS, values)
+    }
+
+def compute_insights(daily: pd.DataFrame, goals: dict, window: int = 7) -> dict:
+    """Rolling averages, macro split, goal adherence and trends from one user's daily totals
+    (columns date, meals and the nutrient fields)"""
+    if daily.empty:
+        return {"meals_logged": 0, "days_logged": 0}
+    
+    fields = list(NUTRIENT_FIELDS)
+    daily = daily.assign(
+        date=pd.to_datetime(daily['date'], format="%Y-%m-%d"),
+        **{field: daily[field].astype("float64").fillna(0.0) for field in fields}
+    )
+    logged = daily.groupby("date", sort=True)[fields].sum()
+    days = logged.index
+    values = logged.to_numpy()
+    
+    # Unlogged days stay NaN so they don't drag the rolling averages to zero
+    calendar = logged.reindex(pd.date_range(days[0], days[-1], freq="D"))
+    rolling = calendar.rolling(window, min_periods=1).mean().tail(INSIGHT_SERIES_DAYS)
+    
+    energy = (values[:, 1:] * KCAL_PER_GRAM).sum(axis=0)
+    energy_share = energy / energy.sum() if energy.sum() else np.zeros(3)
+    
+    goal_values = np.array([goals[field] or np.nan for field in fields], dtype="float64")
+    ratio = values / goal_values
+    
+    # Least-squares slope of each macro against day number, all columns at once
+    x = ((days - days[0]).days.to_numpy(dtype="float64"))
+    x_centered = x - x.mean()
+    spread = x_centered @ x_centered
+    slopes = (x_centered @ (values - values.mean(axis=0))) / spread if spread else np.full(len(fields), np.nan)
+    
+    return {
+        "meals_logged": int(daily['meals'].sum()),
+        "days_logged": len(days),
+        "from": days[0].date().isoformat(),
+        "to": days[-1].date().isoformat(),
+        "window": window,
+        "averages": rounded(values.mean(axis=0)),
+        "rolling": [
+            {"date": day.date().isoformat(), **rounded(row)}
+            for day, row in zip(rolling.index, rolling.to_numpy())
+        ],
+        "macro_split": {
+            field: round(float(share) * 100, 1) for field, share in zip(fields[1:], energy_share)
+        },
+        "goal_adherence": {
+            "percent_of_goal": rounded(np.nanmean(ratio, axis=0) * 100),
+            "on_target_rate": rounded((np.abs(ratio - 1) <= GOAL_TOLERANCE).mean(axis=0) * 100),
+            "tolerance_percent": GOAL_TOLERANCE * 100
+        },
+        "weekly_trend": rounded(slopes * 7)
+    }
+
+async def load_daily_frame(user_id: str, since: Optional[str] = None) -> pd.DataFrame:
+    query = {"user_id": user_id, "meals": {"$gt": 0}}
+    if since:
+        query["date"] = {"$gte": since}
+    projection = {"_id": 0, "date": 1, "meals": 1, **{field: 1 for field in NUTRIENT_FIELDS}}
+    docs = await daily_totals_collection.find(query, projection).to_list(length=None)
+    return pd.DataFrame.from_records(docs, columns=["date", "meals", *NUTRIENT_FIELDS])
+
+# Recipes. Macros are stored per recipe and per serving; search combines a
+# weighted text index over name/ingredients with per-serving range filters and
+# pages newest-first like every other list.
+RECIPE_LIST_PROJECTION = {"_id": 0, "instructions": 0}
+RECIPE_MAX_SEARCH_TERMS = 10
+
+def recipe_document(recipe: RecipeCreate) -> dict:
+    if recipe.servings < 1:
+        raise HTTPException(status_code=400, detail="servings must be at least 1")
+    return {
+        **recipe.dict(),
+        "per_serving": {
+            field: round(getattr(recipe, field) / recipe.servings, 1) for field in NUTRIENT_FIELDS
+        }
+    }
+
+def recipe_search_query(q: Optional[str], ranges: dict, user_id: Optional[str] = None) -> dict:
+    """Every search term must match; ranges map a macro to (min, max) per serving"""
+    query = {}
+    terms = re.findall(r"\w+", (q or "").lower())[:RECIPE_MAX_SEARCH_TERMS]
+    if terms:
+        # Quoting each term makes $text require all of them instead of any
+        query["$text"] = {"$search": " ".join(f'"{term}"' for term in terms)}
+    for field, (low, high) in ranges.items():
+        bounds = {}
+        if low is not None:
+            bounds["$gte"] = low
+        if high is not None:
+            bounds["$lte"] = high
+        if bounds:
+            query[f"per_serving.{field}"] = bounds
+    if user_id:
+        query["user_id"] = user_id
+    return query
+
+# Ingredient nutrition lookup. foods.csv (macros per 100 g) is built into a
+# read-only SQLite table; food names live in an in-memory trigram index, so
+# free-text ingredients are estimated locally before any vision call.
+NUTRITION_CSV = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'foods.csv')
+NUTRITION_DB = os.environ.get('NUTRITION_DB', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'foods.db'))
+NUTRITION_MIN_SIMILARITY = float(os.environ.get('NUTRITION_MIN_SIMILARITY', 0.55))
+# log_meal only fills in blank macros when at least this share of the ingredients matched
+NUTRITION_AUTOFILL_MIN_COVERAGE = float(os.environ.get('NUTRITION_AUTOFILL_MIN_COVERAGE', 0.8))
+
+# Grams per unit of weight
+UNIT_GRAMS = {
+    "g": 1, "gram": 1, "grams": 1, "kg": 1000,
+    "oz": 28.35, "ounce": 28.35, "ounces": 28.35, "lb": 453.6, "lbs": 453.6, "pound": 453.6, "pounds": 453.6,
+}
+# Millilitres per unit of volume. A volume converts to grams through the food's
+# cup_grams (a cup of rice weighs far less than a cup of water); foods without
+# one can't be measured by volume and are reported as unmatched.
+UNIT_ML = {
+    "ml": 1, "l": 1000, "cup": 240, "cups": 240,
+    "tbsp": 15, "tablespoon": 15, "tablespoons": 15, "tsp": 5, "teaspoon": 5, "teaspoons": 5,
+}
+CUP_ML = 240
+# Count units and sizes scale the food's typical unit weight
+COUNT_UNITS = {
+    "piece": 1, "pieces": 1, "pc": 1, "pcs": 1, "slice": 1, "slices": 1, "serving": 1, "servings": 1,
+    "portion": 1, "portions": 1, "bowl": 1, "bowls": 1, "x": 1,
+    "small": 0.75, "medium": 1, "large": 1.3, "big": 1.3,
+}
+FOOD_DESCRIPTORS = {
+    "grilled", "baked", "boiled", "fried", "roasted", "steamed", "cooked", "raw", "fresh", "frozen",
+    "chopped", "sliced", "diced", "plain", "organic", "lean", "skinless", "boneless", "homemade", "some", "a", "an", "of",
+    "and", "n",
+}
+UNICODE_FRACTIONS = {"½": " 1/2", "¼": " 1/4", "¾": " 3/4", "⅓": " 1/3", "⅔": " 2/3"}
+AMOUNT_PATTERN = re.compile(r"^(\d+\s+\d+/\d+|\d+/\d+|\d+(?:\.\d+)?)\s*")
+INGREDIENT_SEPARATORS = re.compile(r"[,;\n+&]|\band\b|\bwith\b")
+INGREDIENT_JOINER = r"\s*(?:[+&]|\band\b|\bn\b|\bwith\b)\s*"
+
+def build_nutrition_db(csv_path: str = NUTRITION_CSV, db_path: str = NUTRITION_DB) -> int:
+    """(Re)build the SQLite food table from the CSV source, replacing it atomically"""
+    with open(csv_path, newline='', encoding='utf-8') as f:
+        rows = [
+            (row['name'], row['aliases'], float(row['unit_grams']), float(row['cup_grams']) if row['cup_grams'] else None,
+             *(float(row[field]) for field in NUTRIENT_FIELDS))
+            for row in csv.DictReader(f)
+        ]
+    tmp_path = f"{db_path}.tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    conn = sqlite3.connect(tmp_path)
+    with conn:
+        conn.execute(
+            "CREATE TABLE foods (id INTEGER PRIMARY KEY, name TEXT NOT NULL, aliases TEXT NOT NULL, "
+            "unit_grams REAL NOT NULL, cup_grams REAL, calories REAL, protein REAL, carbs REAL, fat REAL)"
+        )
+        conn.executemany(
+            "INSERT INTO foods (name, aliases, unit_grams, cup_grams, calories, protein, carbs, fat) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows
+        )
+    conn.close()
+    os.replace(tmp_path, db_path)
+    return len(rows)
+
+def trigrams(text: str) -> set:
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+def normalize_food_name(text: str) -> str:
+    return " ".join(word for word in re.findall(r"[a-z]+", text.lower()) if word not in FOOD_DESCRIPTORS)
+
+class NutritionIndex:
+    """Fuzzy food-name matcher over the SQLite food table.
+
+    Exact names and aliases resolve through a dict; anything else is scored
+    by the trigrams it shares with a name over the larger of the two trigram
+    sets, so a short word can't match a longer name on a common prefix
+    ("salt" is not "salmon"). Names that contain a separator ("mac and
+    cheese") are kept whole when ingredients are split.
+    """
+
+    def __init__(self):
+        self.conn = None
+        self.exact = {}
+        self.names = []
+        self.postings = {}
+        self.compounds = None
+
+    def load(self, db_path: str):
+        conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True, check_same_thread=False)
+        exact, names, postings, compounds = {}, [], {}, []
+        for food_id, name, aliases in conn.execute("SELECT id, name, aliases FROM foods"):
+            for variant in [name, *filter(None, aliases.split('|'))]:
+                if INGREDIENT_SEPARATORS.search(variant):
+                    pieces = [re.escape(piece.strip()) for piece in INGREDIENT_SEPARATORS.split(variant.lower())]
+                    compounds.append(INGREDIENT_JOINER.join(pieces))
+                variant = normalize_food_name(variant)
+                exact.setdefault(variant, food_id)
+                grams = trigrams(variant)
+                for gram in grams:
+                    postings.setdefault(gram, []).append(len(names))
+                names.append((food_id, len(grams)))
+        self.conn, self.exact, self.names, self.postings = conn, exact, names, postings
+        # Longest first, so the regex prefers the most specific compound name
+        self.compounds = re.compile(
+            rf"\b(?:{'|'.join(sorted(compounds, key=len, reverse=True))})\b", re.IGNORECASE
+        ) if compounds else None
+
+    def split(self, text: str) -> List[str]:
+        """Split free text into ingredients, except at separators inside a known food name"""
+        protected = [match.span() for match in self.compounds.finditer(text)] if self.compounds else []
+        parts, start = [], 0
+        for separator in INGREDIENT_SEPARATORS.finditer(text):
+            if any(low <= separator.start() < high for low, high in protected):
+                continue
+            parts.append(text[start:separator.start()])
+            start = separator.end()
+        parts.append(text[start:])
+        return [part.strip() for part in parts if part.strip()]
+
+    def match(self, text: str):
+        """Return (food_id, similarity) for the closest food name, or None"""
+        name = normalize_food_name(text)
+        if not name:
+            return None
+        for candidate in (name, name[:-2] if name.endswith("es") else None, name[:-1] if name.endswith("s") else None):
+            if candidate in self.exact:
+                return self.exact[candidate], 1.0
+
+        grams = trigrams(name)
+        shared = Counter()
+        for gram in grams:
+            shared.update(self.postings.get(gram, ()))
+        best = None
+        for entry, count in shared.items():
+            food_id, size = self.names[entry]
+            score = count / max(len(grams), size)
+            if best is None or score > best[1]:
+                best = (food_id, score)
+        return best if best and best[1] >= NUTRITION_MIN_SIMILARITY else None
+
+    def foods(self, food_ids) -> dict:
+        ids = list(set(food_ids))
+        if not ids:
+            return {}
+        rows = self.conn.execute(
+            f"SELECT id, name, unit_grams, cup_grams, calories, protein, carbs, fat FROM foods WHERE id IN ({','.join('?' * len(ids))})", ids
+        )
+        return {
+            row[0]: {"name": row[1], "unit_grams": row[2], "cup_grams": row[3], **dict(zip(NUTRIENT_FIELDS, row[4:]))}
+            for row in rows
+        }
+
+nutrition_index = NutritionIndex()
+
+@app.on_event("startup")
+async def load_nutrition_index():
+    """Build the food table if the CSV is newer, then index its names"""
+    try:
+        if not os.path.exists(NUTRITION_DB) or os.path.getmtime(NUTRITION_DB) < os.path.getmtime(NUTRITION_CSV):
+            await asyncio.to_thread(build_nutrition_db)
+        await asyncio.to_thread(nutrition_index.load, NUTRITION_DB)
+    except Exception as e:
+        print(f"Nutrition database load failed: {e}")
+
+def parse_amount(text: str) -> float:
+    whole, _, fraction = text.rpartition(" ") if "/" in text else ("", "", text)
+    if "/" in fraction:
+        numerator, denominator = fraction.split("/")
+        value = int(numerator) / int(denominator) if int(denominator) else 0.0
+    else:
+        value = float(fraction)
+    return value + (int(whole) if whole else 0)
+
+def parse_ingredient(text: str):
+    """Split '1 1/2 cups cooked rice' into (amount, grams per unit or None, millilitres per unit
+    or None, size multiplier, food text)"""
+    text = text.strip().lower()
+    for symbol, replacement in UNICODE_FRACTIONS.items():
+        text = text.replace(symbol, replacement)
+    text = text.strip()
+    amount = None
+    match = AMOUNT_PATTERN.match(text)
+    if match:
+        amount = parse_amount(match.group(1))
+        text = text[match.end():]
+    unit_grams, unit_ml, size = None, None, 1.0
+    while match := re.match(r"([a-z]+)\.?(?:\s+|$)", text):
+        word = match.group(1)
+        if word in UNIT_GRAMS and unit_grams is None and unit_ml is None:
+            unit_grams = UNIT_GRAMS[word]
+        elif word in UNIT_ML and unit_grams is None and unit_ml is None:
+            unit_ml = UNIT_ML[word]
+        elif word in COUNT_UNITS:
+            size *= COUNT_UNITS[word]
+        else:
+            break
+        text = text[match.end():]
+    return amount, unit_grams, unit_ml, size, text.strip()
+
+def estimate_nutrition(ingredients: str, quantity: Optional[str] = None) -> dict:
+    """Estimate macros for free-text ingredients from the local food table"""
+    parts = nutrition_index.split(ingredients or "")
+    parsed = [parse_ingredient(part) for part in parts]
+    scale = 1.0
+    if quantity:
+        amount, unit_grams, unit_ml, size, rest = parse_ingredient(quantity)
+        if len(parsed) == 1 and parsed[0][0] is None and parsed[0][1] is None and parsed[0][2] is None:
+            # A lone ingredient takes the meal quantity as its own amount
+            parsed[0] = (amount, unit_grams, unit_ml, parsed[0][3] * size, parsed[0][4])
+        elif amount is not None and unit_grams is None and unit_ml is None:
+            # "2 servings" of a multi-ingredient meal scales the whole estimate
+            scale = amount * size
+
+    matches = [nutrition_index.match(food) for *_, food in parsed]
+    foods = nutrition_index.foods(match[0] for match in matches if match)
+    items, unmatched = [], []
+    totals = dict.fromkeys(NUTRIENT_FIELDS, 0.0)
+    for text, (amount, unit_grams, unit_ml, size, _), match in zip(parts, parsed, matches):
+        food = foods[match[0]] if match else None
+        if food is None or (unit_ml is not None and food['cup_grams'] is None):
+            unmatched.append(text)
+            continue
+        if unit_ml is not None:
+            unit_grams = unit_ml * food['cup_grams'] / CUP_ML
+        grams = (amount if amount is not None else 1) * (unit_grams or food['unit_grams'] * size) * scale
+        item = {"text": text, "food": food['name'], "grams": round(grams, 1), "similarity": round(match[1], 2)}
+        for field in NUTRIENT_FIELDS:
+            value = food[field] * grams / 100
+            item[field] = round(value, 1)
+            totals[field] += value
+        items.append(item)
 
-def create_jwt_token(user_id: str) -> str:
-    payload = {
-        'user_id': user_id,
-        'exp': datetime.now(UTC) + timedelta(days=7)
+    return {
+        "items": items,
+        "unmatched": unmatched,
+        "totals": {field: round(value, 1) for field, value in totals.items()},
+        "coverage": round(len(items) / len(parts), 2) if parts else 0.0,
+        "source": "nutrition_db"
     }
-    return jwt.encode(payload, JWT_SECRET, algorithm='HS256')
 
-def verify_jwt_token(token: str) -> str:
-    try:
-        payload = jwt.decode(token, JWT_SECRET, algorithms=['HS256'])
-        return payload['user_id']
-    except:
-        raise HTTPException(status_code=401, detail="Invalid token")
+RECIPE_RANGE_KEYS = [(f"per_serving.{field}", ASCENDING) for field in NUTRIENT_FIELDS]
 
-async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
-    user_id = verify_jwt_token(credentials.credentials)
-    user = users_collection.find_one({"user_id": user_id})
-    if not user:
-        raise HTTPException(status_code=401, detail="User not found")
-    return user
+# Index management. Every query a route issues must be served by one of these;
+# tests/test_indexes.py keeps a sample of each query shape, explains it against
+# these indexes and fails on COLLSCAN or on a blocking sort of a keyset page.
+REQUIRED_INDEXES = {
+    # Equality, then the newest-first sort, then the macro ranges: pages come out of the
+    # index in order and range misses are rejected on index keys without a fetch or sort
+    recipes_collection: [
+        IndexModel([("recipe_id", ASCENDING)], unique=True),
+        IndexModel([("created_at", DESCENDING), ("recipe_id", DESCENDING), *RECIPE_RANGE_KEYS]),
+        IndexModel([("user_id", ASCENDING), ("created_at", DESCENDING), ("recipe_id", DESCENDING), *RECIPE_RANGE_KEYS]),
+        IndexModel(
+            [("name", TEXT), ("ingredients", TEXT)],
+            weights={"name": 5, "ingredients": 1},
+            name="recipe_text"
+        ),
+    ],
+    meals_collection: [
+        IndexModel([("meal_id", ASCENDING)], unique=True),
+        IndexModel([("user_id", ASCENDING), ("date", ASCENDING), ("created_at", DESCENDING)]),
+        IndexModel([("user_id", ASCENDING), ("created_at", DESCENDING), ("meal_id", DESCENDING)]),
+    ],
+    users_collection: [
+        IndexModel([("user_id", ASCENDING)], unique=True),
+        IndexModel([("email", ASCENDING)], unique=True),
+    ],
+    follows_collection: [
+        IndexModel([("follower_id", ASCENDING), ("followee_id", ASCENDING)], unique=True),
+        IndexModel([("followee_id", ASCENDING), ("created_at", DESCENDING), ("follower_id", DESCENDING)]),
+        IndexModel([("follower_id", ASCENDING), ("created_at", DESCENDING), ("followee_id", DESCENDING)]),
+        IndexModel([("follower_id", ASCENDING)], name="follower_id_fanout_on_read",
+                   partialFilterExpression={"fanout_on_read": True}),
+    ],
+    comments_collection: [
+        IndexModel([("comment_id", ASCENDING)], unique=True),
+        IndexModel([("post_id", ASCENDING), ("created_at", DESCENDING), ("comment_id", DESCENDING)]),
+    ],
+    likes_collection: [
+        IndexModel([("post_id", ASCENDING), ("user_id", ASCENDING)], unique=True),
+    ],
+    daily_totals_collection: [
+        IndexModel([("user_id", ASCENDING), ("date", ASCENDING)], unique=True),
+    ],
+    daily_stats_collection: [
+        IndexModel([("date", ASCENDING)], unique=True),
+    ],
+    timelines_collection: [
+        IndexModel([("user_id", ASCENDING)], unique=True),
+    ],
+    # Keyset pages sort on (created_at, id), so the id is part of every listing index
+    posts_collection: [
+        IndexModel([("post_id", ASCENDING)], unique=True),
+        IndexModel([("user_id", ASCENDING), ("created_at", DESCENDING), ("post_id", DESCENDING)]),
+        IndexModel([("created_at", DESCENDING), ("post_id", DESCENDING)]),
+    ],
+    analysis_cache_collection: [
+        IndexModel([("key", ASCENDING)], unique=True),
+        IndexModel([("expires_at", ASCENDING)], expireAfterSeconds=0),
+    ],
+    analysis_cache_stats_collection: [
+        IndexModel([("date", ASCENDING)], unique=True),
+    ],
+    meal_phash_collection: [
+        IndexModel([("phash", ASCENDING), ("name_key", ASCENDING)], unique=True),
+    ],
+    analysis_jobs_collection: [
+        IndexModel([("job_id", ASCENDING)], unique=True),
+        IndexModel([("created_at", ASCENDING)], expireAfterSeconds=ANALYSIS_JOB_TTL),
+        IndexModel([("status", ASCENDING), ("updated_at", ASCENDING)]),
+    ],
+}
 
-async def analyze_meal_with_ai(image_data: str, meal_name: str = None) -> dict:
-    """Analyze meal using OpenRouter GPT-4o vision"""
-    try:
-        headers = {
-            "Authorization": f"Bearer {OPENROUTER_API_KEY}",
-            "Content-Type": "application/json"
-        }
-        
-        prompt = f"""Analyze this meal image and provide detailed nutritional information. 
-        {'The user says this is: ' + meal_name if meal_name else ''}
-        
-        Please provide:
-        1. Meal name/description
-        2. Estimated calories
-        3. Protein (grams)
-        4. Carbohydrates (grams)
-        5. Fat (grams)
-        6. Brief ingredient list
-        7. Confidence level (1-10)
-        
-        Return as JSON format:
-        {{
-            "name": "meal name",
-            "calories": 500,
-            "protein": 25.5,
-            "carbs": 45.2,
-            "fat": 18.3,
-            "ingredients": "chicken breast, rice, vegetables",
-            "confidence": 8
-        }}"""
-        
-        payload = {
-            "model": "openai/gpt-4o",
-            "messages": [
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "text", "text": prompt},
-                        {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{image_data}"}}
-                    ]
-                }
-            ],
-            "max_tokens": 500,
-            "temperature": 0.3
-        }
-        
-        response = requests.post(f"{OPENROUTER_BASE_URL}/chat/completions", headers=headers, json=payload)
-        
-        if response.status_code == 200:
-            result = response.json()
-            content = result['choices'][0]['message']['content']
-            
-            # Extract JSON from response
-            try:
-                # Try to parse as JSON directly
-                meal_data = json.loads(content)
-                return meal_data
-            except:
-                # If not JSON, create a structured response
-                return {
-                    "name": meal_name or "Unknown meal",
-                    "calories": 400,
-                    "protein": 20.0,
-                    "carbs": 30.0,
-                    "fat": 15.0,
-                    "ingredients": "Could not analyze ingredients",
-                    "confidence": 5
-                }
-        else:
-            raise Exception(f"API call failed: {response.status_code}")
-            
-    except Exception as e:
-        print(f"AI Analysis error: {e}")
-        return {
-            "name": meal_name or "Unknown meal",
-            "calories": 400,
-            "protein": 20.0,
-            "carbs": 30.0,
-            "fat": 15.0,
-            "ingredients": "Could not analyze ingredients",
-            "confidence": 1
-        }
+@app.on_event("startup")
+async def ensure_indexes(database=None):
+    """Create declared indexes (in `database` if given); a no-op for ones that already exist"""
+    for collection, indexes in REQUIRED_INDEXES.items():
+        if database is not None:
+            collection = database[collection.name]
+        try:
+            await collection.create_indexes(indexes)
+        except Exception as e:
+            print(f"Index creation failed for {collection.name}: {e}")
 
-# Profile endpoints
-@app.get("/api/profile/{user_id}")
-async def get_user_profile(user_id: str, current_user: dict = Depends(get_current_user)):
-    """Get user profile by ID"""
-    user = users_collection.find_one({"user_id": user_id}, {"password": 0})
+# Response caches for read-heavy shared endpoints. Only the viewer-independent
+# part of a response is cached; per-viewer fields (liked_by_me, is_following) are
+# added on every request. Writes invalidate this worker's entries, other workers
+# catch up within the TTL. Responses carry weak ETags for conditional requests.
+RESPONSE_CACHE_TTL = float(os.environ.get('RESPONSE_CACHE_TTL', 5))
+discover_cache = ResponseCache(RESPONSE_CACHE_TTL, 256)
+profile_cache = ResponseCache(RESPONSE_CACHE_TTL, int(os.environ.get('PROFILE_CACHE_MAX_ENTRIES', 10000)))
+
+def invalidate_post_caches(user_id: str):
+    discover_cache.clear()
+    profile_cache.invalidate(user_id)
+
+def etag_response(request: Request, payload) -> Response:
+    """JSON response with a weak ETag, or an empty 304 if the client's copy is current.
+
+    A response model payload is validated and rendered by pydantic-core, as FastAPI
+    would for a route's response_model; the ETag is taken over exactly those bytes.
+    """
+    body = payload.model_dump_json().encode() if isinstance(payload, BaseModel) else orjson.dumps(payload)
+    etag = f'W/"{hashlib.blake2b(body, digest_size=16).hexdigest()}"'
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    candidates = {tag.strip().removeprefix("W/") for tag in request.headers.get("if-none-match", "").split(",")}
+    if etag.removeprefix("W/") in candidates or "*" in candidates:
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+async def load_profile(user_id: str) -> dict:
+    user = await users_collection.find_one({"user_id": user_id}, {"_id": 0, "password": 0})
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
     # Get user's recent posts
-    recent_posts = list(posts_collection.find(
+    recent_posts = await posts_collection.find(
         {"user_id": user_id},
-        {"_id": 0}
-    ).sort("created_at", -1).limit(10))
+        POST_LIST_PROJECTION
+    ).sort("created_at", -1).limit(10).to_list(length=10)
     
     # Get user's meal history summary
-    recent_meals = list(meals_collection.find(
+    recent_meals = await meals_collection.find(
         {"user_id": user_id},
-        {"_id": 0}
-    ).sort("created_at", -1).limit(5))
+        MEAL_LIST_PROJECTION
+    ).sort("created_at", -1).limit(5).to_list(length=5)
     
-    return {
+    return {"user": user, "recent_posts": recent_posts, "recent_meals": recent_meals}
+
+# Profile endpoints
+@app.get("/api/profile/{user_id}")
+async def get_user_profile(user_id: str, request: Request, current_user: dict = Depends(get_current_user)):
+    """Get user profile by ID"""
+    profile = await profile_cache.get_or_load(user_id, lambda: load_profile(user_id))
+    user = with_pending_counts(profile['user'])
+    recent_posts = await annotate_liked_by_me([dict(post) for post in profile['recent_posts']], current_user['user_id'])
+    
+    return etag_response(request, {
         "user_id": user['user_id'],
         "name": user['name'],
         "email": user['email'],
         "goal": user['goal'],
         "bio": user.get('bio', ''),
-        "followers": len(user.get('followers', [])),
-        "following": len(user.get('following', [])),
+        "followers": user.get('followers_count', 0),
+        "following": user.get('following_count', 0),
         "posts_count": user.get('posts_count', 0),
-        "current_streak": user.get('current_streak', 0),
+        "likes_received": user.get('likes_received', 0),
+        "current_streak": current_streak(user),
         "longest_streak": user.get('longest_streak', 0),
         "created_at": user['created_at'],
         "recent_posts": recent_posts,
-        "recent_meals": recent_meals,
-        "is_following": user_id in current_user.get('following', []),
-        "daily_goals": {
-            "calories": user.get('daily_calorie_goal', 2000),
-            "protein": user.get('daily_protein_goal', 150),
-            "carbs": user.get('daily_carbs_goal', 250),
-            "fat": user.get('daily_fat_goal', 70)
-        }
-    }
+        "recent_meals": profile['recent_meals'],
+        "is_following": bool(await follows_collection.find_one(
+            {"follower_id": current_user['user_id'], "followee_id": user_id}, {"_id": 1}
+        )),
+        "daily_goals": daily_goals(user)
+    })
 
 @app.put("/api/profile")
 async def update_profile(profile_data: ProfileUpdate, current_user: dict = Depends(get_current_user)):
     """Update user profile"""
     update_data = {k: v for k, v in profile_data.dict().items() if v is not None}
+    if 'timezone' in update_data:
+        validate_timezone(update_data['timezone'])
     
     if update_data:
-        users_collection.update_one(
+        await users_collection.update_one(
             {"user_id": current_user['user_id']},
             {"$set": update_data}
         )
+        user_cache.invalidate(current_user['user_id'])
+        profile_cache.invalidate(current_user['user_id'])
     
     return {"message": "Profile updated successfully"}
 
 @app.post("/api/profile/follow/{user_id}")
-async def follow_user(user_id: str, current_user: dict = Depends(get_current_user)):
-    """Follow or unfollow a user"""
-    if user_id == current_user['user_id']:
+async def follow_user(user_id: str, following: Optional[bool] = None, current_user: dict = Depends(get_current_user)):
+    """Set the follow state with following=true/false (idempotent), or toggle it when omitted"""
+    follower_id = current_user['user_id']
+    if user_id == follower_id:
         raise HTTPException(status_code=400, detail="Cannot follow yourself")
     
-    target_user = users_collection.find_one({"user_id": user_id})
-    if not target_user:
-        raise HTTPException(status_code=404, detail="User not found")
-    
-    current_following = current_user.get('following', [])
-    
-    if user_id in current_following:
-        # Unfollow
-        users_collection.update_one(
-            {"user_id": current_user['user_id']},
-            {"$pull": {"following": user_id}}
-        )
-        users_collection.update_one(
-            {"user_id": user_id},
-            {"$pull": {"followers": current_user['user_id']}}
-        )
-        return {"message": "User unfollowed", "is_following": False}
-    else:
-        # Follow
-        users_collection.update_one(
-            {"user_id": current_user['user_id']},
-            {"$push": {"following": user_id}}
+    changed = False
+    if following is None:
+        changed = await set_follow(follower_id, user_id, False)
+        following = not changed
+    if following:
+        # Cached principals carry fanout_on_read too, so a warm cache skips this lookup.
+        # _id is projected because most users have no fanout_on_read, and {} would read as missing.
+        target_user = user_cache.get(user_id) or await users_collection.find_one(
+            {"user_id": user_id}, {"_id": 1, "fanout_on_read": 1}
         )
-        users_collection.update_one(
-            {"user_id": user_id},
-            {"$push": {"followers": current_user['user_id']}}
-        )
-        return {"message": "User followed", "is_following": True}
+        if not target_user:
+            raise HTTPException(status_code=404, detail="User not found")
+        changed = await set_follow(follower_id, user_id, True, target_user.get('fanout_on_read', False))
+    elif not changed:
+        changed = await set_follow(follower_id, user_id, False)
+    
+    if changed:
+        user_cache.invalidate(follower_id, user_id)
+        profile_cache.invalidate(follower_id, user_id)
+        if not following:
+            await timelines_collection.update_one({"user_id": follower_id}, {"$pull": {"entries": {"author_id": user_id}}})
+        elif not target_user.get('fanout_on_read'):
+            await backfill_timeline(follower_id, user_id)
+        await publish_event([f"user:{user_id}"], {"type": "follow", "user_id": follower_id, "following": following})
+    return {"message": "User followed" if following else "User unfollowed", "is_following": following}
 
 @app.get("/api/profile/followers/{user_id}")
-async def get_followers(user_id: str, current_user: dict = Depends(get_current_user)):
-    """Get user's followers"""
-    user = users_collection.find_one({"user_id": user_id})
-    if not user:
+async def get_followers(user_id: str, cursor: Optional[str] = None, limit: int = 50, current_user: dict = Depends(get_current_user)):
+    """Get user's followers, most recent first"""
+    if not await users_collection.find_one({"user_id": user_id}, {"_id": 1}):
         raise HTTPException(status_code=404, detail="User not found")
     
-    followers = []
-    for follower_id in user.get('followers', []):
-        follower = users_collection.find_one(
-            {"user_id": follower_id},
-            {"user_id": 1, "name": 1, "goal": 1}
-        )
-        if follower:
-            followers.append(follower)
-    
-    return {"followers": followers}
+    followers, next_cursor = await list_follow_users(
+        {"followee_id": user_id}, "follower_id", cursor, clamp_page_size(limit)
+    )
+    return {"followers": followers, "next_cursor": next_cursor}
 
 @app.get("/api/profile/following/{user_id}")
-async def get_following(user_id: str, current_user: dict = Depends(get_current_user)):
-    """Get users that this user is following"""
-    user = users_collection.find_one({"user_id": user_id})
-    if not user:
+async def get_following(user_id: str, cursor: Optional[str] = None, limit: int = 50, current_user: dict = Depends(get_current_user)):
+    """Get users that this user is following, most recent first"""
+    if not await users_collection.find_one({"user_id": user_id}, {"_id": 1}):
         raise HTTPException(status_code=404, detail="User not found")
     
-    following = []
-    for following_id in user.get('following', []):
-        following_user = users_collection.find_one(
-            {"user_id": following_id},
-            {"user_id": 1, "name": 1, "goal": 1}
-        )
-        if following_user:
-            following.append(following_user)
-    
-    return {"following": following}
+    following, next_cursor = await list_follow_users(
+        {"follower_id": user_id}, "followee_id", cursor, clamp_page_size(limit)
+    )
+    return {"following": following, "next_cursor": next_cursor}
 
 # Authentication endpoints
 @app.post("/api/auth/signup")
 async def signup(user: UserSignup):
     # Check if user exists
-    if users_collection.find_one({"email": user.email}):
+    if await users_collection.find_one({"email": user.email}):
         raise HTTPException(status_code=400, detail="Email already registered")
     
+    if user.timezone:
+        validate_timezone(user.timezone)
+    
     # Create user
     user_id = str(uuid.uuid4())
-    hashed_password = hash_password(user.password)
+    hashed_password = await password_executor.run(hash_password, user.password)
     
     user_doc = {
         "user_id": user_id,
@@ -361,10 +2546,12 @@ async def signup(user: UserSignup):
         "name": user.name,
         "password": hashed_password,
         "goal": user.goal,
+        "timezone": user.timezone or "UTC",
         "created_at": datetime.now(UTC),
-        "followers": [],
-        "following": [],
+        "followers_count": 0,
+        "following_count": 0,
         "posts_count": 0,
+        "likes_received": 0,
         "current_streak": 0,
         "longest_streak": 0,
         "daily_calorie_goal": 2000,
@@ -373,7 +2560,7 @@ async def signup(user: UserSignup):
         "daily_fat_goal": 70
     }
     
-    users_collection.insert_one(user_doc)
+    await users_collection.insert_one(user_doc)
     token = create_jwt_token(user_id)
     
     return {"token": token, "user": {
@@ -385,8 +2572,8 @@ async def signup(user: UserSignup):
 
 @app.post("/api/auth/login")
 async def login(user: UserLogin):
-    user_doc = users_collection.find_one({"email": user.email})
-    if not user_doc or not verify_password(user.password, user_doc['password']):
+    user_doc = await users_collection.find_one({"email": user.email})
+    if not user_doc or not await password_executor.run(verify_password, user.password, user_doc['password']):
         raise HTTPException(status_code=401, detail="Invalid credentials")
     
     token = create_jwt_token(user_doc['user_id'])
@@ -399,19 +2586,29 @@ async def login(user: UserLogin):
 
 @app.get("/api/auth/me")
 async def get_current_user_info(current_user: dict = Depends(get_current_user)):
+    current_user = with_pending_counts(current_user)
     return {
         "user_id": current_user['user_id'],
         "email": current_user['email'],
         "name": current_user['name'],
         "goal": current_user['goal'],
-        "followers": len(current_user.get('followers', [])),
-        "following": len(current_user.get('following', [])),
+        "followers": current_user.get('followers_count', 0),
+        "following": current_user.get('following_count', 0),
         "posts_count": current_user.get('posts_count', 0),
-        "current_streak": current_user.get('current_streak', 0),
+        "likes_received": current_user.get('likes_received', 0),
+        "current_streak": current_streak(current_user),
         "longest_streak": current_user.get('longest_streak', 0)
     }
 
 # Meal tracking endpoints
+def estimated_macros(ingredients: str, quantity: Optional[str]) -> Optional[dict]:
+    """Macros from the local food table, or None if too many ingredients went unmatched
+    for the totals to mean anything"""
+    estimate = estimate_nutrition(ingredients, quantity)
+    if not estimate['items'] or estimate['coverage'] < NUTRITION_AUTOFILL_MIN_COVERAGE:
+        return None
+    return {**estimate['totals'], "calories": round(estimate['totals']['calories']), "estimated": True}
+
 @app.post("/api/meals/log")
 async def log_meal(meal: MealLog, current_user: dict = Depends(get_current_user)):
     meal_id = str(uuid.uuid4())
@@ -426,71 +2623,95 @@ async def log_meal(meal: MealLog, current_user: dict = Depends(get_current_user)
         "carbs": meal.carbs,
         "fat": meal.fat,
         "created_at": datetime.now(UTC),
-        "date": datetime.now(UTC).strftime("%Y-%m-%d")
+        "date": local_today(current_user)
     }
+    # Fill in macros the client left out from the local food table
+    if meal.ingredients and all(meal_doc[field] is None for field in NUTRIENT_FIELDS):
+        meal_doc.update(estimated_macros(meal.ingredients, meal.quantity) or {})
     
-    meals_collection.insert_one(meal_doc)
+    await meals_collection.insert_one(meal_doc)
+    await apply_meal_to_rollup(meal_doc)
+    await record_meal_day(current_user['user_id'], meal_doc['date'])
+    profile_cache.invalidate(current_user['user_id'])
+    count_daily(meals_logged=1)
     return {"meal_id": meal_id, "message": "Meal logged successfully"}
 
-@app.post("/api/meals/analyze")
+@app.post("/api/meals/estimate")
+async def estimate_meal(request: NutritionEstimate, current_user: dict = Depends(get_current_user)):
+    """Estimate macros for free-text ingredients without calling the vision model"""
+    if nutrition_index.conn is None:
+        raise HTTPException(status_code=503, detail="Nutrition database unavailable")
+    return estimate_nutrition(request.ingredients, request.quantity)
+
+@app.post("/api/meals/analyze", status_code=202)
 async def analyze_meal_photo(file: UploadFile = File(...), current_user: dict = Depends(get_current_user)):
-    if not file.content_type.startswith('image/'):
-        raise HTTPException(status_code=400, detail="File must be an image")
-    
-    # Read and encode image
-    image_data = await file.read()
-    image_base64 = base64.b64encode(image_data).decode('utf-8')
-    
-    # Analyze with AI
-    analysis = await analyze_meal_with_ai(image_base64, file.filename)
-    
-    # Save analyzed meal
-    meal_id = str(uuid.uuid4())
-    meal_doc = {
-        "meal_id": meal_id,
-        "user_id": current_user['user_id'],
-        "name": analysis.get('name', 'Unknown meal'),
-        "ingredients": analysis.get('ingredients', ''),
-        "calories": analysis.get('calories', 0),
-        "protein": analysis.get('protein', 0),
-        "carbs": analysis.get('carbs', 0),
-        "fat": analysis.get('fat', 0),
-        "confidence": analysis.get('confidence', 5),
-        "created_at": datetime.now(UTC),
-        "date": datetime.now(UTC).strftime("%Y-%m-%d"),
-        "analyzed_by_ai": True
-    }
-    
-    meals_collection.insert_one(meal_doc)
+    """Queue a meal photo for analysis and return a job id to poll or stream"""
+    # Downscale up front: vision models don't need full resolution and queued jobs stay small
+    image_data = await ingest_image(file, ANALYSIS_IMAGE_MAX_DIM)
+    job_id = await enqueue_analysis_job(current_user['user_id'], local_today(current_user), image_data, file.filename)
     
     return {
-        "meal_id": meal_id,
-        "analysis": analysis,
-        "message": "Meal analyzed and logged successfully"
+        "job_id": job_id,
+        "status": "queued",
+        "message": "Meal queued for analysis"
     }
 
+@app.get("/api/meals/analyze/{job_id}")
+async def get_analysis_job(job_id: str, current_user: dict = Depends(get_current_user)):
+    """Poll the status of a queued meal analysis"""
+    job = await analysis_jobs_collection.find_one(
+        {"job_id": job_id, "user_id": current_user['user_id']},
+        ANALYSIS_JOB_PROJECTION
+    )
+    if not job:
+        raise HTTPException(status_code=404, detail="Analysis job not found")
+    return job
+
+@app.get("/api/meals/analyze/{job_id}/events")
+async def stream_analysis_job(job_id: str, current_user: dict = Depends(get_current_user)):
+    """Stream analysis job status changes as Server-Sent Events"""
+    user_id = current_user['user_id']
+    if not await analysis_jobs_collection.find_one({"job_id": job_id, "user_id": user_id}, {"_id": 1}):
+        raise HTTPException(status_code=404, detail="Analysis job not found")
+
+    async def events():
+        last_status = None
+        while True:
+            job = await analysis_jobs_collection.find_one(
+                {"job_id": job_id, "user_id": user_id},
+                ANALYSIS_JOB_PROJECTION
+            )
+            if job and job['status'] != last_status:
+                last_status = job['status']
+                yield f"event: {last_status}\ndata: {json.dumps(jsonable_encoder(job))}\n\n"
+            if not job or last_status in ("done", "failed"):
+                return
+            await wait_for_analysis_job(job_id, ANALYSIS_JOB_POLL_INTERVAL)
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+@app.get("/api/meals/analysis-cache/stats")
+async def get_analysis_cache_stats(days: int = 7, current_user: dict = Depends(get_current_user)):
+    """Daily hit rate and estimated latency saved by the meal analysis cache"""
+    return {"days": await analysis_cache.report(min(max(days, 1), 90))}
+
 @app.get("/api/meals/today")
 async def get_today_meals(current_user: dict = Depends(get_current_user)):
-    today = datetime.now(UTC).strftime("%Y-%m-%d")
-    meals = list(meals_collection.find(
+    today = local_today(current_user)
+    meals = await meals_collection.find(
         {"user_id": current_user['user_id'], "date": today},
-        {"_id": 0}
-    ).sort("created_at", -1))
+        MEAL_LIST_PROJECTION
+    ).sort("created_at", -1).to_list(length=None)
     
-    # Calculate totals
-    total_calories = sum(meal.get('calories', 0) for meal in meals)
-    total_protein = sum(meal.get('protein', 0) for meal in meals)
-    total_carbs = sum(meal.get('carbs', 0) for meal in meals)
-    total_fat = sum(meal.get('fat', 0) for meal in meals)
+    # Totals come from the day's rollup rather than re-summing every meal
+    totals = await daily_totals_collection.find_one(
+        {"user_id": current_user['user_id'], "date": today},
+        {"_id": 0}
+    ) or {}
     
     return {
         "meals": meals,
-        "totals": {
-            "calories": total_calories,
-            "protein": total_protein,
-            "carbs": total_carbs,
-            "fat": total_fat
-        },
+        "totals": {field: totals.get(field, 0) for field in NUTRIENT_FIELDS},
         "goals": {
             "calories": current_user.get('daily_calorie_goal', 2000),
             "protein": current_user.get('daily_protein_goal', 150),
@@ -499,18 +2720,153 @@ async def get_today_meals(current_user: dict = Depends(get_current_user)):
         }
     }
 
-@app.get("/api/meals/history")
-async def get_meal_history(current_user: dict = Depends(get_current_user)):
-    meals = list(meals_collection.find(
-        {"user_id": current_user['user_id']},
+@app.get("/api/meals/history", response_model=MealPage)
+async def get_meal_history(cursor: Optional[str] = None, limit: int = 50, current_user: dict = Depends(get_current_user)):
+    meals, next_cursor = await paginate(
+        meals_collection, {"user_id": current_user['user_id']}, "meal_id", cursor, clamp_page_size(limit), MEAL_LIST_PROJECTION
+    )
+    
+    return {"meals": meals, "next_cursor": next_cursor}
+
+@app.put("/api/meals/{meal_id}")
+async def update_meal(meal_id: str, meal: MealLog, current_user: dict = Depends(get_current_user)):
+    """Update the fields the client sent on a logged meal, keeping its day's totals in step"""
+    query = {"meal_id": meal_id, "user_id": current_user['user_id']}
+    current = await meals_collection.find_one(query, {"_id": 0})
+    if not current:
+        raise HTTPException(status_code=404, detail="Meal not found")
+    
+    changes = meal.dict(exclude_unset=True)
+    unset = {}
+    if any(field in changes for field in NUTRIENT_FIELDS):
+        # Macros the client entered are no longer an estimate
+        unset["estimated"] = ""
+    elif current.get('estimated') and any(field in changes for field in ("ingredients", "quantity")):
+        # Re-estimate for the new ingredients; stale estimates are cleared rather than kept
+        merged = {**current, **changes}
+        estimate = merged.get('ingredients') and estimated_macros(merged['ingredients'], merged.get('quantity'))
+        if estimate:
+            changes.update(estimate)
+        else:
+            changes.update(dict.fromkeys(NUTRIENT_FIELDS))
+            unset["estimated"] = ""
+    
+    update = {"$set": {**changes, "updated_at": datetime.now(UTC)}}
+    if unset:
+        update["$unset"] = unset
+    old_meal = await meals_collection.find_one_and_update(query, update, projection={"_id": 0})
+    if not old_meal:
+        raise HTTPException(status_code=404, detail="Meal not found")
+    
+    await apply_meal_to_rollup(old_meal, -1)
+    await apply_meal_to_rollup({**old_meal, **changes})
+    profile_cache.invalidate(current_user['user_id'])
+    
+    return {"message": "Meal updated successfully"}
+
+@app.delete("/api/meals/{meal_id}")
+async def delete_meal(meal_id: str, current_user: dict = Depends(get_current_user)):
+    """Delete a logged meal and remove it from its day's totals"""
+    meal = await meals_collection.find_one_and_delete(
+        {"meal_id": meal_id, "user_id": current_user['user_id']},
+        projection={"_id": 0}
+    )
+    if not meal:
+        raise HTTPException(status_code=404, detail="Meal not found")
+    
+    await apply_meal_to_rollup(meal, -1)
+    profile_cache.invalidate(current_user['user_id'])
+    
+    return {"message": "Meal deleted successfully"}
+
+@app.get("/api/meals/summary")
+async def get_meal_summary(
+    from_date: Optional[str] = Query(None, alias="from"),
+    to_date: Optional[str] = Query(None, alias="to"),
+    granularity: str = "day",
+    current_user: dict = Depends(get_current_user)
+):
+    """Nutrition totals per day, week (starting Monday) or month, read from daily rollups"""
+    if granularity not in ("day", "week", "month"):
+        raise HTTPException(status_code=400, detail="granularity must be day, week or month")
+    try:
+        end = date.fromisoformat(to_date or local_today(current_user))
+        start = date.fromisoformat(from_date) if from_date else end - timedelta(days=29)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Dates must be YYYY-MM-DD")
+    if start > end or (end - start).days >= SUMMARY_MAX_DAYS:
+        raise HTTPException(status_code=400, detail=f"Range must be between 1 and {SUMMARY_MAX_DAYS} days")
+    
+    rows = await daily_totals_collection.find(
+        {"user_id": current_user['user_id'], "date": {"$gte": start.isoformat(), "$lte": end.isoformat()}},
         {"_id": 0}
-    ).sort("created_at", -1).limit(50))
+    ).sort("date", 1).to_list(length=None)
+    
+    buckets = {}
+    for row in rows:
+        if not row.get('meals'):
+            continue
+        period = summary_period(row['date'], granularity)
+        bucket = buckets.setdefault(period, {"period": period, "meals": 0, "days_logged": 0, **{f: 0 for f in NUTRIENT_FIELDS}})
+        bucket['meals'] += row['meals']
+        bucket['days_logged'] += 1
+        for field in NUTRIENT_FIELDS:
+            bucket[field] += row.get(field, 0)
+    
+    return {
+        "from": start.isoformat(),
+        "to": end.isoformat(),
+        "granularity": granularity,
+        "buckets": list(buckets.values())
+    }
+
+@app.get("/api/meals/insights")
+async def get_meal_insights(window: int = 7, days: Optional[int] = None, current_user: dict = Depends(get_current_user)):
+    """Rolling averages, macro split, goal adherence and trends over the meal history"""
+    if not 1 <= window <= 90:
+        raise HTTPException(status_code=400, detail="window must be between 1 and 90 days")
+    since = None
+    if days is not None:
+        if days < 1:
+            raise HTTPException(status_code=400, detail="days must be positive")
+        since = (date.fromisoformat(local_today(current_user)) - timedelta(days=days - 1)).isoformat()
+    
+    daily = await load_daily_frame(current_user['user_id'], since)
+    return await asyncio.to_thread(compute_insights, daily, daily_goals(current_user), window)
+
+@app.post("/api/meals/import")
+async def import_meal_history(request: Request, format: Optional[str] = None, current_user: dict = Depends(get_current_user)):
+    """Bulk-import meals from a streamed CSV (header row first) or NDJSON body"""
+    fmt = format or ("ndjson" if "json" in request.headers.get("content-type", "") else "csv")
+    if fmt not in MEAL_EXPORT_MEDIA_TYPES:
+        raise HTTPException(status_code=400, detail="format must be csv or ndjson")
     
-    return {"meals": meals}
+    result = await import_meals(current_user['user_id'], import_rows(request, fmt))
+    if result['imported']:
+        await backfill_streaks(current_user['user_id'])
+        user_cache.invalidate(current_user['user_id'])
+    return result
+
+@app.get("/api/meals/export")
+async def export_meal_history(format: str = "csv", current_user: dict = Depends(get_current_user)):
+    """Stream the full meal history, oldest first, as CSV or NDJSON"""
+    if format not in MEAL_EXPORT_MEDIA_TYPES:
+        raise HTTPException(status_code=400, detail="format must be csv or ndjson")
+    
+    cursor = meals_collection.find(
+        {"user_id": current_user['user_id']}, {"_id": 0, "user_id": 0}, batch_size=MEAL_EXPORT_BATCH
+    ).sort("created_at", 1)
+    return StreamingResponse(
+        export_meal_chunks(cursor, format),
+        media_type=MEAL_EXPORT_MEDIA_TYPES[format],
+        headers={"Content-Disposition": f'attachment; filename="eatflex-meals.{format}"'}
+    )
 
 # Basic social endpoints
 @app.post("/api/posts/create")
 async def create_post(post: PostCreate, current_user: dict = Depends(get_current_user)):
+    if post.image_url and post.image_url[:5].lower() == 'data:':
+        raise HTTPException(status_code=400, detail="Upload the image with /api/posts/temp/upload-image first")
     post_id = str(uuid.uuid4())
     post_doc = {
         "post_id": post_id,
@@ -518,68 +2874,89 @@ async def create_post(post: PostCreate, current_user: dict = Depends(get_current
         "author_name": current_user['name'],
         "content": post.content,
         "image_url": post.image_url,
+        "image_thumbnails": post_image_thumbnails(post.image_url) if post.image_url else None,
         "meal_id": post.meal_id,
-        "likes": [],
-        "comments": [],
+        "like_count": 0,
+        "comment_count": 0,
         "created_at": datetime.now(UTC)
     }
     
-    posts_collection.insert_one(post_doc)
+    await posts_collection.insert_one(post_doc)
+    await fan_out_post(current_user, post_doc)
     
-    # Update user posts count
-    users_collection.update_one(
-        {"user_id": current_user['user_id']},
-        {"$inc": {"posts_count": 1}}
-    )
+    counters.incr(users_collection, {"user_id": current_user['user_id']}, {"posts_count": 1})
+    count_daily(posts=1)
+    invalidate_post_caches(current_user['user_id'])
     
     return {"post_id": post_id, "message": "Post created successfully"}
 
-@app.get("/api/posts/feed")
-async def get_feed(current_user: dict = Depends(get_current_user)):
-    """Get personalized feed based on following"""
-    following = current_user.get('following', [])
+@app.get("/api/posts/feed", response_model=PostPage)
+async def get_feed(cursor: Optional[str] = None, limit: int = 20, current_user: dict = Depends(get_current_user)):
+    """Get personalized feed from the materialized timeline"""
+    limit = clamp_page_size(limit)
+    if cursor and cursor.startswith(GLOBAL_FEED_CURSOR_PREFIX):
+        return await global_feed_page(current_user['user_id'], cursor.removeprefix(GLOBAL_FEED_CURSOR_PREFIX), limit)
     
-    # Include own posts and posts from followed users
-    user_ids = following + [current_user['user_id']]
+    entries = await read_timeline_page(current_user['user_id'], cursor, limit + 1)
+    if entries is None:
+        entries = await rebuild_timeline(current_user)
+        if cursor:
+            created_at, post_id = decode_cursor(cursor)
+            entries = [e for e in entries if (e['created_at'], e['post_id']) < (created_at, post_id)]
+        entries = entries[:limit + 1]
+    # (created_at, post_id, post if already loaded) for everything this page could show
+    candidates = {entry['post_id']: (entry['created_at'], entry['post_id'], None) for entry in entries}
     
-    posts = list(posts_collection.find(
-        {"user_id": {"$in": user_ids}} if user_ids else {},
-        {"_id": 0}
-    ).sort("created_at", -1).limit(20))
+    # Merge in recent posts from followed high-follower accounts, which skip fan-out
+    celebrities = await follows_collection.find(
+        {"follower_id": current_user['user_id'], "fanout_on_read": True},
+        {"_id": 0, "followee_id": 1}
+    ).to_list(length=None)
+    if celebrities:
+        celebrity_posts, _ = await paginate(
+            posts_collection,
+            {"user_id": {"$in": [edge['followee_id'] for edge in celebrities]}},
+            "post_id", cursor, limit + 1, POST_LIST_PROJECTION
+        )
+        candidates.update((post['post_id'], (post['created_at'], post['post_id'], post)) for post in celebrity_posts)
     
     # If no personalized posts, show global feed
-    if not posts:
-        posts = list(posts_collection.find(
-            {},
-            {"_id": 0}
-        ).sort("created_at", -1).limit(20))
+    if not candidates and not cursor:
+        return await global_feed_page(current_user['user_id'], None, limit)
     
-    return {"posts": posts}
+    ordered = sorted(candidates.values(), key=lambda candidate: candidate[:2], reverse=True)
+    page = ordered[:limit]
+    # The cursor follows what was read, so deleted posts can't end the feed early
+    next_cursor = encode_cursor(*page[-1][:2]) if len(ordered) > limit else None
+    loaded = {post['post_id']: post for post in await load_posts_in_order([c[1] for c in page if c[2] is None])}
+    posts = [post or loaded[post_id] for _, post_id, post in page if post or post_id in loaded]
+    return {"posts": await annotate_liked_by_me(posts, current_user['user_id']), "next_cursor": next_cursor}
 
-@app.get("/api/posts/discover")
-async def get_discover_feed(current_user: dict = Depends(get_current_user)):
+@app.get("/api/posts/discover", response_model=PostPage)
+async def get_discover_feed(request: Request, cursor: Optional[str] = None, limit: int = 50, current_user: dict = Depends(get_current_user)):
     """Get discover feed with all posts"""
-    posts = list(posts_collection.find(
-        {},
-        {"_id": 0}
-    ).sort("created_at", -1).limit(50))
+    limit = clamp_page_size(limit)
+    posts, next_cursor = await discover_cache.get_or_load(
+        (cursor, limit),
+        lambda: paginate(posts_collection, {}, "post_id", cursor, limit, POST_LIST_PROJECTION)
+    )
+    posts = await annotate_liked_by_me([dict(post) for post in posts], current_user['user_id'])
     
-    return {"posts": posts}
+    return etag_response(request, PostPage(posts=posts, next_cursor=next_cursor))
 
-@app.get("/api/posts/user/{user_id}")
-async def get_user_posts(user_id: str, current_user: dict = Depends(get_current_user)):
+@app.get("/api/posts/user/{user_id}", response_model=PostPage)
+async def get_user_posts(user_id: str, cursor: Optional[str] = None, limit: int = 20, current_user: dict = Depends(get_current_user)):
     """Get posts from a specific user"""
-    posts = list(posts_collection.find(
-        {"user_id": user_id},
-        {"_id": 0}
-    ).sort("created_at", -1).limit(20))
+    posts, next_cursor = await paginate(
+        posts_collection, {"user_id": user_id}, "post_id", cursor, clamp_page_size(limit), POST_LIST_PROJECTION
+    )
     
-    return {"posts": posts}
+    return {"posts": await annotate_liked_by_me(posts, current_user['user_id']), "next_cursor": next_cursor}
 
 @app.post("/api/posts/share-meal/{meal_id}")
 async def share_meal_as_post(meal_id: str, current_user: dict = Depends(get_current_user)):
     """Share a meal as a post"""
-    meal = meals_collection.find_one({"meal_id": meal_id, "user_id": current_user['user_id']})
+    meal = await meals_collection.find_one({"meal_id": meal_id, "user_id": current_user['user_id']})
     if not meal:
         raise HTTPException(status_code=404, detail="Meal not found")
     
@@ -591,186 +2968,373 @@ async def share_meal_as_post(meal_id: str, current_user: dict = Depends(get_curr
         "content": f"Just had {meal['name']}! 🍽️\n\n📊 Nutrition:\n• {meal.get('calories', 0)} calories\n• {meal.get('protein', 0)}g protein\n• {meal.get('carbs', 0)}g carbs\n• {meal.get('fat', 0)}g fat",
         "image_url": None,
         "meal_id": meal_id,
-        "likes": [],
-        "comments": [],
+        "like_count": 0,
+        "comment_count": 0,
         "created_at": datetime.now(UTC)
     }
     
-    posts_collection.insert_one(post_doc)
+    await posts_collection.insert_one(post_doc)
+    await fan_out_post(current_user, post_doc)
     
-    # Update user posts count
-    users_collection.update_one(
-        {"user_id": current_user['user_id']},
-        {"$inc": {"posts_count": 1}}
-    )
+    counters.incr(users_collection, {"user_id": current_user['user_id']}, {"posts_count": 1})
+    count_daily(posts=1)
+    invalidate_post_caches(current_user['user_id'])
     
     return {"post_id": post_id, "message": "Meal shared successfully"}
 
 @app.post("/api/posts/{post_id}/like")
-async def like_post(post_id: str, current_user: dict = Depends(get_current_user)):
-    post = posts_collection.find_one({"post_id": post_id})
-    if not post:
-        raise HTTPException(status_code=404, detail="Post not found")
-    
-    likes = post.get('likes', [])
+async def like_post(post_id: str, liked: Optional[bool] = None, current_user: dict = Depends(get_current_user)):
+    """Set the like state with liked=true/false (idempotent), or toggle it when omitted"""
     user_id = current_user['user_id']
-    
-    if user_id in likes:
-        # Unlike
-        posts_collection.update_one(
-            {"post_id": post_id},
-            {"$pull": {"likes": user_id}}
-        )
-        return {"message": "Post unliked"}
-    else:
-        # Like
-        posts_collection.update_one(
-            {"post_id": post_id},
-            {"$push": {"likes": user_id}}
+    changed, liked, author_id = await set_like(post_id, user_id, liked)
+    if changed:
+        counters.incr(users_collection, {"user_id": author_id}, {"likes_received": 1 if liked else -1})
+        if liked:
+            count_daily(likes=1)
+        await publish_event(
+            [f"post:{post_id}", f"user:{author_id}"],
+            {"type": "like", "post_id": post_id, "user_id": user_id, "liked": liked}
         )
-        return {"message": "Post liked"}
+    return {"message": "Post liked" if liked else "Post unliked", "liked": liked}
 
 @app.post("/api/posts/{post_id}/comment")
 async def comment_on_post(post_id: str, comment: CommentCreate, current_user: dict = Depends(get_current_user)):
     """Add a comment to a post"""
-    post = posts_collection.find_one({"post_id": post_id})
+    post = await posts_collection.find_one({"post_id": post_id}, {"_id": 0, "user_id": 1})
     if not post:
         raise HTTPException(status_code=404, detail="Post not found")
     
     comment_doc = {
         "comment_id": str(uuid.uuid4()),
+        "post_id": post_id,
         "user_id": current_user['user_id'],
         "author_name": current_user['name'],
         "content": comment.content,
         "created_at": datetime.now(UTC)
     }
     
-    posts_collection.update_one(
-        {"post_id": post_id},
-        {"$push": {"comments": comment_doc}}
+    await comments_collection.insert_one(comment_doc)
+    await posts_collection.update_one({"post_id": post_id}, {"$inc": {"comment_count": 1}})
+    await publish_event(
+        [f"post:{post_id}", f"user:{post['user_id']}"],
+        {"type": "comment", "comment": {field: comment_doc[field] for field in CommentOut.model_fields if field in comment_doc}}
     )
     
-    return {"message": "Comment added successfully"}
+    return {"comment_id": comment_doc['comment_id'], "message": "Comment added successfully"}
 
-@app.get("/api/posts/{post_id}/comments")
-async def get_post_comments(post_id: str, current_user: dict = Depends(get_current_user)):
-    """Get comments for a specific post"""
-    post = posts_collection.find_one({"post_id": post_id})
-    if not post:
+@app.get("/api/posts/{post_id}/comments", response_model=CommentPage)
+async def get_post_comments(post_id: str, cursor: Optional[str] = None, limit: int = 50, current_user: dict = Depends(get_current_user)):
+    """Get comments for a specific post, newest first"""
+    comments, next_cursor = await paginate(
+        comments_collection, {"post_id": post_id}, "comment_id", cursor, clamp_page_size(limit), COMMENT_LIST_PROJECTION
+    )
+    if not comments and not cursor and not await posts_collection.find_one({"post_id": post_id}, {"_id": 1}):
         raise HTTPException(status_code=404, detail="Post not found")
     
-    comments = post.get('comments', [])
-    return {"comments": comments}
+    return {"comments": comments, "next_cursor": next_cursor}
 
 @app.post("/api/posts/temp/upload-image")
 async def upload_temp_image(file: UploadFile = File(...), current_user: dict = Depends(get_current_user)):
-    """Upload a temporary image for posts"""
-    if not file.content_type.startswith('image/'):
-        raise HTTPException(status_code=400, detail="File must be an image")
-    
-    # Create a unique filename
-    import base64
-    import os
+    """Upload an image for a post and return its URL and thumbnail URLs"""
+    image_data = await ingest_image(file, POST_IMAGE_MAX_DIM)
+    urls = await store_post_image(image_data)
     
-    # Read file content
-    file_content = await file.read()
-    
-    # Convert to base64 for storage (in production, use cloud storage)
-    encoded_image = base64.b64encode(file_content).decode('utf-8')
-    
-    # Create data URL for immediate use
-    image_url = f"data:{file.content_type};base64,{encoded_image}"
-    
-    return {"image_url": image_url}
+    return {
+        "image_url": urls['lg'],
+        "thumbnails": {name: url for name, url in urls.items() if name != 'lg'}
+    }
+
+@app.get("/api/images/{key:path}")
+async def get_image(key: str):
+    """Serve a stored image (public, since <img> tags can't send auth headers)"""
+    if not BLOB_KEY_PATTERN.match(key):
+        raise HTTPException(status_code=404, detail="Image not found")
+    data = await blob_store.get(key)
+    if data is None:
+        raise HTTPException(status_code=404, detail="Image not found")
+    return Response(content=data, media_type="image/jpeg", headers={"Cache-Control": "public, max-age=31536000, immutable"})
 
 @app.put("/api/posts/{post_id}")
 async def update_post(post_id: str, post_update: PostUpdate, current_user: dict = Depends(get_current_user)):
     """Update a post"""
-    post = posts_collection.find_one({"post_id": post_id, "user_id": current_user['user_id']})
+    post = await posts_collection.find_one({"post_id": post_id, "user_id": current_user['user_id']})
     if not post:
         raise HTTPException(status_code=404, detail="Post not found or you don't have permission")
     
-    posts_collection.update_one(
+    await posts_collection.update_one(
         {"post_id": post_id},
         {"$set": {"content": post_update.content, "updated_at": datetime.now(UTC)}}
     )
+    invalidate_post_caches(current_user['user_id'])
     
     return {"message": "Post updated successfully"}
 
 @app.delete("/api/posts/{post_id}")
 async def delete_post(post_id: str, current_user: dict = Depends(get_current_user)):
     """Delete a post"""
-    post = posts_collection.find_one({"post_id": post_id, "user_id": current_user['user_id']})
+    post = await posts_collection.find_one({"post_id": post_id, "user_id": current_user['user_id']})
     if not post:
         raise HTTPException(status_code=404, detail="Post not found or you don't have permission")
     
-    posts_collection.delete_one({"post_id": post_id})
+    await posts_collection.delete_one({"post_id": post_id})
+    await comments_collection.delete_many({"post_id": post_id})
+    await likes_collection.delete_many({"post_id": post_id})
     
-    # Update user posts count
-    users_collection.update_one(
+    counters.incr(
+        users_collection,
         {"user_id": current_user['user_id']},
-        {"$inc": {"posts_count": -1}}
+        {"posts_count": -1, "likes_received": -post.get('like_count', 0)}
     )
+    invalidate_post_caches(current_user['user_id'])
     
     return {"message": "Post deleted successfully"}
 
 @app.put("/api/posts/{post_id}/comments/{comment_id}")
 async def update_comment(post_id: str, comment_id: str, comment_update: CommentUpdate, current_user: dict = Depends(get_current_user)):
     """Update a comment"""
-    post = posts_collection.find_one({"post_id": post_id})
-    if not post:
-        raise HTTPException(status_code=404, detail="Post not found")
-    
-    # Check if user owns the comment
-    comment_found = False
-    for comment in post.get('comments', []):
-        if comment['comment_id'] == comment_id and comment['user_id'] == current_user['user_id']:
-            comment_found = True
-            break
-    
-    if not comment_found:
-        raise HTTPException(status_code=404, detail="Comment not found or you don't have permission")
-    
-    posts_collection.update_one(
-        {"post_id": post_id, "comments.comment_id": comment_id},
-        {"$set": {"comments.$.content": comment_update.content, "comments.$.updated_at": datetime.now(UTC)}}
+    result = await comments_collection.update_one(
+        {"comment_id": comment_id, "post_id": post_id, "user_id": current_user['user_id']},
+        {"$set": {"content": comment_update.content, "updated_at": datetime.now(UTC)}}
     )
+    if not result.matched_count:
+        raise HTTPException(status_code=404, detail="Comment not found or you don't have permission")
     
     return {"message": "Comment updated successfully"}
 
 @app.delete("/api/posts/{post_id}/comments/{comment_id}")
 async def delete_comment(post_id: str, comment_id: str, current_user: dict = Depends(get_current_user)):
     """Delete a comment"""
-    post = posts_collection.find_one({"post_id": post_id})
-    if not post:
-        raise HTTPException(status_code=404, detail="Post not found")
+    result = await comments_collection.delete_one(
+        {"comment_id": comment_id, "post_id": post_id, "user_id": current_user['user_id']}
+    )
+    if not result.deleted_count:
+        raise HTTPException(status_code=404, detail="Comment not found or you don't have permission")
     
-    # Check if user owns the comment
-    comment_found = False
-    for comment in post.get('comments', []):
-        if comment['comment_id'] == comment_id and comment['user_id'] == current_user['user_id']:
-            comment_found = True
-            break
+    await posts_collection.update_one({"post_id": post_id}, {"$inc": {"comment_count": -1}})
     
-    if not comment_found:
-        raise HTTPException(status_code=404, detail="Comment not found or you don't have permission")
+    return {"message": "Comment deleted successfully"}
+
+# Recipe endpoints
+@app.post("/api/recipes")
+async def create_recipe(recipe: RecipeCreate, current_user: dict = Depends(get_current_user)):
+    """Create a recipe"""
+    recipe_id = str(uuid.uuid4())
+    await recipes_collection.insert_one({
+        "recipe_id": recipe_id,
+        "user_id": current_user['user_id'],
+        "user_name": current_user['name'],
+        **recipe_document(recipe),
+        "created_at": datetime.now(UTC)
+    })
     
-    posts_collection.update_one(
-        {"post_id": post_id},
-        {"$pull": {"comments": {"comment_id": comment_id}}}
+    return {"recipe_id": recipe_id, "message": "Recipe created successfully"}
+
+@app.get("/api/recipes/search")
+async def search_recipes(
+    q: Optional[str] = None,
+    min_calories: Optional[float] = None,
+    max_calories: Optional[float] = None,
+    min_protein: Optional[float] = None,
+    max_protein: Optional[float] = None,
+    min_carbs: Optional[float] = None,
+    max_carbs: Optional[float] = None,
+    min_fat: Optional[float] = None,
+    max_fat: Optional[float] = None,
+    user_id: Optional[str] = None,
+    cursor: Optional[str] = None,
+    limit: int = DEFAULT_RECIPE_PAGE_SIZE,
+    current_user: dict = Depends(get_current_user)
+):
+    """Search recipes by name/ingredients and per-serving macro ranges, newest first"""
+    query = recipe_search_query(q, {
+        "calories": (min_calories, max_calories),
+        "protein": (min_protein, max_protein),
+        "carbs": (min_carbs, max_carbs),
+        "fat": (min_fat, max_fat),
+    }, user_id)
+    recipes, next_cursor = await paginate(
+        recipes_collection, query, "recipe_id", cursor, clamp_page_size(limit), RECIPE_LIST_PROJECTION
     )
     
-    return {"message": "Comment deleted successfully"}
+    return {"recipes": recipes, "next_cursor": next_cursor}
+
+@app.get("/api/recipes/{recipe_id}")
+async def get_recipe(recipe_id: str, current_user: dict = Depends(get_current_user)):
+    """Get a recipe"""
+    recipe = await recipes_collection.find_one({"recipe_id": recipe_id}, {"_id": 0})
+    if not recipe:
+        raise HTTPException(status_code=404, detail="Recipe not found")
+    return recipe
+
+@app.put("/api/recipes/{recipe_id}")
+async def update_recipe(recipe_id: str, recipe: RecipeCreate, current_user: dict = Depends(get_current_user)):
+    """Update a recipe"""
+    result = await recipes_collection.update_one(
+        {"recipe_id": recipe_id, "user_id": current_user['user_id']},
+        {"$set": {**recipe_document(recipe), "updated_at": datetime.now(UTC)}}
+    )
+    if not result.matched_count:
+        raise HTTPException(status_code=404, detail="Recipe not found or you don't have permission")
+    
+    return {"message": "Recipe updated successfully"}
+
+@app.delete("/api/recipes/{recipe_id}")
+async def delete_recipe(recipe_id: str, current_user: dict = Depends(get_current_user)):
+    """Delete a recipe"""
+    result = await recipes_collection.delete_one({"recipe_id": recipe_id, "user_id": current_user['user_id']})
+    if not result.deleted_count:
+        raise HTTPException(status_code=404, detail="Recipe not found or you don't have permission")
+    
+    return {"message": "Recipe deleted successfully"}
+
+# Push endpoints. Browsers can't set headers on WebSocket/EventSource connections,
+# so both take a push token from /api/events/token as a query parameter. It is only
+# checked when connecting; clients fetch a fresh one each time they reconnect.
+@app.post("/api/events/token")
+async def create_push_connection_token(current_user: dict = Depends(get_current_user)):
+    """Short-lived token that only opens push connections"""
+    return {"token": create_push_token(current_user['user_id']), "expires_in": PUSH_TOKEN_TTL}
+
+@app.websocket("/api/ws")
+async def push_websocket(websocket: WebSocket, token: str):
+    """Push feed and engagement events; clients send {"action": "subscribe"|"unsubscribe", "post_id": ...}"""
+    try:
+        user = await load_principal(token, scope="push")
+    except HTTPException:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    await websocket.accept()
+    subscription = push_broker.subscribe(await push_topics(user['user_id']))
+    
+    async def receive():
+        try:
+            while True:
+                try:
+                    message = json.loads(await websocket.receive_text())
+                except ValueError:
+                    continue
+                if not isinstance(message, dict):
+                    continue
+                topic = f"post:{message.get('post_id')}"
+                if message.get('action') == "subscribe":
+                    if sum(t.startswith("post:") for t in subscription.topics) < PUSH_MAX_POST_TOPICS:
+                        push_broker.add_topic(subscription, topic)
+                elif message.get('action') == "unsubscribe":
+                    push_broker.remove_topic(subscription, topic)
+        except WebSocketDisconnect:
+            pass
+        finally:
+            subscription.close()
+    
+    receiver = asyncio.create_task(receive())
+    try:
+        while True:
+            try:
+                payload = await asyncio.wait_for(subscription.queue.get(), PUSH_HEARTBEAT_INTERVAL)
+            except asyncio.TimeoutError:
+                payload = PUSH_PING
+            if payload is None:
+                break
+            # Awaiting the send is the backpressure: a slow client fills its own buffer, not ours
+            await websocket.send_text(payload)
+    except WebSocketDisconnect:
+        pass
+    finally:
+        receiver.cancel()
+        push_broker.unsubscribe(subscription)
+
+@app.get("/api/events")
+async def push_events(token: str, post_ids: Optional[str] = None):
+    """Server-Sent Events version of the push channel; post_ids is a comma-separated list"""
+    user = await load_principal(token, scope="push")
+    topics = await push_topics(user['user_id'])
+    topics += [f"post:{post_id}" for post_id in (post_ids or "").split(",")[:PUSH_MAX_POST_TOPICS] if post_id]
+    
+    async def events():
+        subscription = push_broker.subscribe(topics)
+        try:
+            yield "retry: 5000\n\n"
+            while True:
+                try:
+                    payload = await asyncio.wait_for(subscription.queue.get(), PUSH_HEARTBEAT_INTERVAL)
+                except asyncio.TimeoutError:
+                    yield ": ping\n\n"
+                    continue
+                yield f"data: {payload}\n\n"
+        finally:
+            push_broker.unsubscribe(subscription)
+    
+    return StreamingResponse(
+        events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
 
 # Health check
 @app.get("/api/health")
 async def health_check():
     return {"status": "healthy", "app": "EatFlex API"}
 
+@app.get("/api/metrics/caches")
+async def get_cache_metrics(current_user: dict = Depends(get_current_user)):
+    """Hit rates of this worker's in-process caches"""
+    return {
+        "user_principals": user_cache.stats(),
+        "discover": discover_cache.stats(),
+        "profiles": profile_cache.stats()
+    }
+
+@app.get("/api/metrics/counters")
+async def get_counter_metrics(current_user: dict = Depends(get_current_user)):
+    """Write-behind counter buffer on this worker"""
+    return counters.stats()
+
+@app.get("/api/metrics/daily")
+async def get_daily_metrics(days: int = 7, current_user: dict = Depends(get_current_user)):
+    """App-wide meals logged and imported, posts and likes per UTC day"""
+    days = min(max(days, 1), 90)
+    rows = await daily_stats_collection.find({}, {"_id": 0}).sort("date", -1).limit(days).to_list(length=days)
+    today = datetime.now(UTC).strftime("%Y-%m-%d")
+    if not rows or rows[0]['date'] != today:
+        rows = [{"date": today}, *rows][:days]
+    return {"days": [
+        {"meals_logged": 0, "meals_imported": 0, "posts": 0, "likes": 0, **counters.overlay(daily_stats_collection, {"date": row['date']}, row)}
+        for row in rows
+    ]}
+
+@app.get("/api/metrics/push")
+async def get_push_metrics(current_user: dict = Depends(get_current_user)):
+    """Open push connections, subscribed topics and buffer drops on this worker"""
+    return {
+        "connections": push_broker.connections,
+        "topics": len(push_broker.topics),
+        "dropped": push_broker.dropped,
+        "rss_bytes": process_rss()
+    }
+
 @app.get("/")
 async def root():
     return {"message": "Welcome to the EatFlex API"}
 
+# Shutdown happens in one hook so the order is explicit: everything that may still
+# write (analysis jobs marking themselves failed, the push relay, buffered counters)
+# stops before the clients it writes through are closed.
+SHUTDOWN_STEPS = [
+    stop_analysis_workers,
+    stop_push_broker,
+    counters.stop,
+    close_openrouter_client,
+    stop_password_executor,
+    close_mongo_connection,
+]
+
+@app.on_event("shutdown")
+async def shutdown():
+    for step in SHUTDOWN_STEPS:
+        try:
+            await step()
+        except Exception as e:
+            # Keep going so one failure can't skip the steps after it
+            print(f"Shutdown step failed: {e}")
+
 if __name__ == "__main__":
     import uvicorn
     port = int(os.environ.get('PORT', 8001))
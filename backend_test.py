@@ -8,6 +8,7 @@ import requests
 import sys
 import json
 import base64
+import time
 from datetime import datetime
 import os
 
@@ -142,15 +143,23 @@ class EatFlexAPITester:
     def test_ai_meal_analysis(self):
         """Test AI meal analysis with a sample image"""
         # Create a simple test image (1x1 pixel PNG)
-        test_image_data = base64.b64decode('iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNkYPhfDwAChAI9jU77mgAAAABJRU5ErkJggg==')
+        test_image_data = base64.b64decode('iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAIAAACQd1PeAAAADElEQVR4nGM4UaEBAAN0AWnL+tDXAAAAAElFTkSuQmCC')
         
         files = {
             'file': ('test_meal.png', test_image_data, 'image/png')
         }
         
-        success, response, status = self.api_call('POST', '/api/meals/analyze', files=files)
+        success, response, status = self.api_call('POST', '/api/meals/analyze', files=files, expected_status=202)
         
-        if success and 'analysis' in response:
+        # Analysis runs as a background job; poll until it completes
+        if success and 'job_id' in response:
+            for _ in range(30):
+                success, response, status = self.api_call('GET', f"/api/meals/analyze/{response['job_id']}")
+                if not success or response.get('status') in ('done', 'failed'):
+                    break
+                time.sleep(1)
+        
+        if success and response.get('status') == 'done':
             analysis = response['analysis']
             return self.log_test("AI Meal Analysis", True, f"Analyzed: {analysis.get('name')}, Calories: {analysis.get('calories')}")
         else:
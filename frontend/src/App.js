@@ -6,6 +6,9 @@ import './components.css';
 
 const API_BASE_URL = process.env.REACT_APP_API_URL || 'http://127.0.0.1:8001';
 
+// Images stored by the backend come back as API-relative paths
+const resolveImageUrl = (url) => (url && url.startsWith('/') ? `${API_BASE_URL}${url}` : url);
+
 function App() {
   const [user, setUser] = useState(null);
   const [token, setToken] = useState(localStorage.getItem('token'));
@@ -20,6 +23,7 @@ function App() {
   // New social features states
   const [newPost, setNewPost] = useState({ content: '', image: null });
   const [showComments, setShowComments] = useState({});
+  const [postComments, setPostComments] = useState({});
   const [newComment, setNewComment] = useState({});
   const [editingPost, setEditingPost] = useState({});
   const [editingComment, setEditingComment] = useState({});
@@ -89,6 +93,58 @@ function App() {
     }
   }, [token]);
 
+  // Live updates pushed by the server: new feed posts, likes and comments. Open comment
+  // threads are subscribed to so their likes and comments arrive too.
+  const userId = user?.user_id;
+  const openThreads = Object.keys(showComments).filter(postId => showComments[postId]).sort().slice(0, 50).join(',');
+  useEffect(() => {
+    if (!token || !userId) return undefined;
+    let source = null;
+    let retry = null;
+    let closed = false;
+    const connect = async () => {
+      try {
+        // A short-lived push token goes in the URL, never the session token
+        const { token: pushToken } = await apiCall('/api/events/token', { method: 'POST' });
+        if (closed) return;
+        const params = new URLSearchParams({ token: pushToken });
+        if (openThreads) params.set('post_ids', openThreads);
+        source = new EventSource(`${API_BASE_URL}/api/events?${params}`);
+      } catch (error) {
+        retry = setTimeout(connect, 5000);
+        return;
+      }
+      source.onmessage = (message) => {
+        const event = JSON.parse(message.data);
+        if (event.type === 'post') {
+          setPosts(prev => prev.some(post => post.post_id === event.post.post_id) ? prev : [event.post, ...prev]);
+        } else if (event.type === 'resync') {
+          loadFeed();
+        } else if (event.type === 'like' && event.user_id !== userId) {
+          setPosts(prev => prev.map(post => post.post_id === event.post_id
+            ? { ...post, like_count: (post.like_count || 0) + (event.liked ? 1 : -1) }
+            : post));
+        } else if (event.type === 'comment') {
+          const { comment } = event;
+          setPostComments(prev => prev[comment.post_id] && !prev[comment.post_id].some(c => c.comment_id === comment.comment_id)
+            ? { ...prev, [comment.post_id]: [...prev[comment.post_id], comment] }
+            : prev);
+        }
+      };
+      source.onerror = () => {
+        // The push token has expired by the time EventSource would retry, so reconnect with a fresh one
+        source.close();
+        retry = setTimeout(connect, 5000);
+      };
+    };
+    connect();
+    return () => {
+      closed = true;
+      clearTimeout(retry);
+      if (source) source.close();
+    };
+  }, [token, userId, openThreads]);
+
   const loadUserData = async () => {
     try {
       const userData = await apiCall('/api/auth/me');
@@ -135,7 +191,11 @@ function App() {
         headers: {
           'Content-Type': 'application/json',
         },
-        body: JSON.stringify(authForm)
+        body: JSON.stringify(
+          authMode === 'login'
+            ? authForm
+            : { ...authForm, timezone: Intl.DateTimeFormat().resolvedOptions().timeZone }
+        )
       });
       
       console.log('Response status:', response.status);
@@ -178,10 +238,11 @@ function App() {
         method: 'POST',
         body: JSON.stringify({
           ...mealForm,
-          calories: parseInt(mealForm.calories) || 0,
-          protein: parseFloat(mealForm.protein) || 0,
-          carbs: parseFloat(mealForm.carbs) || 0,
-          fat: parseFloat(mealForm.fat) || 0
+          // Blank macros are left to the server to estimate from the ingredients
+          calories: mealForm.calories === '' ? null : parseInt(mealForm.calories) || 0,
+          protein: mealForm.protein === '' ? null : parseFloat(mealForm.protein) || 0,
+          carbs: mealForm.carbs === '' ? null : parseFloat(mealForm.carbs) || 0,
+          fat: mealForm.fat === '' ? null : parseFloat(mealForm.fat) || 0
         })
       });
       
@@ -216,8 +277,24 @@ function App() {
         throw new Error('Analysis failed');
       }
       
-      const data = await response.json();
-      alert(`Meal analyzed! ${data.analysis.name}: ${data.analysis.calories} cal, ${data.analysis.protein}g protein`);
+      const { job_id } = await response.json();
+      
+      // Analysis runs in the background; poll until the job finishes
+      let job = { status: 'queued' };
+      while (job.status === 'queued' || job.status === 'running') {
+        await new Promise((resolve) => setTimeout(resolve, 1000));
+        job = await apiCall(`/api/meals/analyze/${job_id}`);
+      }
+      
+      if (job.status !== 'done') {
+        throw new Error(job.error || 'Analysis failed');
+      }
+      
+      if (job.analysis.fallback) {
+        alert(`Couldn't analyze this photo, so placeholder values were saved for ${job.analysis.name}. Please check them.`);
+      } else {
+        alert(`Meal analyzed! ${job.analysis.name}: ${job.analysis.calories} cal, ${job.analysis.protein}g protein`);
+      }
       setSelectedFile(null);
       loadTodayMeals();
     } catch (error) {
@@ -227,9 +304,10 @@ function App() {
     }
   };
 
-  const handleLike = async (postId) => {
+  const handleLike = async (post) => {
     try {
-      await apiCall(`/api/posts/${postId}/like`, { method: 'POST' });
+      // Send the desired state so repeated taps can't flip it back and forth
+      await apiCall(`/api/posts/${post.post_id}/like?liked=${!post.liked_by_me}`, { method: 'POST' });
       loadFeed();
     } catch (error) {
       console.error('Failed to like post:', error);
@@ -291,6 +369,7 @@ function App() {
       });
       
       setNewComment({ ...newComment, [postId]: '' });
+      loadComments(postId);
       loadFeed();
     } catch (error) {
       console.error('Failed to add comment:', error);
@@ -336,8 +415,8 @@ function App() {
         body: JSON.stringify({ content: newContent })
       });
       
-      setEditingComment({ ...editingComment, [commentId]: false });
-      loadFeed();
+      setEditingComment({ ...editingComment, [commentId]: undefined });
+      loadComments(postId);
     } catch (error) {
       console.error('Failed to edit comment:', error);
     }
@@ -351,6 +430,7 @@ function App() {
         method: 'DELETE'
       });
       
+      loadComments(postId);
       loadFeed();
     } catch (error) {
       console.error('Failed to delete comment:', error);
@@ -398,7 +478,20 @@ function App() {
     }
   };
 
+  const loadComments = async (postId) => {
+    try {
+      const data = await apiCall(`/api/posts/${postId}/comments`);
+      // The API pages newest first; show the thread in chronological order
+      setPostComments(prev => ({ ...prev, [postId]: (data.comments || []).slice().reverse() }));
+    } catch (error) {
+      console.error('Failed to load comments:', error);
+    }
+  };
+
   const toggleComments = (postId) => {
+    if (!showComments[postId]) {
+      loadComments(postId);
+    }
     setShowComments(prev => ({ ...prev, [postId]: !prev[postId] }));
   };
 
@@ -814,10 +907,10 @@ function App() {
                           <p>{post.content}</p>
                           {post.image_url && (
                             <img 
-                              src={post.image_url} 
+                              src={resolveImageUrl(post.image_thumbnails?.md || post.image_url)} 
                               alt="Post" 
                               className="post-image"
-                              onClick={() => setSelectedImage(post.image_url)}
+                              onClick={() => setSelectedImage(resolveImageUrl(post.image_url))}
                               onError={(e) => {
                                 e.target.style.display = 'none';
                                 console.log('Image failed to load:', post.image_url);
@@ -829,16 +922,16 @@ function App() {
                     </div>
                     <div className="post-actions">
                       <button 
-                        onClick={() => handleLike(post.post_id)}
-                        className={`like-button ${post.likes?.includes(user.user_id) ? 'liked' : ''}`}
+                        onClick={() => handleLike(post)}
+                        className={`like-button ${post.liked_by_me ? 'liked' : ''}`}
                       >
-                        💪 {post.likes?.length || 0}
+                        💪 {post.like_count || 0}
                       </button>
                       <button 
                         onClick={() => toggleComments(post.post_id)}
                         className="comment-button"
                       >
-                        💬 {post.comments?.length || 0}
+                        💬 {post.comment_count || 0}
                       </button>
                     </div>
                     
@@ -846,7 +939,7 @@ function App() {
                     {showComments[post.post_id] && (
                       <div className="comments-section">
                         <div className="comments-list">
-                          {post.comments?.map((comment, commentIndex) => (
+                          {postComments[post.post_id]?.map((comment, commentIndex) => (
                             <div key={commentIndex} className="comment">
                               <div className="comment-header">
                                 <strong>{comment.author_name}</strong>
@@ -949,6 +1042,10 @@ function App() {
                   <span className="stat-number">{user.posts_count || 0}</span>
                   <span className="stat-label">Posts</span>
                 </div>
+                <div className="stat">
+                  <span className="stat-number">{user.likes_received || 0}</span>
+                  <span className="stat-label">Likes</span>
+                </div>
                 <div className="stat">
                   <span className="stat-number">{user.followers || 0}</span>
                   <span className="stat-label">Followers</span>
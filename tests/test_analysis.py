@@ -0,0 +1,51 @@
+"""Meal analysis replies: fenced JSON parses, and placeholder fallbacks are never cached."""
+import asyncio
+
+import pytest
+
+from backend import server
+
+
+def test_parses_fenced_json_reply():
+    reply = '```json\n{"name": "Oatmeal", "calories": 300, "confidence": 8}\n```'
+    assert server.parse_analysis_content(reply) == {"name": "Oatmeal", "calories": 300, "confidence": 8}
+
+
+def test_model_cannot_mark_its_own_reply_as_fallback():
+    assert "fallback" not in server.parse_analysis_content('{"name": "Oatmeal", "fallback": true}')
+
+
+@pytest.mark.parametrize("reply", ["I can't tell what this is", "[1, 2]", "```json\nnot json\n```"])
+def test_unparseable_reply_raises(reply):
+    with pytest.raises(ValueError):
+        server.parse_analysis_content(reply)
+
+
+def test_fallback_is_not_cached(monkeypatch):
+    calls = []
+
+    async def analyze(image_base64, meal_name=None):
+        calls.append(meal_name)
+        return server.fallback_analysis(meal_name, confidence=5)
+
+    monkeypatch.setattr(server, "analysis_cache", server.AnalysisCache(60, 10))
+    monkeypatch.setattr(server, "analyze_meal_with_ai", analyze)
+
+    async def run():
+        # Not a decodable image, so the perceptual-hash tier is skipped
+        first = await server.analyze_meal_cached(b"not an image", "toast")
+        second = await server.analyze_meal_cached(b"not an image", "toast")
+        return first, second
+
+    first, second = asyncio.run(run())
+    assert first["fallback"] and second["fallback"]
+    assert len(calls) == 2
+    assert not server.analysis_cache.entries
+
+
+def test_similar_photos_reuse_analysis_only_when_names_agree():
+    index = server.MealHashIndex(server.PHASH_MAX_DISTANCE)
+    index.add(server.meal_name_key("Pasta.jpg"), 0b1010, {"name": "Pasta"})
+    assert index.find(server.meal_name_key("pasta"), 0b1011) == (1, {"name": "Pasta"})
+    assert index.find(server.meal_name_key("salad.jpg"), 0b1011) is None
+    assert server.meal_name_key("IMG_0412.jpg") == server.meal_name_key("img_0413.JPG")
@@ -0,0 +1,59 @@
+"""Analysis jobs stranded by a crashed worker are re-queued or failed instead of polling forever."""
+import asyncio
+import os
+from datetime import datetime, timedelta, UTC
+
+import pytest
+from motor.motor_asyncio import AsyncIOMotorClient
+
+from backend import server
+
+pytestmark = pytest.mark.skipif(not os.environ.get("MONGO_URL"), reason="set MONGO_URL to run against MongoDB")
+
+
+def job(job_id, status, age, **fields):
+    updated_at = datetime.now(UTC) - timedelta(seconds=age)
+    return {"job_id": job_id, "user_id": "u1", "status": status, "meal_date": "2024-01-01", "image": b"jpeg",
+            "filename": f"{job_id}.jpg", "owner": "crashed-worker", "created_at": updated_at, "updated_at": updated_at,
+            **fields}
+
+
+def test_stale_jobs_are_recovered(monkeypatch):
+    async def run():
+        db = AsyncIOMotorClient(os.environ["MONGO_URL"])["eatflex_test_analysis_jobs"]
+        await db.client.drop_database(db.name)
+        await db.analysis_jobs.create_indexes(server.REQUIRED_INDEXES[server.analysis_jobs_collection])
+        monkeypatch.setattr(server, "analysis_jobs_collection", db.analysis_jobs)
+        monkeypatch.setattr(server, "analysis_queue", asyncio.Queue(maxsize=10))
+        stale = server.ANALYSIS_JOB_STALE_AFTER + 60
+        await db.analysis_jobs.insert_many([
+            job("stale-running", "running", stale),
+            job("stale-queued", "queued", stale),
+            job("legacy-queued", "queued", stale),
+            job("fresh-queued", "queued", 0),
+            job("done", "done", stale),
+        ])
+        await db.analysis_jobs.update_one({"job_id": "legacy-queued"}, {"$unset": {"image": ""}})
+        try:
+            claimed = await server.recover_analysis_jobs()
+            # Claimed once: a second sweep finds nothing stale left to take
+            claimed += await server.recover_analysis_jobs()
+            queued = [server.analysis_queue.get_nowait() for _ in range(server.analysis_queue.qsize())]
+            jobs = {row['job_id']: row async for row in db.analysis_jobs.find({}, {"_id": 0})}
+            # The crashed worker's copy of the claimed job no longer matches, so it is skipped
+            taken = await server.set_analysis_job_status(
+                "stale-queued", "running", {"status": "queued", "owner": "crashed-worker"}
+            )
+            return claimed, queued, jobs, taken
+        finally:
+            await db.client.drop_database(db.name)
+
+    claimed, queued, jobs, taken = asyncio.run(run())
+    assert claimed == 1
+    assert queued == [("stale-queued", "u1", "2024-01-01", b"jpeg", "stale-queued.jpg")]
+    assert jobs["stale-queued"]['owner'] == server.analysis_process_id
+    assert jobs["stale-running"]['status'] == "failed" and "image" not in jobs["stale-running"]
+    assert jobs["legacy-queued"]['status'] == "failed"
+    assert jobs["fresh-queued"]['status'] == "queued" and jobs["fresh-queued"]['owner'] == "crashed-worker"
+    assert jobs["done"]['status'] == "done"
+    assert taken is False
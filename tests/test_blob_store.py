@@ -0,0 +1,102 @@
+"""Post images go to the blob store once per size, and posts keep every size's URL."""
+import asyncio
+import io
+import os
+
+import httpx
+import pytest
+from botocore.response import StreamingBody
+from botocore.stub import Stubber
+from motor.motor_asyncio import AsyncIOMotorClient
+from PIL import Image
+
+from backend import server
+
+
+def jpeg(size=(1200, 900)):
+    output = io.BytesIO()
+    Image.new('RGB', size, (180, 90, 20)).save(output, 'JPEG')
+    return output.getvalue()
+
+
+def test_local_store_round_trip(tmp_path, monkeypatch):
+    monkeypatch.setattr(server, "blob_store", server.LocalBlobStore(str(tmp_path)))
+
+    async def run():
+        urls = await server.store_post_image(jpeg())
+        stored = {name: await server.blob_store.get(url.removeprefix("/api/images/")) for name, url in urls.items()}
+        return urls, stored, await server.blob_store.get("posts/missing/lg.jpg")
+
+    urls, stored, missing = asyncio.run(run())
+    assert set(urls) == {"lg", *server.POST_THUMBNAIL_SIZES}
+    assert missing is None
+    for name, dim in server.POST_THUMBNAIL_SIZES.items():
+        assert max(Image.open(io.BytesIO(stored[name])).size) == dim
+    # The post stores the thumbnails that belong to its full-size image
+    assert server.post_image_thumbnails(urls['lg']) == {name: urls[name] for name in server.POST_THUMBNAIL_SIZES}
+
+
+def test_s3_store_uploads_immutable_jpegs(monkeypatch):
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    store = server.S3BlobStore("eatflex-images", public_url="https://cdn.example.com/")
+    data = jpeg((64, 48))
+    with Stubber(store.s3) as s3:
+        s3.add_response("put_object", {}, {
+            "Bucket": "eatflex-images", "Key": "posts/abc/lg.jpg", "Body": data,
+            "ContentType": "image/jpeg", "CacheControl": "public, max-age=31536000, immutable"
+        })
+        s3.add_response("get_object", {"Body": StreamingBody(io.BytesIO(data), len(data))},
+                        {"Bucket": "eatflex-images", "Key": "posts/abc/lg.jpg"})
+        s3.add_client_error("get_object", service_error_code="NoSuchKey", http_status_code=404)
+
+        async def run():
+            await store.put("posts/abc/lg.jpg", data, "image/jpeg")
+            return await store.get("posts/abc/lg.jpg"), await store.get("posts/missing/lg.jpg")
+
+        assert asyncio.run(run()) == (data, None)
+        s3.assert_no_pending_responses()
+    assert store.url("posts/abc/lg.jpg") == "https://cdn.example.com/posts/abc/lg.jpg"
+
+    monkeypatch.setattr(server, "blob_store", store)
+    assert server.post_image_thumbnails("https://cdn.example.com/posts/abc/lg.jpg") == {
+        name: f"https://cdn.example.com/posts/abc/{name}.jpg" for name in server.POST_THUMBNAIL_SIZES
+    }
+    assert server.post_image_thumbnails("https://elsewhere.example.com/posts/abc/lg.jpg") is None
+
+
+@pytest.mark.skipif(not os.environ.get("MONGO_URL"), reason="set MONGO_URL to run against MongoDB")
+def test_posts_keep_thumbnails_and_reject_inline_images(tmp_path, monkeypatch):
+    monkeypatch.setattr(server, "blob_store", server.LocalBlobStore(str(tmp_path)))
+
+    async def run():
+        db = AsyncIOMotorClient(os.environ["MONGO_URL"])["eatflex_test_posts"]
+        await db.client.drop_database(db.name)
+        for name in ("users_collection", "posts_collection", "follows_collection", "timelines_collection"):
+            source = getattr(server, name)
+            await db[source.name].create_indexes(server.REQUIRED_INDEXES[source])
+            monkeypatch.setattr(server, name, db[source.name])
+        try:
+            async with httpx.AsyncClient(transport=httpx.ASGITransport(app=server.app), base_url="http://test") as http:
+                response = await http.post("/api/auth/signup", json={
+                    "email": "poster@example.com", "name": "poster", "password": "correct horse"
+                })
+                headers = {"Authorization": f"Bearer {response.json()['token']}"}
+                upload = (await http.post(
+                    "/api/posts/temp/upload-image", headers=headers, files={"file": ("meal.jpg", jpeg(), "image/jpeg")}
+                )).json()
+                created = await http.post("/api/posts/create", headers=headers, json={
+                    "content": "Dinner", "image_url": upload['image_url']
+                })
+                inline = await http.post("/api/posts/create", headers=headers, json={
+                    "content": "Dinner", "image_url": "data:image/jpeg;base64,/9j/4AAQ"
+                })
+                post = await db.posts.find_one({"post_id": created.json()['post_id']})
+                return upload, post, inline, await db.posts.count_documents({})
+        finally:
+            await db.client.drop_database(db.name)
+
+    upload, post, inline, posts = asyncio.run(run())
+    assert post['image_url'] == upload['image_url']
+    assert post['image_thumbnails'] == upload['thumbnails']
+    assert inline.status_code == 400
+    assert posts == 1
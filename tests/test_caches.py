@@ -0,0 +1,46 @@
+"""Coalesced caches must never store a load that an invalidation raced past."""
+import asyncio
+
+from backend import server
+
+
+def test_invalidation_during_load_is_not_stored():
+    async def run():
+        cache = server.ResponseCache(30, 10)
+        release = asyncio.Event()
+
+        async def load():
+            await release.wait()
+            return {"followers_count": 1}
+
+        pending = asyncio.ensure_future(cache.get_or_load("user", load))
+        await asyncio.sleep(0)
+        cache.invalidate("user")
+        release.set()
+        assert await pending == {"followers_count": 1}
+        assert cache.get("user") is None
+
+    asyncio.run(run())
+
+
+def test_invalidation_before_load_starts_is_not_stored():
+    async def run():
+        cache = server.ResponseCache(30, 10)
+
+        async def load():
+            return {"followers_count": 1}
+
+        # Invalidate after the load is scheduled but before its task has run
+        pending = asyncio.ensure_future(cache.get_or_load("user", load))
+        await asyncio.sleep(0)
+        cache.invalidate("user")
+        await pending
+        assert cache.get("user") is None
+        assert await cache.get_or_load("user", load) == {"followers_count": 1}
+        assert cache.get("user") == {"followers_count": 1}
+
+    asyncio.run(run())
+
+
+def test_user_principals_are_generation_guarded():
+    assert isinstance(server.user_cache, server.ResponseCache)
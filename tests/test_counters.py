@@ -0,0 +1,74 @@
+"""Write-behind counters: readers overlay unflushed deltas exactly once, even while a flush is running."""
+import asyncio
+
+from backend import server
+
+
+class SlowCollection:
+    """Applies $inc bulk writes to in-memory documents, optionally waiting to be released first"""
+
+    def __init__(self, name, docs, release=None):
+        self.name = name
+        self.docs = docs
+        self.release = release
+        self.writing = asyncio.Event()
+
+    async def bulk_write(self, operations, ordered=True):
+        self.writing.set()
+        if self.release:
+            await self.release.wait()
+        for operation in operations:
+            # Documents are keyed by the value of their single-field filter
+            doc = self.docs[next(iter(operation._filter.values()))]
+            for field, delta in operation._doc['$inc'].items():
+                doc[field] = doc.get(field, 0) + delta
+
+
+def test_reads_during_a_flush_see_each_delta_once():
+    async def run():
+        release = asyncio.Event()
+        users = SlowCollection("users", {"u1": {"followers_count": 10}})
+        posts = SlowCollection("posts", {"p1": {"like_count": 5}}, release)
+        flushed = []
+        counters = server.CounterBuffer(60, 1000, on_flush=flushed.extend)
+        counters.incr(users, {"user_id": "u1"}, {"followers_count": 2})
+        counters.incr(posts, {"post_id": "p1"}, {"like_count": 3})
+
+        def read():
+            return (
+                counters.overlay(users, {"user_id": "u1"}, users.docs["u1"])['followers_count'],
+                counters.overlay(posts, {"post_id": "p1"}, posts.docs["p1"])['like_count'],
+            )
+
+        before = read()
+        flush = asyncio.ensure_future(counters.flush())
+        # users is written and posts is still in flight
+        await posts.writing.wait()
+        during = read()
+        users_flushed = list(flushed)
+        counters.incr(posts, {"post_id": "p1"}, {"like_count": 1})
+        release.set()
+        await flush
+        return before, during, users_flushed, read()
+
+    before, during, users_flushed, after = asyncio.run(run())
+    assert before == (12, 8)
+    assert during == (12, 8)
+    assert users_flushed == [("users", (("user_id", "u1"),))]
+    # The increment made mid-flush is still pending, on top of the written 8
+    assert after == (12, 9)
+
+
+def test_failed_write_is_overlaid_once_while_requeued():
+    class Unreachable(SlowCollection):
+        async def bulk_write(self, operations, ordered=True):
+            raise ConnectionError("no primary")
+
+    async def run():
+        users = Unreachable("users", {"u1": {"followers_count": 10}})
+        counters = server.CounterBuffer(60, 1000)
+        counters.incr(users, {"user_id": "u1"}, {"followers_count": 2})
+        assert await counters.flush() == 0
+        return counters.overlay(users, {"user_id": "u1"}, users.docs["u1"])['followers_count']
+
+    assert asyncio.run(run()) == 12
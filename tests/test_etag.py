@@ -0,0 +1,33 @@
+"""Conditional responses: response models are validated before the ETag is taken over their bytes."""
+from datetime import datetime
+
+import orjson
+import pydantic
+import pytest
+from fastapi import Request
+
+from backend import server
+
+POST = {"post_id": "p1", "user_id": "u1", "author_name": "Ada", "content": "Lunch", "created_at": datetime(2024, 1, 1, 12)}
+
+
+def request(if_none_match=None):
+    headers = [(b"if-none-match", if_none_match.encode())] if if_none_match else []
+    return Request({"type": "http", "headers": headers})
+
+
+def test_response_model_is_validated_and_tagged():
+    response = server.etag_response(request(), server.PostPage(posts=[POST]))
+    body = orjson.loads(response.body)
+    # Defaults from PostOut are filled in, as the declared response_model promises
+    assert body["posts"][0]["liked_by_me"] is False
+    assert body["next_cursor"] is None
+
+    cached = server.etag_response(request(response.headers["etag"]), server.PostPage(posts=[POST]))
+    assert cached.status_code == 304
+    assert cached.headers["etag"] == response.headers["etag"]
+
+
+def test_invalid_page_is_rejected():
+    with pytest.raises(pydantic.ValidationError):
+        server.PostPage(posts=[{**POST, "content": None}])
@@ -0,0 +1,48 @@
+"""Following goes through the route: a target missing from this worker's principal cache must still be found."""
+import asyncio
+import os
+
+import httpx
+import pytest
+from motor.motor_asyncio import AsyncIOMotorClient
+
+from backend import server
+
+pytestmark = pytest.mark.skipif(not os.environ.get("MONGO_URL"), reason="set MONGO_URL to run against MongoDB")
+
+
+def test_follow_uncached_user(monkeypatch):
+    async def run():
+        db = AsyncIOMotorClient(os.environ["MONGO_URL"])["eatflex_test_follow"]
+        await db.client.drop_database(db.name)
+        for name in ("users_collection", "posts_collection", "follows_collection", "timelines_collection"):
+            source = getattr(server, name)
+            await db[source.name].create_indexes(server.REQUIRED_INDEXES[source])
+            monkeypatch.setattr(server, name, db[source.name])
+        server.user_cache.clear()
+        try:
+            async with httpx.AsyncClient(transport=httpx.ASGITransport(app=server.app), base_url="http://test") as http:
+                tokens = {}
+                for name in ("follower", "target"):
+                    response = await http.post("/api/auth/signup", json={
+                        "email": f"{name}@example.com", "name": name, "password": "correct horse", "goal": "maintenance"
+                    })
+                    tokens[name] = response.json()['token']
+                target_id = server.verify_jwt_token(tokens["target"])
+                # The target has made no requests, so only the database knows about them
+                assert server.user_cache.get(target_id) is None
+
+                headers = {"Authorization": f"Bearer {tokens['follower']}"}
+                response = await http.post(f"/api/profile/follow/{target_id}", params={"following": True}, headers=headers)
+                missing = await http.post("/api/profile/follow/nobody", params={"following": True}, headers=headers)
+                target = await db.users.find_one({"user_id": target_id})
+                return response, missing, target
+        finally:
+            server.user_cache.clear()
+            await db.client.drop_database(db.name)
+
+    response, missing, target = asyncio.run(run())
+    assert response.status_code == 200
+    assert response.json()['is_following'] is True
+    assert target['followers_count'] == 1
+    assert missing.status_code == 404
@@ -0,0 +1,102 @@
+"""Every query shape the routes issue must be served by a declared index."""
+import asyncio
+import os
+from datetime import datetime
+
+import pytest
+from motor.motor_asyncio import AsyncIOMotorClient
+
+from backend import server
+
+pytestmark = pytest.mark.skipif(not os.environ.get("MONGO_URL"), reason="set MONGO_URL to run against MongoDB")
+
+# (collection, filter, sort) for each query shape issued by the routes; add new routes' queries here
+ROUTE_QUERIES = [
+    (server.users_collection, {"user_id": "u1"}, None),
+    (server.users_collection, {"email": "a@example.com"}, None),
+    (server.users_collection, {"user_id": {"$in": ["u1", "u2"]}}, None),
+    (server.follows_collection, {"follower_id": "u1", "followee_id": "u2"}, None),
+    (server.follows_collection, {"followee_id": "u1"}, [("created_at", -1), ("follower_id", -1)]),
+    (server.follows_collection, {"follower_id": "u1"}, [("created_at", -1), ("followee_id", -1)]),
+    (server.follows_collection, {"follower_id": "u1", "fanout_on_read": True}, None),
+    (server.timelines_collection, {"user_id": "u1"}, None),
+    (server.timelines_collection, {"user_id": {"$in": ["u1", "u2"]}}, None),
+    (server.posts_collection, {"post_id": {"$in": ["p1", "p2"]}}, None),
+    (server.meals_collection, {"meal_id": "m1", "user_id": "u1"}, None),
+    (server.meals_collection, {"meal_id": {"$in": ["m1", "m2"]}}, None),
+    (server.meals_collection, {"user_id": "u1", "date": "2024-01-01"}, [("created_at", -1)]),
+    (server.meals_collection, {"user_id": "u1"}, [("created_at", -1), ("meal_id", -1)]),
+    (server.posts_collection, {"post_id": "p1"}, None),
+    (server.posts_collection, {"post_id": "p1", "user_id": "u1"}, None),
+    (server.posts_collection, {"user_id": "u1"}, [("created_at", -1)]),
+    (server.posts_collection, {"user_id": "u1"}, [("created_at", -1), ("post_id", -1)]),
+    (server.posts_collection, {"user_id": {"$in": ["u1", "u2"]}}, [("created_at", -1), ("post_id", -1)]),
+    (server.posts_collection, {}, [("created_at", -1), ("post_id", -1)]),
+    (server.posts_collection, server.keyset_filter(server.encode_cursor(datetime(2024, 1, 1), "p1"), "post_id"), [("created_at", -1), ("post_id", -1)]),
+    (server.posts_collection, {"$and": [{"user_id": "u1"}, server.keyset_filter(server.encode_cursor(datetime(2024, 1, 1), "p1"), "post_id")]},
+     [("created_at", -1), ("post_id", -1)]),
+    (server.meals_collection, {"$and": [{"user_id": "u1"}, server.keyset_filter(server.encode_cursor(datetime(2024, 1, 1), "m1"), "meal_id")]},
+     [("created_at", -1), ("meal_id", -1)]),
+    (server.comments_collection, {"post_id": "p1"}, [("created_at", -1), ("comment_id", -1)]),
+    (server.comments_collection, {"comment_id": "c1", "post_id": "p1", "user_id": "u1"}, None),
+    (server.likes_collection, {"post_id": {"$in": ["p1", "p2"]}, "user_id": "u1", "active": {"$ne": False}}, None),
+    (server.likes_collection, {"post_id": "p1", "user_id": "u1"}, None),
+    (server.meals_collection, {"user_id": "u1", "date": {"$gte": "2024-01-01"}}, None),
+    (server.meals_collection, {}, [("user_id", 1), ("date", 1)]),
+    (server.meals_collection, {"user_id": "u1"}, [("user_id", 1), ("date", 1)]),
+    (server.meals_collection, {"user_id": "u1"}, [("created_at", 1)]),
+    (server.recipes_collection, {"recipe_id": "r1"}, None),
+    (server.recipes_collection, {}, [("created_at", -1), ("recipe_id", -1)]),
+    (server.recipes_collection, {"user_id": "u1"}, [("created_at", -1), ("recipe_id", -1)]),
+    (server.recipes_collection, {"per_serving.calories": {"$lte": 400}}, [("created_at", -1), ("recipe_id", -1)]),
+    (server.recipes_collection, {"per_serving.carbs": {"$lte": 30}, "per_serving.fat": {"$gte": 10}}, [("created_at", -1), ("recipe_id", -1)]),
+    (server.recipes_collection, {"user_id": "u1", "per_serving.protein": {"$gte": 30}}, [("created_at", -1), ("recipe_id", -1)]),
+    (server.recipes_collection, {"$text": {"$search": '"chicken"'}, "per_serving.protein": {"$gte": 30}}, [("created_at", -1), ("recipe_id", -1)]),
+    (server.daily_totals_collection, {"user_id": "u1", "date": "2024-01-01"}, None),
+    (server.daily_totals_collection, {"user_id": "u1", "date": {"$gte": "2024-01-01", "$lte": "2024-03-31"}}, [("date", 1)]),
+    (server.daily_totals_collection, {"user_id": "u1", "meals": {"$gt": 0}, "date": {"$gte": "2024-01-01"}}, None),
+    (server.analysis_cache_collection, {"key": "k", "expires_at": {"$gt": datetime(2024, 1, 1)}}, None),
+    (server.analysis_cache_stats_collection, {}, [("date", -1)]),
+    (server.daily_stats_collection, {}, [("date", -1)]),
+    (server.analysis_jobs_collection, {"job_id": "j1", "user_id": "u1"}, None),
+    (server.analysis_jobs_collection, {"status": "queued", "updated_at": {"$lt": datetime(2024, 1, 1)}}, None),
+]
+
+
+def plan_stages(plan: dict):
+    yield plan.get('stage')
+    for key in ('inputStage', 'queryPlan'):
+        if key in plan:
+            yield from plan_stages(plan[key])
+    for child in plan.get('inputStages', []):
+        yield from plan_stages(child)
+
+
+async def check_query_plans(database):
+    """Explain every route query against `database`; return those that COLLSCAN or sort in memory"""
+    await server.ensure_indexes(database)
+    failures = []
+    for collection, query, sort in ROUTE_QUERIES:
+        collection = database[collection.name]
+        cursor = collection.find(query).limit(1)
+        if sort:
+            cursor = cursor.sort(sort)
+        explain = await cursor.explain()
+        stages = list(plan_stages(explain['queryPlanner']['winningPlan']))
+        # Text matches can't come back in index order, so only those may sort
+        if 'COLLSCAN' in stages or (sort and 'SORT' in stages and '$text' not in query):
+            failures.append(f"{collection.name} {query} sort={sort}: {' <- '.join(filter(None, stages))}")
+    return failures
+
+
+def test_route_queries_use_indexes():
+    async def run():
+        db = AsyncIOMotorClient(os.environ["MONGO_URL"])["eatflex_test_indexes"]
+        await db.client.drop_database(db.name)
+        try:
+            return await check_query_plans(db)
+        finally:
+            await db.client.drop_database(db.name)
+
+    failures = asyncio.run(run())
+    assert not failures, "\n".join(failures)
@@ -0,0 +1,67 @@
+"""Nutrition insights computed from daily totals: averages, rolling windows, macro split, adherence and trends."""
+import pandas as pd
+import pytest
+
+from backend import server
+
+GOALS = {"calories": 2000, "protein": 150, "carbs": 250, "fat": 70}
+
+
+def daily(*rows):
+    return pd.DataFrame.from_records(
+        [dict(zip(["date", "meals", *server.NUTRIENT_FIELDS], row)) for row in rows],
+        columns=["date", "meals", *server.NUTRIENT_FIELDS]
+    )
+
+
+def test_empty_history():
+    assert server.compute_insights(daily(), GOALS) == {"meals_logged": 0, "days_logged": 0}
+
+
+def test_single_day():
+    insights = server.compute_insights(daily(("2024-03-01", 3, 2000, 150, 250, 70)), GOALS)
+    assert (insights['meals_logged'], insights['days_logged']) == (3, 1)
+    assert insights['from'] == insights['to'] == "2024-03-01"
+    assert insights['averages'] == {"calories": 2000, "protein": 150, "carbs": 250, "fat": 70}
+    assert insights['rolling'] == [{"date": "2024-03-01", "calories": 2000, "protein": 150, "carbs": 250, "fat": 70}]
+    assert insights['goal_adherence']['percent_of_goal'] == {"calories": 100, "protein": 100, "carbs": 100, "fat": 100}
+    assert insights['goal_adherence']['on_target_rate'] == {"calories": 100, "protein": 100, "carbs": 100, "fat": 100}
+    # One day has no trend
+    assert insights['weekly_trend'] == dict.fromkeys(server.NUTRIENT_FIELDS)
+
+
+def test_aggregations_over_gaps():
+    insights = server.compute_insights(daily(
+        ("2024-03-03", 2, 2400, 100, 300, 80),
+        ("2024-03-01", 1, 1600, 200, 200, None),
+        ("2024-03-04", 1, 2000, 150, 250, 60),
+    ), GOALS, window=2)
+    assert (insights['meals_logged'], insights['days_logged']) == (4, 3)
+    assert (insights['from'], insights['to']) == ("2024-03-01", "2024-03-04")
+    # A missing macro counts as zero
+    assert insights['averages'] == {"calories": 2000, "protein": 150, "carbs": 250, "fat": 46.7}
+
+    # The unlogged 2 March is in the calendar but doesn't drag the averages down
+    rolling = {row['date']: row['calories'] for row in insights['rolling']}
+    assert rolling == {"2024-03-01": 1600, "2024-03-02": 1600, "2024-03-03": 2400, "2024-03-04": 2200}
+
+    # Energy from protein 450 g * 4, carbs 750 g * 4, fat 140 g * 9
+    energy = {"protein": 1800, "carbs": 3000, "fat": 1260}
+    assert insights['macro_split'] == {
+        field: pytest.approx(value / sum(energy.values()) * 100, abs=0.05) for field, value in energy.items()
+    }
+    adherence = insights['goal_adherence']
+    assert adherence['percent_of_goal']['calories'] == 100
+    assert adherence['on_target_rate']['calories'] == pytest.approx(100 / 3, abs=0.05)
+    assert adherence['on_target_rate']['protein'] == pytest.approx(100 / 3, abs=0.05)
+
+    # Least-squares slope of calories over days 0, 2 and 3, per week
+    days, calories = [0, 2, 3], [1600, 2400, 2000]
+    mean_day, mean_calories = sum(days) / 3, sum(calories) / 3
+    slope = sum((d - mean_day) * (c - mean_calories) for d, c in zip(days, calories)) / sum((d - mean_day) ** 2 for d in days)
+    assert insights['weekly_trend']['calories'] == pytest.approx(slope * 7, abs=0.05)
+
+
+def test_missing_goal_is_left_out_of_adherence():
+    insights = server.compute_insights(daily(("2024-03-01", 1, 1000, 75, 125, 35)), {**GOALS, "fat": 0})
+    assert insights['goal_adherence']['percent_of_goal'] == {"calories": 50, "protein": 50, "carbs": 50, "fat": None}
@@ -0,0 +1,68 @@
+"""Re-importing an export must not duplicate meals or double the daily rollups, and imports stop at the row cap."""
+import asyncio
+import os
+
+import pytest
+from motor.motor_asyncio import AsyncIOMotorClient
+
+from backend import server
+
+
+ROWS = [
+    {"meal_id": "import-1", "name": "Oatmeal", "date": "2024-01-01", "calories": 300},
+    {"meal_id": "import-2", "name": "Salad", "date": "2024-01-01", "calories": 200},
+    {"meal_id": "theirs", "name": "Soup", "date": "2024-01-02", "calories": 150},
+    {"name": "Toast", "date": "2024-01-02", "calories": 100},
+]
+
+
+async def numbered(rows):
+    for number, row in enumerate(rows, 1):
+        yield number, row
+
+
+@pytest.mark.skipif(not os.environ.get("MONGO_URL"), reason="set MONGO_URL to run against MongoDB")
+def test_reimport_skips_existing_meals(monkeypatch):
+    async def run():
+        db = AsyncIOMotorClient(os.environ["MONGO_URL"])["eatflex_test_import"]
+        await db.client.drop_database(db.name)
+        await db.meals.create_indexes(server.REQUIRED_INDEXES[server.meals_collection])
+        monkeypatch.setattr(server, "meals_collection", db.meals)
+        monkeypatch.setattr(server, "daily_totals_collection", db.daily_totals)
+        await db.meals.insert_one({"meal_id": "theirs", "user_id": "someone-else", "date": "2024-01-02"})
+        try:
+            first = await server.import_meals("importer", numbered(ROWS))
+            # The export carries meal_ids for every row, so a second import adds nothing
+            exported = [meal async for meal in db.meals.find({"user_id": "importer"}, {"_id": 0, "user_id": 0})]
+            second = await server.import_meals("importer", numbered(
+                {**meal, "created_at": meal['created_at'].isoformat()} for meal in exported
+            ))
+            meals = await db.meals.count_documents({"user_id": "importer"})
+            totals = {row['date']: row async for row in db.daily_totals.find({"user_id": "importer"})}
+            return first, second, meals, totals
+        finally:
+            await db.client.drop_database(db.name)
+
+    first, second, meals, totals = asyncio.run(run())
+    assert (first['imported'], first['skipped']) == (4, 0)
+    assert (second['imported'], second['skipped']) == (0, 4)
+    assert meals == 4
+    assert (totals["2024-01-01"]['meals'], totals["2024-01-01"]['calories']) == (2, 500)
+    assert (totals["2024-01-02"]['meals'], totals["2024-01-02"]['calories']) == (2, 250)
+
+
+def test_import_stops_exactly_at_the_row_cap(monkeypatch):
+    written = []
+
+    async def write_meal_batch(batch):
+        written.extend(batch)
+        return len(batch)
+
+    monkeypatch.setattr(server, "write_meal_batch", write_meal_batch)
+    monkeypatch.setattr(server, "MEAL_IMPORT_BATCH", 3)
+    monkeypatch.setattr(server, "MEAL_IMPORT_MAX_ROWS", 5)
+    rows = [{"name": f"Meal {i}", "date": "2024-01-01", "calories": 100} for i in range(10)]
+    result = asyncio.run(server.import_meals("importer", numbered(rows)))
+    # One full batch is written and two rows are still pending when the cap is reached
+    assert len(written) == result['imported'] == 5
+    assert result['errors'] == [{"line": 6, "error": "Import stopped after 5 rows"}]
@@ -0,0 +1,89 @@
+"""Updating a meal changes only the fields the client sent, and the day's totals follow."""
+import asyncio
+import os
+
+import httpx
+import pytest
+from motor.motor_asyncio import AsyncIOMotorClient
+
+from backend import server
+
+pytestmark = pytest.mark.skipif(not os.environ.get("MONGO_URL"), reason="set MONGO_URL to run against MongoDB")
+
+
+@pytest.fixture
+def foods(tmp_path, monkeypatch):
+    db_path = str(tmp_path / "foods.db")
+    server.build_nutrition_db(db_path=db_path)
+    index = server.NutritionIndex()
+    index.load(db_path)
+    monkeypatch.setattr(server, "nutrition_index", index)
+
+
+def test_partial_meal_update(monkeypatch, foods):
+    async def run():
+        db = AsyncIOMotorClient(os.environ["MONGO_URL"])["eatflex_test_meal_update"]
+        await db.client.drop_database(db.name)
+        for name in ("users_collection", "meals_collection", "daily_totals_collection"):
+            source = getattr(server, name)
+            await db[source.name].create_indexes(server.REQUIRED_INDEXES[source])
+            monkeypatch.setattr(server, name, db[source.name])
+        try:
+            async with httpx.AsyncClient(transport=httpx.ASGITransport(app=server.app), base_url="http://test") as http:
+                response = await http.post("/api/auth/signup", json={
+                    "email": "eater@example.com", "name": "eater", "password": "correct horse"
+                })
+                headers = {"Authorization": f"Bearer {response.json()['token']}"}
+                states = {}
+
+                async def snapshot(label, meal_id):
+                    meal = await db.meals.find_one({"meal_id": meal_id}, {"_id": 0})
+                    totals = await db.daily_totals.find_one({"date": meal['date']}, {"_id": 0})
+                    states[label] = meal, totals
+
+                response = await http.post("/api/meals/log", headers=headers, json={
+                    "name": "Lunch", "ingredients": "rice, beans", "quantity": "1 bowl",
+                    "calories": 600, "protein": 20, "carbs": 100, "fat": 10
+                })
+                entered = response.json()['meal_id']
+                await http.put(f"/api/meals/{entered}", headers=headers, json={"name": "Burrito bowl"})
+                await snapshot("renamed", entered)
+                await http.put(f"/api/meals/{entered}", headers=headers, json={"name": "Burrito bowl", "calories": 650})
+                await snapshot("calories", entered)
+
+                response = await http.post("/api/meals/log", headers=headers, json={
+                    "name": "Snack", "ingredients": "100g banana"
+                })
+                estimated = response.json()['meal_id']
+                await snapshot("estimated", estimated)
+                await http.put(f"/api/meals/{estimated}", headers=headers, json={"name": "Snack", "ingredients": "200g banana"})
+                await snapshot("re-estimated", estimated)
+                await http.put(f"/api/meals/{estimated}", headers=headers, json={"name": "Snack", "calories": 100})
+                await snapshot("entered", estimated)
+                return states
+        finally:
+            await db.client.drop_database(db.name)
+
+    states = asyncio.run(run())
+    meal, totals = states["renamed"]
+    assert meal['name'] == "Burrito bowl"
+    assert (meal['ingredients'], meal['quantity']) == ("rice, beans", "1 bowl")
+    assert (meal['calories'], meal['protein'], meal['carbs'], meal['fat']) == (600, 20, 100, 10)
+    assert (totals['meals'], totals['calories'], totals['protein']) == (1, 600, 20)
+
+    meal, totals = states["calories"]
+    assert (meal['calories'], meal['protein']) == (650, 20)
+    assert (totals['meals'], totals['calories'], totals['protein']) == (1, 650, 20)
+
+    meal, _ = states["estimated"]
+    assert meal['estimated'] is True
+    one_banana = meal['calories']
+    meal, totals = states["re-estimated"]
+    # Changing the ingredients of an estimated meal re-estimates its macros
+    assert meal['estimated'] is True
+    assert meal['calories'] == pytest.approx(2 * one_banana, abs=1)
+    assert totals['calories'] == 650 + meal['calories']
+
+    meal, totals = states["entered"]
+    assert 'estimated' not in meal
+    assert totals['calories'] == 750
@@ -0,0 +1,64 @@
+"""Local nutrition estimates: short words must not match longer foods, and multi-word foods stay whole."""
+import pytest
+
+from backend import server
+
+
+@pytest.fixture
+def foods(tmp_path, monkeypatch):
+    db_path = str(tmp_path / "foods.db")
+    server.build_nutrition_db(db_path=db_path)
+    index = server.NutritionIndex()
+    index.load(db_path)
+    monkeypatch.setattr(server, "nutrition_index", index)
+    return index
+
+
+def matched_food(index, text):
+    match = index.match(text)
+    return index.foods([match[0]])[match[0]]['name'] if match else None
+
+
+@pytest.mark.parametrize("text, food", [
+    ("salt", "salt"),
+    ("mac & cheese", "mac and cheese"),
+    ("chiken breast", "chicken breast"),
+    ("brocoli", "broccoli"),
+    ("soy milk", None),
+])
+def test_match(foods, text, food):
+    assert matched_food(foods, text) == food
+
+
+def test_seasoning_is_not_a_meal(foods):
+    estimate = server.estimate_nutrition("salt and pepper")
+    assert [item['food'] for item in estimate['items']] == ["salt and pepper"]
+    assert estimate['totals']['calories'] < 10
+
+
+def test_multi_word_foods_are_not_split(foods):
+    estimate = server.estimate_nutrition("mac and cheese with broccoli")
+    assert [item['food'] for item in estimate['items']] == ["mac and cheese", "broccoli"]
+    assert estimate['coverage'] == 1.0
+
+
+def test_unmatched_ingredients_lower_coverage(foods):
+    estimate = server.estimate_nutrition("chicken breast, dragonfruit sorbet")
+    assert estimate['unmatched'] == ["dragonfruit sorbet"]
+    assert estimate['coverage'] < server.NUTRITION_AUTOFILL_MIN_COVERAGE
+
+
+def test_volumes_use_each_foods_density(foods):
+    estimate = server.estimate_nutrition("1 cup rice, 1 cup milk")
+    rice, milk = estimate['items']
+    # A cup of cooked rice is about 158 g, not the 240 g of a cup of water
+    assert rice['grams'] == 158
+    assert rice['calories'] == pytest.approx(205, abs=1)
+    assert milk['grams'] == 244
+    assert server.estimate_nutrition("rice", quantity="2 tbsp")['items'][0]['grams'] == pytest.approx(19.8)
+
+
+def test_volumes_of_foods_without_a_density_are_unmatched(foods):
+    estimate = server.estimate_nutrition("1 cup steak, 200g steak")
+    assert estimate['unmatched'] == ["1 cup steak"]
+    assert [item['grams'] for item in estimate['items']] == [200]
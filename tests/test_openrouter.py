@@ -0,0 +1,90 @@
+"""Concurrent meal analyses against a fake OpenRouter: calls are pooled, bounded by
+AI_MAX_CONCURRENCY, retried on 5xx and never block one another."""
+import asyncio
+import json
+import time
+
+import httpx
+import pytest
+
+from backend import server
+
+UPLOADS = 50
+LATENCY = 0.05
+REPLY = {"name": "Chicken rice bowl", "calories": 620, "protein": 42, "carbs": 70, "fat": 14,
+         "ingredients": "chicken, rice, broccoli", "confidence": 8}
+
+
+class FakeOpenRouter:
+    """httpx transport handler that answers chat completions after a fixed delay"""
+
+    def __init__(self, fail_first: int = 0):
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.requests = 0
+        self.fail_first = fail_first
+
+    async def __call__(self, request: httpx.Request) -> httpx.Response:
+        assert request.url.path.endswith("/chat/completions")
+        self.requests += 1
+        number = self.requests
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(LATENCY)
+        finally:
+            self.in_flight -= 1
+        if number <= self.fail_first:
+            return httpx.Response(503)
+        content = f"```json\n{json.dumps(REPLY)}\n```"
+        return httpx.Response(200, json={"choices": [{"message": {"content": content}}]})
+
+
+@pytest.fixture
+def fake_openrouter(monkeypatch):
+    def install(fake):
+        # Built inside the test's event loop; the module-level ones belong to no loop yet
+        monkeypatch.setattr(server, "openrouter_client", httpx.AsyncClient(
+            base_url=server.OPENROUTER_BASE_URL, transport=httpx.MockTransport(fake)
+        ))
+        monkeypatch.setattr(server, "ai_semaphore", asyncio.Semaphore(server.AI_MAX_CONCURRENCY))
+        monkeypatch.setattr(server, "analysis_cache", server.AnalysisCache(60, 1000))
+        return fake
+    return install
+
+
+async def analyze_uploads():
+    # Not decodable images, so every upload is a distinct cache miss without a perceptual hash
+    started = time.perf_counter()
+    results = await asyncio.gather(*(
+        server.analyze_meal_cached(f"upload-{i}".encode(), "lunch") for i in range(UPLOADS)
+    ))
+    return results, time.perf_counter() - started
+
+
+def test_concurrent_uploads_are_bounded_and_pooled(fake_openrouter):
+    async def run():
+        fake = fake_openrouter(FakeOpenRouter())
+        results, elapsed = await analyze_uploads()
+        await server.openrouter_client.aclose()
+        return fake, results, elapsed
+
+    fake, results, elapsed = asyncio.run(run())
+    assert all(not result.get("fallback") and result["calories"] == 620 for result in results)
+    assert fake.requests == UPLOADS
+    assert fake.max_in_flight == server.AI_MAX_CONCURRENCY
+    # Batches of AI_MAX_CONCURRENCY calls overlap, so 50 uploads take a handful of round trips, not 50
+    batches = -(-UPLOADS // server.AI_MAX_CONCURRENCY)
+    assert elapsed < 3 * batches * LATENCY
+
+
+def test_transient_failures_are_retried(fake_openrouter):
+    async def run():
+        fake = fake_openrouter(FakeOpenRouter(fail_first=10))
+        results, _ = await analyze_uploads()
+        await server.openrouter_client.aclose()
+        return fake, results
+
+    fake, results = asyncio.run(run())
+    assert all(not result.get("fallback") for result in results)
+    assert fake.requests == UPLOADS + 10
@@ -0,0 +1,31 @@
+"""Push connections take a short-lived push token, never the session token, and vice versa."""
+from datetime import datetime, timedelta, UTC
+
+import jwt
+import pytest
+from fastapi import HTTPException
+
+from backend import server
+
+
+def test_push_token_opens_push_connections_only():
+    token = server.create_push_token("user-1")
+    assert server.verify_jwt_token(token, scope="push") == "user-1"
+    with pytest.raises(HTTPException):
+        server.verify_jwt_token(token)
+
+
+def test_session_token_is_rejected_by_push_endpoints():
+    token = server.create_jwt_token("user-1")
+    assert server.verify_jwt_token(token) == "user-1"
+    with pytest.raises(HTTPException):
+        server.verify_jwt_token(token, scope="push")
+
+
+def test_expired_push_token_is_rejected():
+    token = jwt.encode(
+        {"user_id": "user-1", "scope": "push", "exp": datetime.now(UTC) - timedelta(seconds=1)},
+        server.JWT_SECRET, algorithm="HS256"
+    )
+    with pytest.raises(HTTPException):
+        server.verify_jwt_token(token, scope="push")
@@ -0,0 +1,122 @@
+"""Parallel like/follow toggles against a real MongoDB: counters must match edges
+and every operation must stay within its round-trip budget."""
+import asyncio
+import os
+import random
+
+import pytest
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import monitoring
+
+from backend import server
+
+pytestmark = pytest.mark.skipif(not os.environ.get("MONGO_URL"), reason="set MONGO_URL to run against MongoDB")
+
+OPERATIONS = 1000
+ACTORS = [f"toggle-user-{i}" for i in range(100)]
+
+
+class CommandCounter(monitoring.CommandListener):
+    """Counts commands sent to the server, i.e. database round trips"""
+
+    def __init__(self):
+        self.count = 0
+
+    def started(self, event):
+        self.count += 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+async def scratch_database(counter, monkeypatch):
+    db = AsyncIOMotorClient(os.environ["MONGO_URL"], event_listeners=[counter])["eatflex_test_toggles"]
+    await db.client.drop_database(db.name)
+    for name in ("users_collection", "posts_collection", "likes_collection", "follows_collection"):
+        source = getattr(server, name)
+        await db[source.name].create_indexes(server.REQUIRED_INDEXES[source])
+        monkeypatch.setattr(server, name, db[source.name])
+    await db.users.insert_many([
+        {"user_id": user_id, "email": f"{user_id}@example.com", "followers_count": 0, "following_count": 0}
+        for user_id in ACTORS
+    ])
+    await db.posts.insert_one({"post_id": "toggle-post", "user_id": ACTORS[0], "like_count": 0})
+    return db
+
+
+async def count_round_trips(counter, operations):
+    counter.count = 0
+    await asyncio.gather(*operations)
+    return counter.count
+
+
+async def assert_like_count_matches(db):
+    post = await db.posts.find_one({"post_id": "toggle-post"})
+    assert post["like_count"] == await db.likes.count_documents({"active": {"$ne": False}})
+
+
+def test_parallel_like_toggles(monkeypatch):
+    async def run():
+        counter = CommandCounter()
+        db = await scratch_database(counter, monkeypatch)
+        rng = random.Random(0)
+        actors = [rng.choice(ACTORS) for _ in range(OPERATIONS)]
+        round_trips = await count_round_trips(counter, (
+            server.set_like("toggle-post", user_id, None) for user_id in actors
+        ))
+        assert round_trips <= 2 * OPERATIONS
+
+        # Toggles on one edge serialize, so an odd number of taps leaves the post liked
+        await assert_like_count_matches(db)
+        liked = {like["user_id"] async for like in db.likes.find({"active": {"$ne": False}})}
+        assert liked == {user_id for user_id in ACTORS if actors.count(user_id) % 2}
+        await db.client.drop_database(db.name)
+
+    asyncio.run(run())
+
+
+def test_parallel_explicit_likes_are_idempotent(monkeypatch):
+    async def run():
+        counter = CommandCounter()
+        db = await scratch_database(counter, monkeypatch)
+        rng = random.Random(1)
+        # A few hot edges, so most writes find the state already set
+        round_trips = await count_round_trips(counter, (
+            server.set_like("toggle-post", rng.choice(ACTORS[:5]), rng.random() < 0.5)
+            for _ in range(OPERATIONS)
+        ))
+        assert round_trips <= 2 * OPERATIONS
+        await assert_like_count_matches(db)
+        await db.client.drop_database(db.name)
+
+    asyncio.run(run())
+
+
+def test_parallel_follows_keep_counters_in_step(monkeypatch):
+    async def run():
+        counter = CommandCounter()
+        db = await scratch_database(counter, monkeypatch)
+        rng = random.Random(2)
+
+        async def toggle(follower_id, followee_id):
+            # Same decision as the route: an unfollow that changed nothing becomes a follow
+            if not await server.set_follow(follower_id, followee_id, False):
+                await server.set_follow(follower_id, followee_id, True)
+
+        pairs = [rng.sample(ACTORS[:10], 2) for _ in range(OPERATIONS)]
+        explicit = await count_round_trips(counter, (
+            server.set_follow(*pair, rng.random() < 0.5) for pair in pairs
+        ))
+        assert explicit <= 2 * OPERATIONS
+        toggles = await count_round_trips(counter, (toggle(*pair) for pair in pairs))
+        assert toggles <= 3 * OPERATIONS
+
+        async for user in db.users.find():
+            assert user["followers_count"] == await db.follows.count_documents({"followee_id": user["user_id"]})
+            assert user["following_count"] == await db.follows.count_documents({"follower_id": user["user_id"]})
+        await db.client.drop_database(db.name)
+
+    asyncio.run(run())